@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Read every prompt once at startup instead of on the first request
+        from api.bot import prompt_registry
+        prompt_registry.registry.load()
@@ -1,9 +1,14 @@
-from api.models import Message, UserMemoryState
+from api.models import Message, UserDayProgress, UserMemoryState
 from api.bot.gpt_for_summarization import openai_req_generator
+from api.bot import metrics
+from api.bot.metrics import llm_call_site
+from api.bot.Memory import summary_queue
 from django.db.models import Max
+import threading
 import time
 
 
+@llm_call_site("summarize_conversation")
 def summarize_conversation(text, context):
     system_prompt = f"""
     با توجه به پیش‌زمینه‌ای که از مکالمه موجود است و به شرح زیر است:
@@ -17,20 +22,141 @@ def summarize_conversation(text, context):
     return openai_req_generator(system_prompt=system_prompt, json_output=False, temperature=0.1)
 
 
+def format_messages(messages):
+    return "\n".join(
+        f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
+        for msg in messages
+    )
+
+
+class ConversationContext:
+    """
+    A user's messages, memory state, day progress and latest session id,
+    each read at most once. During a turn (MemoryManager.begin_turn ..
+    end_turn) every consumer shares the same context and messages written
+    through MemoryManager are appended to it, so nothing is re-queried and
+    the history is not re-joined for each LLM call.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._memory_state = None
+        self._day_progress = None
+        self._current_day = None
+        self._latest_session_id = None
+        self._messages = None
+        self._history = {}  # session id (None = all sessions) -> rendered history
+        self.lock = threading.Lock()
+
+    @property
+    def memory_state(self):
+        if self._memory_state is None:
+            self._memory_state, created = (UserMemoryState.objects
+                                           .select_related('last_processed_message')
+                                           .get_or_create(user=self.user))
+        return self._memory_state
+
+    @memory_state.setter
+    def memory_state(self, memory_state):
+        self._memory_state = memory_state
+
+    @property
+    def day_progress(self):
+        if self._day_progress is None:
+            self._day_progress, created = UserDayProgress.objects.get_or_create(user=self.user)
+        return self._day_progress
+
+    @property
+    def current_day(self):
+        """The user's program day (1-8), worked out once per context"""
+        if self._current_day is None:
+            self._current_day = self.day_progress.calculate_current_day()
+        return self._current_day
+
+    @property
+    def latest_session_id(self):
+        """Highest session id among the user's messages, 0 if there are none"""
+        with self.lock:
+            if self._messages is not None:
+                return max((msg.session_id for msg in self._messages), default=0)
+            if self._latest_session_id is not None:
+                return self._latest_session_id
+        latest = Message.objects.filter(user=self.user).aggregate(Max('session_id'))['session_id__max'] or 0
+        with self.lock:
+            self._latest_session_id = latest
+        return latest
+
+    @property
+    def messages(self):
+        with self.lock:
+            if self._messages is None:
+                self._messages = list(Message.objects.filter(user=self.user).order_by('timestamp'))
+            return self._messages
+
+    def append(self, message):
+        with self.lock:
+            if self._latest_session_id is not None:
+                self._latest_session_id = max(self._latest_session_id, message.session_id)
+            if self._messages is None:
+                return  # not loaded yet; the first read will include it
+            self._messages.append(message)
+            self._history.pop(None, None)
+            self._history.pop(message.session_id, None)
+
+    def chat_history(self, session_id=None):
+        if session_id is None:
+            return list(self.messages)
+        return [msg for msg in self.messages if msg.session_id == session_id]
+
+    def unprocessed(self, session_id=None):
+        last_processed = self.memory_state.last_processed_message
+        return [
+            msg for msg in self.chat_history(session_id)
+            if last_processed is None or msg.timestamp > last_processed.timestamp
+        ]
+
+    def history_text(self, session_id=None):
+        messages = self.messages
+        with self.lock:
+            text = self._history.get(session_id)
+            if text is None:
+                text = self._history[session_id] = format_messages(
+                    msg for msg in messages if session_id is None or msg.session_id == session_id
+                )
+        return text
+
+
+# Contexts of the turns in progress, shared by every MemoryManager in the process
+_turn_contexts = {}
+_turn_contexts_lock = threading.Lock()
+
+
 class MemoryManager:
     def __init__(self):
         pass
 
+    def begin_turn(self, user):
+        """Read the user's conversation once and serve the rest of the turn from memory"""
+        context = ConversationContext(user)
+        with _turn_contexts_lock:
+            _turn_contexts[user.id] = context
+        return context
+
+    def end_turn(self, user):
+        with _turn_contexts_lock:
+            _turn_contexts.pop(user.id, None)
+
+    def conversation(self, user):
+        """The current turn's context, or a fresh one outside a turn"""
+        return _turn_contexts.get(user.id) or ConversationContext(user)
+
     def get_or_create_memory_state(self, user):
-        print(user, type(user))
-        memory_state, created = UserMemoryState.objects.get_or_create(user=user)
-        return memory_state
+        return self.conversation(user).memory_state
 
     def add_message(self, user, text, is_user=True, session_id=None, state=None):
         # Get the current session ID or create new one
         if session_id is None:
-            current_session = Message.objects.filter(user=user).aggregate(Max('session_id'))['session_id__max']
-            session_id = (current_session or 0) + 1
+            session_id = self.get_latest_session_id(user) + 1
 
         # Create and save the message
         message = Message.objects.create(
@@ -41,38 +167,46 @@ class MemoryManager:
             state=state,
             timestamp=time.time()
         )
+        context = _turn_contexts.get(user.id)
+        if context is not None:
+            context.append(message)
         return message
 
     def get_unprocessed_messages(self, user, session_id=None):
-        memory_state = self.get_or_create_memory_state(user)
-        last_processed = memory_state.last_processed_message
-
-        query = Message.objects.filter(user=user)
-
-        # Filter by session if provided
-        if session_id is not None:
-            query = query.filter(session_id=session_id)
-
-        if last_processed:
-            return query.filter(timestamp__gt=last_processed.timestamp).order_by('timestamp')
-        return query.order_by('timestamp')
+        return self.conversation(user).unprocessed(session_id)
 
     def get_session_messages(self, user, session_id):
         """Get all messages for a specific session"""
         return Message.objects.filter(user=user, session_id=session_id).order_by('timestamp')
 
+    def get_latest_session_id(self, user):
+        return self.conversation(user).latest_session_id
+
+    def get_current_day(self, user):
+        return self.conversation(user).current_day
+
     def get_current_session_messages(self, user):
         """Get messages from the current session"""
-        current_session = Message.objects.filter(user=user).aggregate(Max('session_id'))['session_id__max']
+        current_session = self.get_latest_session_id(user)
         if current_session:
             return self.get_session_messages(user, current_session)
         return Message.objects.none()
 
-    def update_memory(self, user):
-        memory_state = self.get_or_create_memory_state(user)
-        unprocessed_messages = self.get_unprocessed_messages(user)
+    def schedule_summary(self, user):
+        """Refresh the user's memory summary in the background (see summary_queue)"""
+        summary_queue.get_queue().enqueue(user.id)
+
+    def update_memory(self, user, context=None):
+        """
+        Summarize the unprocessed messages now. The new summary is stored only
+        if no other summary was committed meanwhile, so a prompt always
+        pairs the latest committed summary with the messages it does not cover.
+        """
+        context = context or self.conversation(user)
+        memory_state = context.memory_state
+        unprocessed_messages = context.unprocessed()
 
-        if not unprocessed_messages.exists():
+        if not unprocessed_messages:
             return memory_state.current_memory
 
         # Format messages for summarization
@@ -87,49 +221,41 @@ class MemoryManager:
             context=memory_state.current_memory
         )
 
-        # Update the memory state
+        # Update the memory state, unless another summary got there first
+        stored = UserMemoryState.objects.filter(
+            pk=memory_state.pk, last_processed_message_id=memory_state.last_processed_message_id,
+        ).update(current_memory=updated_memory, last_processed_message=unprocessed_messages[-1])
+        if not stored:
+            metrics.SUMMARY_JOBS.inc(outcome="stale")
+            print(f"Memory of user {user.id} was summarized concurrently; dropping this summary")
+            return memory_state.current_memory
         memory_state.current_memory = updated_memory
-        memory_state.last_processed_message = unprocessed_messages.last()
-        memory_state.save()
+        memory_state.last_processed_message = unprocessed_messages[-1]
 
         return updated_memory
 
     def get_chat_history(self, user, session_id=None):
-        query = Message.objects.filter(user=user)
-        if session_id is not None:
-            query = query.filter(session_id=session_id)
-        return query.order_by('timestamp')
+        return self.conversation(user).chat_history(session_id)
 
     def get_current_memory(self, user):
-        memory_state = self.get_or_create_memory_state(user)
-        return memory_state.current_memory
+        return self.conversation(user).memory_state.current_memory
 
     def end_session(self, user):
-        self.update_memory(user)
+        self.schedule_summary(user)
 
     def get_formatted_session_history(self, user, session_id=None):
         """
         Returns the full conversation history for the current session,
         formatted as alternating User/Assistant messages.
         """
-        messages = self.get_chat_history(user, session_id)
-        lines = []
-        for msg in messages:
-            role = "User" if msg.is_user else "Assistant"
-            lines.append(f"{role}: {msg.text}")
-        return "\n".join(lines)
+        return self.conversation(user).history_text(session_id)
 
     def format_memory_for_prompt(self, user, session_id=None):
-        # Get current memory state
-        memory_state = self.get_or_create_memory_state(user)
-        current_memory = memory_state.current_memory or ""
+        context = self.conversation(user)
+        current_memory = context.memory_state.current_memory or ""
 
         # Get unprocessed messages for current session
-        unprocessed = self.get_unprocessed_messages(user, session_id)
-        unprocessed_text = "\n".join([
-            f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
-            for msg in unprocessed
-        ])
+        unprocessed_text = format_messages(context.unprocessed(session_id))
 
         # Combine current memory with unprocessed messages
         if unprocessed_text:
@@ -137,3 +263,35 @@ class MemoryManager:
         else:
             formatted_memory = f"""پیش‌زمینه مکالمه:\n{current_memory}"""
         return formatted_memory.strip()
+
+    # Async variants used by the ASGI simple and placebo chats. They use Django's
+    # async ORM so a request waiting on the LLM does not pin a worker thread.
+
+    async def aadd_message(self, user, text, is_user=True, session_id=None, state=None):
+        if session_id is None:
+            current_session = (await Message.objects.filter(user=user).aaggregate(Max('session_id')))['session_id__max']
+            session_id = (current_session or 0) + 1
+
+        return await Message.objects.acreate(
+            user=user,
+            text=text,
+            session_id=session_id,
+            is_user=is_user,
+            state=state,
+            timestamp=time.time()
+        )
+
+    async def aget_current_session_id(self, user):
+        """Latest session id for the user, or 1 if they have no messages yet"""
+        latest_message = await Message.objects.filter(user=user).order_by('-timestamp').afirst()
+        return latest_message.session_id if latest_message else 1
+
+    async def aget_last_n_history(self, user, n=6):
+        """Last n messages as chat-completion dicts, in chronological order"""
+        messages = [
+            msg async for msg in Message.objects.filter(user=user).order_by('-timestamp')[:n].values('is_user', 'text')
+        ][::-1]
+        return [
+            {"role": "user" if msg["is_user"] else "assistant", "content": msg["text"]}
+            for msg in messages
+        ]
@@ -0,0 +1,169 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.bot import metrics
+from api.models import SummaryJob, User
+
+# Memory summaries are refreshed off the request path. A user has at most
+# one queued job; triggers that fire while one is queued are coalesced, and
+# a trigger during a running job makes it run once more afterwards. Jobs are
+# handed over only when the transaction that wrote the messages commits.
+
+DEFAULT_WORKERS = int(os.getenv('SUMMARY_QUEUE_WORKERS', '2'))
+CLAIM_SECONDS = int(os.getenv('SUMMARY_QUEUE_CLAIM_SECONDS', '300'))  # a crashed worker's job is retried after this
+MAX_ATTEMPTS = int(os.getenv('SUMMARY_QUEUE_MAX_ATTEMPTS', '3'))
+
+
+def summarize_user(user_id):
+    """Fold the user's unprocessed messages into their memory summary"""
+    from api.bot.Memory.LLM_Memory import ConversationContext, MemoryManager
+
+    user = User.objects.get(pk=user_id)
+    # A fresh context: never the one a turn of this user is using right now
+    return MemoryManager().update_memory(user, context=ConversationContext(user))
+
+
+class InlineSummaryQueue:
+    """Summarizes right away, on the caller's thread"""
+
+    def enqueue(self, user_id):
+        summarize_user(user_id)
+        metrics.SUMMARY_JOBS.inc(outcome="done")
+
+
+class LocalSummaryQueue:
+    """Thread pool in this process; jobs are lost if the process exits"""
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+        self.status = {}  # user_id -> "queued", "running" or "rerun"
+        self.lock = threading.Lock()
+
+    def enqueue(self, user_id):
+        transaction.on_commit(lambda: self._submit(user_id))
+
+    def _submit(self, user_id):
+        with self.lock:
+            status = self.status.get(user_id)
+            if status in ("queued", "rerun"):
+                metrics.SUMMARY_JOBS.inc(outcome="coalesced")
+                return
+            if status == "running":
+                self.status[user_id] = "rerun"
+                return
+            self.status[user_id] = "queued"
+        self.pool.submit(self._run, user_id)
+
+    def _run(self, user_id):
+        try:
+            while True:
+                with self.lock:
+                    self.status[user_id] = "running"
+                try:
+                    summarize_user(user_id)
+                    metrics.SUMMARY_JOBS.inc(outcome="done")
+                except Exception as e:
+                    metrics.SUMMARY_JOBS.inc(outcome="failed")
+                    print(f"Summarizing the memory of user {user_id} failed: {e}")
+                with self.lock:
+                    if self.status.get(user_id) != "rerun":
+                        del self.status[user_id]
+                        return
+        finally:
+            connection.close()
+
+    def wait(self):
+        """Block until every job submitted so far has finished (for tests and shutdown)"""
+        while True:
+            with self.lock:
+                if not self.status:
+                    return
+            time.sleep(0.01)
+
+
+class DatabaseSummaryQueue:
+    """
+    One SummaryJob row per user, shared by every web worker and processed
+    by `manage.py run_summary_worker`; jobs survive restarts.
+    """
+
+    def __init__(self, claim_seconds=CLAIM_SECONDS):
+        self.claim_seconds = claim_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def enqueue(self, user_id):
+        # A newer requested_at on a claimed job tells its worker to run it again
+        _, created = SummaryJob.objects.update_or_create(user_id=user_id, defaults={'requested_at': timezone.now()})
+        if not created:
+            metrics.SUMMARY_JOBS.inc(outcome="coalesced")
+
+    def claim(self, limit=10):
+        """Claim up to `limit` jobs that are unclaimed or whose claim expired"""
+        now = timezone.now()
+        candidates = (SummaryJob.objects.filter(Q(claimed_by="") | Q(claimed_until__lt=now))
+                      .order_by('requested_at').values_list('id', flat=True)[:limit])
+        claimed = []
+        for job_id in candidates:
+            taken = SummaryJob.objects.filter(id=job_id).filter(Q(claimed_by="") | Q(claimed_until__lt=now)).update(
+                claimed_by=self.worker_id, claimed_until=now + timedelta(seconds=self.claim_seconds))
+            if taken:
+                claimed.append(SummaryJob.objects.get(id=job_id))
+        return claimed
+
+    def run(self, job):
+        try:
+            summarize_user(job.user_id)
+        except Exception as e:
+            metrics.SUMMARY_JOBS.inc(outcome="failed")
+            print(f"Summarizing the memory of user {job.user_id} failed: {e}")
+            if job.attempts + 1 >= MAX_ATTEMPTS:
+                SummaryJob.objects.filter(id=job.id, claimed_by=self.worker_id).delete()
+            else:
+                SummaryJob.objects.filter(id=job.id, claimed_by=self.worker_id).update(
+                    claimed_by="", claimed_until=None, attempts=job.attempts + 1)
+            return False
+        metrics.SUMMARY_JOBS.inc(outcome="done")
+        # Done, unless it was requested again while running
+        finished = SummaryJob.objects.filter(
+            id=job.id, claimed_by=self.worker_id, requested_at=job.requested_at).delete()[0]
+        if not finished:
+            SummaryJob.objects.filter(id=job.id, claimed_by=self.worker_id).update(claimed_by="", claimed_until=None)
+        return True
+
+    def run_pending(self, limit=10):
+        """Claim and run pending jobs; returns how many ran"""
+        jobs = self.claim(limit)
+        for job in jobs:
+            self.run(job)
+        return len(jobs)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """The queue named by settings.SUMMARY_QUEUE_BACKEND ("local", "database" or "inline")"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            backend = getattr(settings, 'SUMMARY_QUEUE_BACKEND', 'local')
+            if backend == 'local':
+                _queue = LocalSummaryQueue(getattr(settings, 'SUMMARY_QUEUE_WORKERS', DEFAULT_WORKERS))
+            elif backend == 'database':
+                _queue = DatabaseSummaryQueue()
+            elif backend == 'inline':
+                _queue = InlineSummaryQueue()
+            else:
+                raise ValueError(f"Unknown summary queue backend: {backend}")
+        return _queue
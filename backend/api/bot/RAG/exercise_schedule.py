@@ -0,0 +1,56 @@
+import json
+import re
+
+from api.bot import prompt_registry
+
+# Which exercises a user may do on each program day. Day 1 opens the 0.x
+# exercises and exercises 1-3, every further day opens three more, and from
+# the last day on everything is open. The exercises of each day are worked
+# out once from exercises_mapping.json, so both bots filter by a dict lookup.
+
+LAST_DAY = 8
+EXERCISES_PER_DAY = 3
+
+with open(prompt_registry.bot_path('RAG', 'exercises_mapping.json'), 'r', encoding='utf-8') as f:
+    exercises = json.load(f)
+
+
+def base_number(exercise_num):
+    """Parse exercise number to base number (e.g., '2a' -> 2, '0.1' -> 0)"""
+    if '.' in exercise_num:
+        return int(float(exercise_num))
+    match = re.match(r'(\d+)', exercise_num)
+    return int(match.group(1)) if match else 0
+
+
+def allowed_numbers(day):
+    """Base numbers open on a given day, or None if all exercises are"""
+    if day >= LAST_DAY:
+        return None
+    if day < 1:
+        day = 1  # Default to first day's exercises
+    return [0] + list(range(1, day * EXERCISES_PER_DAY + 1))
+
+
+def build_index(exercise_list):
+    """{day: exercises open on that day} for days 1..LAST_DAY, in file order"""
+    numbered = [(base_number(exercise["Exercise Number"]), exercise) for exercise in exercise_list]
+    index = {}
+    for day in range(1, LAST_DAY + 1):
+        allowed = allowed_numbers(day)
+        if allowed is None:
+            index[day] = list(exercise_list)
+        else:
+            allowed = set(allowed)
+            index[day] = [exercise for number, exercise in numbered if number in allowed]
+    return index
+
+
+_index = build_index(exercises)
+
+
+def exercises_for_day(day):
+    """The exercises open on `day`; callers must not modify the list"""
+    if day >= LAST_DAY:
+        return _index[LAST_DAY]
+    return _index.get(day, _index[1])
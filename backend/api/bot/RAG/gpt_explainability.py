@@ -1,5 +1,8 @@
 from api.bot.gpt import openai_req_generator
+from api.bot.metrics import llm_call_site
+from api.bot import prompt_registry
 
+@llm_call_site("exercise_explanation")
 def create_exercise_explanation(memory: str, exercise_content: str) -> str:
     """
     Creates personalized explanation for why a specific exercise is recommended based on user's memory
@@ -12,12 +15,11 @@ def create_exercise_explanation(memory: str, exercise_content: str) -> str:
         Single string containing personalized explanation
     """
     try:
-        with open('api/bot/RAG/exercise_explanation_prompt.md', 'r', encoding='utf-8') as f:
-            prompt_template = f.read()
+        prompt_template = prompt_registry.get('RAG/exercise_explanation_prompt.md')
     except FileNotFoundError:
         return "خطا: قالب توضیحات یافت نشد"
 
-    formatted_prompt = prompt_template.format(
+    formatted_prompt = prompt_template.render(
         memory=memory,
         exercise_descriptions=exercise_content
     )
@@ -0,0 +1,229 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+
+from api.bot import prompt_registry
+from api.bot.cache import hash_text
+
+# Sections of sat_knowledge_base.md are ranked against the user's message
+# with BM25, so each prompt carries the parts of the knowledge base that
+# matter for the state and the message instead of the whole file.
+
+KNOWLEDGE_FILE = 'RAG/sat_knowledge_base.md'
+INDEX_PATH = os.getenv(
+    'SAT_KNOWLEDGE_INDEX_PATH', str(Path(__file__).resolve().parents[3] / 'sat_knowledge_index.json')
+)
+TOP_K = int(os.getenv('SAT_KNOWLEDGE_TOP_K', '3'))
+# Long sections are split at paragraph breaks into chunks of about this size
+MAX_CHUNK_CHARS = int(os.getenv('SAT_KNOWLEDGE_CHUNK_CHARS', '1200'))
+BM25_K1 = 1.5
+BM25_B = 0.75
+INDEX_VERSION = 1
+
+UNAVAILABLE = "دانش پایه SAT در دسترس نیست."
+
+DEFAULT_SECTIONS = {'default': ['هدف اصلی SAT', 'مکانیزم عمل']}
+
+STOPWORDS = {
+    'و', 'در', 'به', 'از', 'که', 'را', 'با', 'این', 'آن', 'است', 'برای', 'یا', 'تا', 'هم', 'می', 'ها', 'های',
+    'ای', 'یک', 'بر', 'هر', 'شود', 'کند', 'کنید', 'باید', 'خود', 'نیز', 'اما', 'اگر', 'چه', 'من', 'تو', 'ما',
+    'هست', 'بود', 'شد', 'کرد', 'دارد', 'the', 'and', 'of', 'to', 'a', 'in',
+}
+_CHAR_MAP = str.maketrans({'\u064a': '\u06cc', '\u0649': '\u06cc', '\u0643': '\u06a9', '\u0629': '\u0647',
+                           '\u200c': ' ', '\u0640': ''})  # Arabic yeh/kaf -> Persian, ZWNJ -> space
+_DIACRITICS = re.compile('[\u064b-\u0652\u0670]')
+_TOKEN = re.compile(r'\w+')
+_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*:?\s*$')
+
+
+def tokenize(text):
+    text = _DIACRITICS.sub('', text.translate(_CHAR_MAP)).lower()
+    return [token for token in _TOKEN.findall(text) if len(token) > 1 and token not in STOPWORDS]
+
+
+def _split_long(text, limit):
+    parts, current = [], ""
+    for paragraph in text.split("\n\n"):
+        if current and len(current) + len(paragraph) > limit:
+            parts.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        parts.append(current)
+    return parts
+
+
+def chunk_markdown(text, max_chars=MAX_CHUNK_CHARS):
+    """
+    One chunk per heading (its own lines up to the next heading). A chunk's
+    section is its heading text; long sections become several chunks.
+    """
+    sections = []  # [section, parent, lines]
+    parent = None
+    for line in text.splitlines():
+        match = _HEADING.match(line)
+        if match:
+            level, title = len(match.group(1)), match.group(2)
+            if level <= 2:
+                parent = title
+            sections.append([title, parent if level > 2 else None, [line]])
+        elif sections:
+            sections[-1][2].append(line)
+
+    chunks = []
+    for section, parent, lines in sections:
+        body = "\n".join(lines[1:]).strip()
+        if not body:
+            continue
+        for part in _split_long(body, max_chars):
+            chunks.append({
+                'id': len(chunks),
+                'section': section,
+                'parent': parent,
+                'text': f"{lines[0]}\n{part}",
+            })
+    return chunks
+
+
+class KnowledgeIndex:
+    """BM25 index over the knowledge base chunks"""
+
+    def __init__(self, source_hash, chunks, term_freqs, doc_freqs):
+        self.source_hash = source_hash
+        self.chunks = chunks
+        self.term_freqs = term_freqs
+        self.doc_freqs = doc_freqs
+        self.lengths = [sum(freqs.values()) for freqs in term_freqs]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+
+    @classmethod
+    def build(cls, text):
+        chunks = chunk_markdown(text)
+        term_freqs = [
+            dict(Counter(tokenize(" ".join(filter(None, [chunk['parent'], chunk['text']])))))
+            for chunk in chunks
+        ]
+        doc_freqs = Counter(term for freqs in term_freqs for term in freqs)
+        return cls(hash_text(text), chunks, term_freqs, dict(doc_freqs))
+
+    def to_dict(self):
+        return {
+            'version': INDEX_VERSION,
+            'source_hash': self.source_hash,
+            'chunks': self.chunks,
+            'term_freqs': self.term_freqs,
+            'doc_freqs': self.doc_freqs,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['source_hash'], data['chunks'], data['term_freqs'], data['doc_freqs'])
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, source_hash):
+        """The index stored at path, or None if it is missing or stale"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != INDEX_VERSION or data.get('source_hash') != source_hash:
+            return None
+        return cls.from_dict(data)
+
+    def score(self, query_terms, i):
+        freqs, length = self.term_freqs[i], self.lengths[i]
+        total = 0.0
+        for term in query_terms:
+            tf = freqs.get(term)
+            if not tf:
+                continue
+            df = self.doc_freqs[term]
+            idf = math.log(1 + (len(self.chunks) - df + 0.5) / (df + 0.5))
+            total += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / self.avg_length))
+        return total
+
+    def search(self, query, k=TOP_K, exclude=()):
+        """Up to k chunks matching the query, best first"""
+        terms = set(tokenize(query or ""))
+        if not terms or k <= 0:
+            return []
+        scored = [
+            (self.score(terms, i), chunk['id'])
+            for i, chunk in enumerate(self.chunks)
+            if chunk['id'] not in exclude
+        ]
+        scored = sorted((item for item in scored if item[0] > 0), key=lambda item: -item[0])[:k]
+        return [self.chunks[chunk_id] for _, chunk_id in scored]
+
+    def section_chunks(self, sections):
+        wanted = set(sections)
+        return [chunk for chunk in self.chunks if chunk['section'] in wanted or chunk['parent'] in wanted]
+
+
+_index = None
+_index_template = None  # registry entry the index was built from
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The index for the current knowledge base text, rebuilt when the file changes"""
+    global _index, _index_template
+    template = prompt_registry.get(KNOWLEDGE_FILE)
+    if template is _index_template:
+        return _index
+    with _index_lock:
+        if template is _index_template:
+            return _index
+        source_hash = hash_text(template.text)
+        index = KnowledgeIndex.load(INDEX_PATH, source_hash)
+        if index is None:
+            index = KnowledgeIndex.build(template.text)
+            try:
+                index.save(INDEX_PATH)
+            except OSError as e:
+                print(f"Could not write the knowledge index to {INDEX_PATH}: {e}")
+        _index, _index_template = index, template
+    return _index
+
+
+def state_sections(state):
+    """Sections always included for a state, from settings.SAT_KNOWLEDGE_SECTIONS"""
+    table = getattr(settings, 'SAT_KNOWLEDGE_SECTIONS', DEFAULT_SECTIONS)
+    return table.get(state, table.get('default', []))
+
+
+def _render(chunks):
+    return "\n\n".join(chunk['text'] for chunk in sorted(chunks, key=lambda chunk: chunk['id']))
+
+
+def state_knowledge(state):
+    """The state's allowlisted sections; identical for every user, so it belongs in the prompt prefix"""
+    try:
+        index = get_index()
+    except FileNotFoundError:
+        return UNAVAILABLE
+    return _render(index.section_chunks(state_sections(state)))
+
+
+def relevant_knowledge(query, state, k=TOP_K):
+    """The k sections that best match the query, leaving out the state's allowlisted ones"""
+    try:
+        index = get_index()
+    except FileNotFoundError:
+        return ""
+    allowlisted = {chunk['id'] for chunk in index.section_chunks(state_sections(state))}
+    return _render(index.search(query, k, exclude=allowlisted))
@@ -3,26 +3,21 @@ import json
 import random
 
 from typing import List
-from dotenv import load_dotenv
-from openai import OpenAI
+from api.bot.llm_client import chat_completion
+from api.bot.metrics import llm_call_site
+from api.bot import prompt_registry
+from api.bot.RAG.exercise_schedule import exercises
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
-# Load exercises from JSON file
-with open('api/bot/RAG/exercises_mapping.json', 'r', encoding='utf-8') as f:
-    exercises = json.load(f)
-
-
 def get_exercise_content(ids):
     exercise_contents = []
 
     for exercise_num in ids:
-        file_path = f'api/bot/RAG/Exercises/exercise{exercise_num}.txt'
+        file_path = f'RAG/Exercises/exercise{exercise_num}.txt'
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                exercise_contents.append(content)
+            exercise_contents.append(prompt_registry.text(file_path))
         except FileNotFoundError:
             print(f"Exercise file {file_path} not found")
             continue
@@ -49,20 +44,20 @@ def suggest_exercises(done_exercises: List[str], user_memory: str, user_stage: s
         return None, None
 
     # First get 3 potential exercises using the initial prompt
-    with open('api/bot/RAG/prompt.md', 'r', encoding='utf-8') as f:
-        system_prompt = f.read()
+    template = prompt_registry.get('RAG/prompt.md')
 
     # shuffle json of excerices to prevent bias on first items
     random.shuffle(available_exercises)
 
-    system_prompt = system_prompt.format(
+    system_prompt = template.render(
         memory=user_memory,
         stage=user_stage,
         done_before=','.join(done_exercises) if done_exercises else "None",
-        exc=json.dumps(available_exercises, ensure_ascii=False, indent=2),
+        exc=json.dumps(available_exercises, ensure_ascii=False, separators=(',', ':')),
     )
 
-    potential_excs_nums = openai_req_generator(system_prompt=system_prompt).split(',')
+    with llm_call_site("suggest_exercises:shortlist"):
+        potential_excs_nums = openai_req_generator(system_prompt=system_prompt).split(',')
     print(potential_excs_nums)
     potential_excs_nums = [exc_num.strip() for exc_num in potential_excs_nums]
 
@@ -76,8 +71,7 @@ def suggest_exercises(done_exercises: List[str], user_memory: str, user_stage: s
     ]
 
     # Use the exercise decider to choose the best exercise
-    with open('api/bot/RAG/exercise_decider.md', 'r', encoding='utf-8') as f:
-        decider_prompt = f.read()
+    decider_prompt = prompt_registry.get('RAG/exercise_decider.md')
 
     # Format a structured prompt with all the data needed for decision
     exercise_data = []
@@ -93,7 +87,7 @@ def suggest_exercises(done_exercises: List[str], user_memory: str, user_stage: s
             "Why": metadata.get("Why", "")
         })
 
-    decision_prompt = decider_prompt.format(
+    decision_prompt = decider_prompt.render(
         memory=user_memory,
         stage=user_stage,
         exc=exercise_data,
@@ -101,7 +95,8 @@ def suggest_exercises(done_exercises: List[str], user_memory: str, user_stage: s
     )
 
     # Get the final chosen exercise number
-    chosen_exc_num = openai_req_generator(system_prompt=decision_prompt).strip()
+    with llm_call_site("suggest_exercises:decide"):
+        chosen_exc_num = openai_req_generator(system_prompt=decision_prompt).strip()
 
     # Get the content for the chosen exercise
     chosen_exc_content = get_exercise_content([chosen_exc_num])
@@ -109,19 +104,8 @@ def suggest_exercises(done_exercises: List[str], user_memory: str, user_stage: s
     return chosen_exc_content, chosen_exc_num
 
 
-load_dotenv(override=True)
-
-client = OpenAI(
-    api_key=os.getenv('OPENAI_API_KEY'),
-)
-
-
 def openai_req_generator(system_prompt):
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": system_prompt}
-        ],
-        model="gpt-4o",
+    return chat_completion(
+        [{"role": "system", "content": system_prompt}],
         temperature=0.05,
     )
-    return chat_completion.choices[0].message.content
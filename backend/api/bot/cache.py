@@ -0,0 +1,176 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with an optional per-entry TTL (seconds)"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def normalize_prompt(text):
+    """Collapse whitespace so cosmetic prompt edits do not split cache entries"""
+    return " ".join((text or "").split())
+
+
+def response_cache_key(model, temperature, messages, json_output=False):
+    payload = json.dumps([
+        model,
+        round(float(temperature), 4),
+        bool(json_output),
+        [[message["role"], normalize_prompt(message["content"])] for message in messages],
+    ], ensure_ascii=False)
+    return hash_text(payload)
+
+
+class ResponseCache:
+    """
+    Content-addressed cache for deterministic (low-temperature) LLM calls.
+    An in-memory LRU fronts a SQLite table so entries survive restarts and are
+    shared by every worker on the host.
+    """
+
+    def __init__(self, path, memory_size=2048, max_rows=50000):
+        self.path = str(path)
+        self.memory = LRUCache(maxsize=memory_size)
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_response_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS llm_response_cache_last_used ON llm_response_cache (last_used)"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not MISSING:
+            self.memory_hits += 1
+            return value
+
+        with self.lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT response FROM llm_response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return MISSING
+            connection.execute(
+                "UPDATE llm_response_cache SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            connection.commit()
+
+        self.disk_hits += 1
+        self.memory.set(key, row[0])
+        return row[0]
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_response_cache (key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            count = connection.execute("SELECT COUNT(*) FROM llm_response_cache").fetchone()[0]
+            if count > self.max_rows:
+                # Drop the least recently used tenth in one go rather than a row per insert
+                overflow = count - self.max_rows + self.max_rows // 10
+                connection.execute(
+                    "DELETE FROM llm_response_cache WHERE key IN "
+                    "(SELECT key FROM llm_response_cache ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+                self.disk_evictions += overflow
+            connection.commit()
+
+    def clear(self):
+        self.memory.clear()
+        with self.lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM llm_response_cache")
+            connection.commit()
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_size": len(self.memory),
+            "memory_evictions": self.memory.evictions,
+            "disk_evictions": self.disk_evictions,
+        }
@@ -0,0 +1,96 @@
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from api.bot import metrics
+
+# Shared across turns so a busy worker does not spawn threads per request
+PLANNER_MAX_WORKERS = int(os.getenv('LLM_PLANNER_MAX_WORKERS', '16'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PLANNER_MAX_WORKERS, thread_name_prefix="llm-call")
+    return _executor
+
+
+class CallNode:
+    def __init__(self, name, fn, inputs, args, kwargs):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.args = args
+        self.kwargs = kwargs
+
+
+class CallPlan:
+    """
+    Per-turn DAG of LLM calls. Each node declares the nodes whose results it
+    consumes; nodes whose inputs are ready run concurrently, so a turn costs
+    its critical path instead of the sum of its calls.
+
+    Node functions are called as fn(*input_results, *args, **kwargs). They run
+    on worker threads, so resolve any ORM reads on the request thread first
+    and pass the values in.
+    """
+
+    def __init__(self, executor=None):
+        self.nodes = {}
+        self.executor = executor
+
+    def add(self, name, fn, *args, inputs=(), **kwargs):
+        if name in self.nodes:
+            raise ValueError(f"Duplicate call node: {name}")
+        for dependency in inputs:
+            if dependency not in self.nodes:
+                raise ValueError(f"Call node {name} depends on unknown node {dependency}")
+        self.nodes[name] = CallNode(name, fn, inputs, args, kwargs)
+        return self
+
+    def critical_path(self):
+        """Length (in calls) of the longest dependency chain"""
+        depth = {}
+        for name, node in self.nodes.items():  # insertion order is topological
+            depth[name] = 1 + max((depth[dep] for dep in node.inputs), default=0)
+        return max(depth.values(), default=0)
+
+    def start(self):
+        """
+        Dispatch every node and return {name: Future} without waiting. Callers
+        can consume some results (e.g. stream a reply) while the rest finish.
+        """
+        executor = self.executor or get_executor()
+        futures = {}
+        # Nodes are submitted in topological order, so by the time a node is
+        # dequeued its inputs are already running or done and waiting on them
+        # cannot starve the shared pool.
+        for name, node in self.nodes.items():
+            dependencies = [futures[dep] for dep in node.inputs]
+            # Each node runs in a copy of the caller's context so metric labels follow it
+            context = contextvars.copy_context()
+            futures[name] = executor.submit(context.run, self._call, node, dependencies, time.perf_counter())
+        return futures
+
+    def run(self):
+        """Run the plan to completion and return {name: result}"""
+        futures = self.start()
+        try:
+            return {name: future.result() for name, future in futures.items()}
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
+
+    @staticmethod
+    def _call(node, dependencies, submitted_at):
+        metrics.QUEUE_SECONDS.set(time.perf_counter() - submitted_at)
+        call_args = [dependency.result() for dependency in dependencies] + list(node.args)
+        return node.fn(*call_args, **node.kwargs)
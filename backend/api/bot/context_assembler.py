@@ -0,0 +1,120 @@
+import functools
+import os
+
+import tiktoken
+from django.conf import settings
+
+from api.bot import metrics
+
+TOKENIZER_ENCODING = os.getenv('LLM_TOKENIZER_ENCODING', 'o200k_base')
+DEFAULT_CONTEXT_BUDGET = int(os.getenv('LLM_CONTEXT_BUDGET', '12000'))
+TOKEN_CACHE_SIZE = int(os.getenv('LLM_TOKEN_CACHE_SIZE', '8192'))
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    # tiktoken downloads the encoding file on first use (or reads it from
+    # TIKTOKEN_CACHE_DIR); only a host that can do neither estimates counts
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except OSError as e:
+        print(f"Tokenizer encoding {TOKENIZER_ENCODING} unavailable, estimating token counts: {e}")
+        return None
+
+
+def _count(text):
+    encoding = _encoding()
+    if encoding is None:
+        # About four UTF-8 bytes per token; Persian letters take two bytes each
+        return (len(text.encode('utf-8')) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def count_tokens(text):
+    """Token count of `text`; cached, since prompts and history lines repeat every turn"""
+    return _count(text) if text else 0
+
+
+def truncate_to_tokens(text, limit):
+    """Longest head of `text` that fits in `limit` tokens"""
+    if limit <= 0:
+        return ""
+    tokens = _count(text)
+    while tokens > limit:
+        text = text[:int(len(text) * limit / tokens * 0.95)]
+        tokens = _count(text)
+    return text
+
+
+def context_budget(state=None):
+    """Token budget for a whole system prompt, from settings.LLM_CONTEXT_BUDGETS"""
+    budgets = getattr(settings, 'LLM_CONTEXT_BUDGETS', {})
+    return budgets.get(state, budgets.get('default', DEFAULT_CONTEXT_BUDGET))
+
+
+def format_turn(message):
+    return f"{'User' if message.is_user else 'Assistant'}: {message.text}"
+
+
+class AssembledContext:
+    def __init__(self, memory, turns, tokens, dropped):
+        self.memory = memory
+        self.turns = turns
+        self.tokens = tokens
+        self.dropped = dropped  # {"turns": n, "memory_tokens": n} for what did not fit
+
+    def render(self, history_title="تاریخچه کامل مکالمه این جلسه"):
+        history = "\n".join(self.turns)
+        if self.dropped.get("turns"):
+            history = f"(… {self.dropped['turns']} پیام قدیمی‌تر به دلیل محدودیت طول حذف شد)\n" + history
+        return (f"### خلاصه اطلاعات کاربر:\nپیش‌زمینه مکالمه:\n{self.memory}"
+                f"\n\n### {history_title}:\n{history}")
+
+    @property
+    def text(self):
+        return self.render()
+
+
+def assemble(memory, spans, budget, fixed_text="", state=None):
+    """
+    Fit the memory summary and conversation turns into `budget` tokens.
+    `spans` are message querysets/lists that may overlap (e.g. unprocessed
+    messages and the session history); each message is used once, in
+    timestamp order. Priority: `fixed_text` (the system rules already in the
+    prompt) > memory > recent turns > older turns. Older turns are dropped
+    as a block, so the history that remains is contiguous.
+    """
+    unique = {}
+    for span in spans:
+        for message in span:
+            unique.setdefault(message.id, message)
+    lines = [format_turn(message) for message in sorted(unique.values(), key=lambda m: (m.timestamp, m.id))]
+
+    dropped = {}
+    remaining = budget - count_tokens(fixed_text)
+    memory = memory or ""
+    memory_tokens = count_tokens(memory)
+    if memory_tokens > remaining:
+        memory = truncate_to_tokens(memory, remaining)
+        dropped["memory_tokens"] = memory_tokens - count_tokens(memory)
+    remaining -= count_tokens(memory)
+
+    kept = []
+    for line in reversed(lines):
+        cost = count_tokens(line) + 1  # newline
+        if cost > remaining:
+            break
+        kept.append(line)
+        remaining -= cost
+    if len(kept) < len(lines):
+        dropped["turns"] = len(lines) - len(kept)
+
+    label = state or '-'
+    for part, amount in dropped.items():
+        metrics.LLM_CONTEXT_DROPPED.inc(amount, state=label, part=part)
+    if dropped:
+        print(f"Context over budget ({budget} tokens) in {label}, dropped {dropped}")
+    context = AssembledContext(memory, kept[::-1], budget - remaining, dropped)
+    metrics.LLM_CONTEXT_TOKENS.observe(context.tokens, state=label)
+    return context
@@ -0,0 +1,27 @@
+from contextlib import ExitStack, contextmanager
+
+from django.db import transaction
+
+# SQLite opens a transaction as a reader and upgrades it at its first write.
+# Two workers that both read before writing then deadlock, and one of them
+# fails at once with "database is locked" instead of waiting. The shared
+# lease, buffer and user state writes take the write lock up front instead;
+# every other transaction keeps SQLite's default, so readers never queue
+# behind a writer.
+
+
+@contextmanager
+def immediate_atomic(using=None):
+    """transaction.atomic() that, on SQLite, takes the write lock when it begins"""
+    connection = transaction.get_connection(using)
+    with ExitStack() as stack:
+        if connection.vendor != 'sqlite' or connection.in_atomic_block:
+            stack.enter_context(transaction.atomic(using=using))
+        else:
+            connection.ensure_connection()
+            previous, connection.transaction_mode = connection.transaction_mode, "IMMEDIATE"
+            try:
+                stack.enter_context(transaction.atomic(using=using))
+            finally:
+                connection.transaction_mode = previous
+        yield
@@ -0,0 +1,189 @@
+# The chatbot's states as data. For each state: how it replies, which judge
+# and classifier calls decide where it goes next, and which context pieces
+# its prompt carries. StateMachine runs a state only through its spec, so
+# the LLM calls (and therefore the cost) of a state can be read off this
+# table, and cheap states skip the context they do not use.
+
+# Context a reply prompt can carry
+MEMORY = "memory"          # memory summary and the messages it does not cover yet
+HISTORY = "history"        # the session's conversation history
+KNOWLEDGE = "knowledge"    # SAT knowledge sections (allowlisted and retrieved)
+REPETITION = "repetition"  # phrases the bot already used, and the guidance about them
+CONTEXT_PIECES = (MEMORY, HISTORY, KNOWLEDGE, REPETITION)
+
+# How a state produces its reply
+REPLY_PROMPT = "prompt"          # one ask_llm call with the state's prompt
+REPLY_SUGGESTION = "suggestion"  # the exercise suggestion pipeline
+REPLIES = (REPLY_PROMPT, REPLY_SUGGESTION)
+
+# Classifiers: name -> user state field their label is stored in
+CLASSIFIERS = {
+    "emotion": "emotion",
+    "response": "response",
+}
+
+# Verdict of a judge that lets the state move on
+JUDGE_YES = "بله"
+
+
+class Transition:
+    """Go to `target` if every condition given holds; a state's first matching rule wins"""
+
+    def __init__(self, target, judged=False, label=None, min_messages=0, message_has=(), min_history=0):
+        self.target = target
+        self.judged = judged              # the judge said the state has what it needs
+        self.label = label                # text in the classifier's label
+        self.min_messages = min_messages  # messages received in the state (its counter)
+        self.message_has = tuple(message_has)  # any of these in the user's message
+        self.min_history = min_history    # messages in the user's chat history
+
+    def matches(self, verdict, label, count, message, history_length):
+        return ((not self.judged or JUDGE_YES in (verdict or ""))
+                and (self.label is None or self.label in (label or ""))
+                and count >= self.min_messages
+                and (not self.message_has or any(word in message for word in self.message_has))
+                and history_length >= self.min_history)
+
+
+class StateSpec:
+    """
+    One FSM state. `judge` is a prompt of if_data_sufficient_for_state_change
+    (with the memory summary in its context if `judge_memory`), `classifier`
+    a key of CLASSIFIERS. A state with `decide_on_reply` has no reply of its
+    own: its transitions run when the reply is due and the next state answers.
+    """
+
+    def __init__(self, name, prompt=None, reply=REPLY_PROMPT, judge=None, judge_memory=True, judge_in_reply=False,
+                 classifier=None, counter=None, transitions=(), decide_on_reply=False, context=CONTEXT_PIECES,
+                 prefetch=False, when_exhausted=None):
+        self.name = name
+        self.prompt = prompt
+        self.reply = reply
+        self.judge = judge
+        self.judge_memory = judge_memory
+        self.judge_in_reply = judge_in_reply  # the reply prompt is told the judge's verdict
+        self.classifier = classifier
+        self.counter = counter  # user state field counting messages in this state; reset on entry
+        self.transitions = tuple(transitions)
+        self.decide_on_reply = decide_on_reply
+        self.context = tuple(context)
+        self.prefetch = prefetch  # entering the state starts the exercise suggestion speculatively
+        self.when_exhausted = when_exhausted  # next state when no exercise is left to suggest
+
+    @property
+    def needs_history_length(self):
+        return any(rule.min_history for rule in self.transitions)
+
+    def llm_calls(self):
+        """Names of the LLM calls a turn in this state makes, in order"""
+        calls = []
+        if self.judge:
+            calls.append(f"judge:{self.judge}")
+        if self.classifier:
+            calls.append(f"classifier:{self.classifier}")
+        if self.decide_on_reply:
+            return calls
+        if self.reply == REPLY_PROMPT:
+            calls.append(f"ask_llm:{self.prompt}")
+        elif self.reply == REPLY_SUGGESTION:
+            calls += ["suggest_exercises:shortlist", "suggest_exercises:decide", "customize_exercises",
+                      "exercise_explanation"]
+        return calls + ["recommendations"]
+
+
+def compile_states(specs):
+    """Check a state table and index it by name"""
+    states = {}
+    for spec in specs:
+        if spec.name in states:
+            raise ValueError(f"State {spec.name} is declared twice")
+        if spec.reply not in REPLIES:
+            raise ValueError(f"State {spec.name} has an unknown reply kind: {spec.reply}")
+        if spec.reply == REPLY_PROMPT and not spec.decide_on_reply and not spec.prompt:
+            raise ValueError(f"State {spec.name} replies with a prompt but names none")
+        if spec.classifier is not None and spec.classifier not in CLASSIFIERS:
+            raise ValueError(f"State {spec.name} has an unknown classifier: {spec.classifier}")
+        unknown = set(spec.context) - set(CONTEXT_PIECES)
+        if unknown:
+            raise ValueError(f"State {spec.name} asks for unknown context: {sorted(unknown)}")
+        for rule in spec.transitions:
+            if rule.judged and not spec.judge:
+                raise ValueError(f"State {spec.name} has a judged transition but no judge")
+            if rule.label is not None and not spec.classifier:
+                raise ValueError(f"State {spec.name} has a labelled transition but no classifier")
+            if rule.min_messages and not spec.counter:
+                raise ValueError(f"State {spec.name} counts messages but has no counter")
+        states[spec.name] = spec
+    for spec in states.values():
+        targets = [rule.target for rule in spec.transitions] + [spec.when_exhausted]
+        for target in targets:
+            if target is not None and target not in states:
+                raise ValueError(f"State {spec.name} goes to unknown state {target}")
+        if spec.decide_on_reply and (not spec.transitions or spec.transitions[-1].label or spec.transitions[-1].judged):
+            raise ValueError(f"State {spec.name} decides on reply, so its last transition must be unconditional")
+    return states
+
+
+STATES = compile_states([
+    StateSpec(
+        "GREETING_FORMALITY_NAME", prompt="greeting_formality_name.md",
+        judge="greeting.md", judge_in_reply=True,
+        transitions=[Transition("EMOTION", judged=True)],
+    ),
+    StateSpec(
+        "EMOTION", prompt="emotion.md",
+        judge="emotion.md", judge_memory=False, judge_in_reply=True, counter='emotion_message_count',
+        transitions=[Transition("EMOTION_DECIDER", judged=True, min_messages=2)],
+    ),
+    StateSpec(
+        "EMOTION_DECIDER", classifier="emotion", decide_on_reply=True,
+        transitions=[Transition("ASK_EXERCISE", label="Positive"), Transition("SUPER_STATE_EVENT")],
+    ),
+    StateSpec(
+        "SUPER_STATE_EVENT", prompt="ask_all_event.md",
+        judge="event.md", judge_memory=False, judge_in_reply=True, counter='event_message_count',
+        transitions=[
+            # The user wants to tell more about what happened
+            Transition("OPEN_ENDED_CONVERSATION", judged=True, min_messages=2, message_has=("نمیدونی", "تعریف کنم")),
+            Transition("ASK_EXERCISE", judged=True, min_messages=2),
+        ],
+    ),
+    StateSpec(
+        "OPEN_ENDED_CONVERSATION", prompt="open_ended_conversation.md",
+        transitions=[Transition("ASK_EXERCISE", min_history=4)],
+    ),
+    StateSpec(
+        "ASK_EXERCISE", prompt="ask_exercise.md", classifier="response", prefetch=True,
+        transitions=[Transition("EXERCISE_SUGGESTION", label="Yes"), Transition("THANKS")],
+    ),
+    StateSpec(
+        "EXERCISE_SUGGESTION", prompt="suggestion.md", reply=REPLY_SUGGESTION, classifier="response",
+        when_exhausted="THANKS",
+        transitions=[Transition("EXERCISE_EXPLANATION", label="Yes"), Transition("LIKE_ANOTHER_EXERCSISE")],
+    ),
+    StateSpec(
+        "EXERCISE_EXPLANATION", prompt="exercise_explanation.md", classifier="response",
+        transitions=[Transition("FEEDBACK", label="Yes"), Transition("LIKE_ANOTHER_EXERCSISE")],
+    ),
+    StateSpec(
+        "FEEDBACK", prompt="feedback.md",
+        transitions=[Transition("LIKE_ANOTHER_EXERCSISE")],
+    ),
+    StateSpec(
+        "LIKE_ANOTHER_EXERCSISE", prompt="like_to_do_another_exc.md", classifier="response", prefetch=True,
+        transitions=[Transition("EXERCISE_SUGGESTION", label="Yes"), Transition("THANKS")],
+    ),
+    # Closing states only look back at the conversation
+    StateSpec(
+        "THANKS", prompt="thanks.md", context=(MEMORY, HISTORY, REPETITION),
+        transitions=[Transition("END")],
+    ),
+    StateSpec(
+        "END", prompt="end.md", context=(MEMORY, HISTORY, REPETITION),
+    ),
+])
+
+
+def cost_table(states=None):
+    """{state: LLM calls of a turn in it}, for reviewing what each state costs"""
+    return {name: spec.llm_calls() for name, spec in (states or STATES).items()}
@@ -1,42 +1,36 @@
-import os
-from openai import OpenAI
-from dotenv import load_dotenv
+from api.bot.llm_client import chat_completion, achat_completion, stream_chat_completion
 
-load_dotenv(override=True)
 
-client = OpenAI(
-    api_key=os.getenv('OPENAI_API_KEY'),
-)
+def openai_req_generator(system_prompt, user_prompt=None, json_output=False, temperature=None, cache=False, hedge=False):
+    messages = [{"role": "system", "content": system_prompt}]
+    if user_prompt:
+        messages.append({"role": "user", "content": user_prompt})
+    return chat_completion(
+        messages,
+        temperature=temperature,
+        json_output=json_output,
+        cache=cache,
+        hedge=hedge,
+    )
+
+# New function for passing full message history
 
 
-def openai_req_generator(system_prompt, user_prompt=None, json_output=False, temperature=0.01):
+def openai_req_with_history(messages, temperature=None):
+    return chat_completion(messages, temperature=temperature)
+
+
+def openai_req_generator_stream(system_prompt, user_prompt=None, temperature=None):
+    """Like openai_req_generator, but yields the reply as it is generated"""
     messages = [{"role": "system", "content": system_prompt}]
     if user_prompt:
         messages.append({"role": "user", "content": user_prompt})
-    if json_output:
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model="gpt-4o",
-            # model="gpt-4o-mini",
-            response_format={"type": "json_object"},
-            temperature=temperature,
-        )
-    else:
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model="gpt-4o",
-            # model="chatgpt-4o-latest",
-            temperature=temperature,
-        )
-    return chat_completion.choices[0].message.content
+    return stream_chat_completion(messages, temperature=temperature)
 
-# New function for passing full message history
 
+def openai_req_with_history_stream(messages, temperature=None):
+    return stream_chat_completion(messages, temperature=temperature)
 
-def openai_req_with_history(messages, temperature=0.01):
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model="gpt-4o",
-        temperature=temperature,
-    )
-    return chat_completion.choices[0].message.content
+
+async def aopenai_req_with_history(messages, temperature=None):
+    return await achat_completion(messages, temperature=temperature)
@@ -8,7 +8,10 @@ from typing import Literal, TypedDict, Union
 
 from dotenv import load_dotenv
 from openai.lib._parsing import type_to_response_format_param
-from api.bot.gpt import client
+from api.bot.llm_client import chat_completion, get_client
+from api.bot.metrics import llm_call_site
+from api.bot import prompt_registry
+from api.bot.model_routing import resolve as resolve_route
 
 
 load_dotenv(override=True)
@@ -28,40 +31,45 @@ class LLM:
 
 
 class OpenAILLM(LLM):
-    def __init__(self, model: str = "gpt-4o-mini") -> None:
-        api_key = os.getenv('OPENAI_API_KEY'),
-        self.client = client
+    def __init__(self, model: str = None) -> None:
+        self.client = get_client()
         self.temperature = 0.01
+        # None lets settings.LLM_ROUTING pick the model per call site
         self.model = model
 
     def read_prompt(self, prompt_file: str) -> str:
-        with open(f'api/bot/Prompts/{prompt_file}', "r", encoding="utf-8") as file:
-            return file.read()
+        return prompt_registry.text(f'Prompts/{prompt_file}')
 
-    def chat(self, system_message: str, user_message: str) -> str:
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
+    def chat(self, system_message: str, user_message: str, cache: bool = False, hedge: bool = False) -> str:
+        return chat_completion(
+            [
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": user_message}
             ],
-            temperature=self.temperature
+            model=self.model,
+            temperature=self.temperature,
+            cache=cache,
+            hedge=hedge,
         )
-        return response.choices[0].message.content
 
     def chat_structured(self, messages: list[Message], response_format=BaseModel) -> BaseModel:
         response = self.client.beta.chat.completions.parse(
-            model=self.model,
+            model=self.model or resolve_route().model,
             messages=messages,
             response_format=response_format,
         )
         return response.choices[0].message.parsed
 
+    def retriever_system_message(self, prompt_file: str, chat_history: str) -> str:
+        return "Chat History:" + chat_history + "\n\n" + self.read_prompt(prompt_file)
+
+    @llm_call_site("emotion_retriever")
     def emotion_retriever(self, user_message: str, chat_history: str) -> str:
-        return self.chat(system_message="Chat History:" + chat_history + "\n\n" + self.read_prompt("emotion_retriever.md"), user_message=user_message)
+        return self.chat(system_message=self.retriever_system_message("emotion_retriever.md", chat_history), user_message=user_message, cache=True, hedge=True)
 
+    @llm_call_site("response_retriever")
     def response_retriever(self, user_message: str, chat_history: str) -> str:
-        return self.chat(system_message="Chat History:" + chat_history + "\n\n" + self.read_prompt("response_retriever.md"), user_message=user_message)
+        return self.chat(system_message=self.retriever_system_message("response_retriever.md", chat_history), user_message=user_message, cache=True, hedge=True)
 
 
 class OpenAIBatchILLM(LLM):
@@ -1,18 +1,36 @@
+import os
+
+from api.bot import prompt_registry
 from api.bot.gpt import openai_req_generator
+from api.bot.cache import LRUCache, MISSING, hash_text
+from api.bot.metrics import llm_call_site
+
+# The judge is asked the same question twice per turn (execute_state and
+# state_handler) and again when a client retries, so remember recent verdicts.
+judge_cache = LRUCache(
+    maxsize=int(os.getenv('JUDGE_CACHE_SIZE', '1024')),
+    ttl=float(os.getenv('JUDGE_CACHE_TTL', '600')),
+)
 
+
+@llm_call_site("judge")
 def if_data_sufficient_for_state_change(prompt_path, responses):
-    with open("debug2.md", "w", encoding="utf-8") as file:
-        file.write(f"Responses: {responses}")
-    
-    with open("api/bot/Information_prompts/Judge_prompt.md", "r", encoding="utf-8") as file:
-        judge_prompt = file.read()
-
-    with open(f"api/bot/Information_prompts/{prompt_path}", "r", encoding="utf-8") as file:
-        prompt = file.read()
-    
-    return openai_req_generator(judge_prompt
-                         + "\n---------------------\n"
-                         + f"اطلاعات استخراج شده مورد نیاز:\n{prompt}\n"
-                         + "-------------------\n"
-                         + f"تاریخچه گفتگو:\n{responses}", "")
-                        
+    cache_key = (prompt_path, hash_text(responses))
+    verdict = judge_cache.get(cache_key)
+    if verdict is not MISSING:
+        return verdict
+
+    verdict = openai_req_generator(build_judge_prompt(prompt_path, responses), "", cache=True, hedge=True)
+    judge_cache.set(cache_key, verdict)
+    return verdict
+
+
+def build_judge_prompt(prompt_path, responses):
+    judge_prompt = prompt_registry.text("Information_prompts/Judge_prompt.md")
+    prompt = prompt_registry.text(f"Information_prompts/{prompt_path}")
+
+    return (judge_prompt
+            + "\n---------------------\n"
+            + f"اطلاعات استخراج شده مورد نیاز:\n{prompt}\n"
+            + "-------------------\n"
+            + f"تاریخچه گفتگو:\n{responses}")
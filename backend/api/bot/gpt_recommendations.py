@@ -1,8 +1,10 @@
 
 
 from api.bot.gpt import openai_req_generator
+from api.bot.metrics import llm_call_site
 
 
+@llm_call_site("recommendations")
 def create_recommendations(bot_message, memory):
     # Debug
     return ["", "", ""]
@@ -0,0 +1,276 @@
+import os
+import asyncio
+import threading
+import weakref
+import importlib.util
+from pathlib import Path
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from dotenv import load_dotenv
+
+from api.bot import metrics, model_routing
+from api.bot.resilience import (
+    ATTEMPT_TIMEOUT, CLASSIFIER_ATTEMPT_TIMEOUT, call_with_resilience, acall_with_resilience,
+)
+from api.bot.cache import MISSING, ResponseCache, response_cache_key
+
+load_dotenv(override=True)
+
+# Connection pool / timeout tuning. A single intervention turn makes several
+# sequential calls, so keeping connections warm avoids repeated TLS handshakes.
+CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', '60'))
+WRITE_TIMEOUT = float(os.getenv('LLM_WRITE_TIMEOUT', '30'))
+POOL_TIMEOUT = float(os.getenv('LLM_POOL_TIMEOUT', '5'))
+MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '100'))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('LLM_MAX_KEEPALIVE_CONNECTIONS', '20'))
+KEEPALIVE_EXPIRY = float(os.getenv('LLM_KEEPALIVE_EXPIRY', '120'))
+# Audio uploads are larger and Whisper is slower than a chat completion
+TRANSCRIPTION_READ_TIMEOUT = float(os.getenv('LLM_TRANSCRIPTION_READ_TIMEOUT', '120'))
+
+# Persistent cache for deterministic classifier calls (opt-in per call site)
+RESPONSE_CACHE_ENABLED = os.getenv('LLM_RESPONSE_CACHE_ENABLED', '1') == '1'
+RESPONSE_CACHE_PATH = os.getenv(
+    'LLM_RESPONSE_CACHE_PATH', str(Path(__file__).resolve().parents[2] / 'llm_cache.sqlite3')
+)
+RESPONSE_CACHE_MEMORY_SIZE = int(os.getenv('LLM_RESPONSE_CACHE_MEMORY_SIZE', '2048'))
+RESPONSE_CACHE_MAX_ROWS = int(os.getenv('LLM_RESPONSE_CACHE_MAX_ROWS', '50000'))
+
+_client = None
+_client_lock = threading.Lock()
+# httpx async pools are bound to the event loop that opened them
+_async_clients = weakref.WeakKeyDictionary()
+_response_cache = None
+
+
+def http2_available():
+    """HTTP/2 needs the optional `h2` package; fall back to HTTP/1.1 without it."""
+    return importlib.util.find_spec("h2") is not None
+
+
+def build_timeout(read=READ_TIMEOUT):
+    return httpx.Timeout(connect=CONNECT_TIMEOUT, read=read, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT)
+
+
+def build_limits():
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def build_http_client():
+    """Create the pooled keep-alive HTTP client shared by every LLM call."""
+    return httpx.Client(http2=http2_available(), timeout=build_timeout(), limits=build_limits())
+
+
+def build_async_http_client():
+    return httpx.AsyncClient(http2=http2_available(), timeout=build_timeout(), limits=build_limits())
+
+
+def get_client():
+    """Return the process-wide OpenAI client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=os.getenv('OPENAI_API_KEY'),
+                    http_client=build_http_client(),
+                    timeout=build_timeout(),
+                    # Retries are budget-aware and live in api.bot.resilience
+                    max_retries=0,
+                )
+    return _client
+
+
+def get_async_client():
+    """Return the AsyncOpenAI client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            http_client=build_async_http_client(),
+            timeout=build_timeout(),
+            max_retries=0,
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def get_response_cache():
+    """Return the process-wide classifier response cache, or None when disabled."""
+    global _response_cache
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    if _response_cache is None:
+        with _client_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(
+                    RESPONSE_CACHE_PATH,
+                    memory_size=RESPONSE_CACHE_MEMORY_SIZE,
+                    max_rows=RESPONSE_CACHE_MAX_ROWS,
+                )
+    return _response_cache
+
+
+# Temperature of a call that names none and whose route sets none
+DEFAULT_TEMPERATURE = 0.01
+
+
+def _chat_params(messages, model, temperature, json_output):
+    """
+    Request parameters. Model, temperature and max_tokens come from the routing
+    table for the call site in flight. A model or temperature the caller passes
+    explicitly wins over the route; a temperature neither sets is DEFAULT_TEMPERATURE.
+    """
+    route = model_routing.resolve()
+    if temperature is None:
+        temperature = DEFAULT_TEMPERATURE if route.temperature is None else route.temperature
+    params = {
+        "messages": messages,
+        "model": model or route.model,
+        "temperature": temperature,
+    }
+    if route.max_tokens:
+        params["max_tokens"] = route.max_tokens
+    if json_output:
+        params["response_format"] = {"type": "json_object"}
+    return params
+
+
+def _attempt_cap(hedge):
+    return CLASSIFIER_ATTEMPT_TIMEOUT if hedge else ATTEMPT_TIMEOUT
+
+
+def chat_completion(messages, model=None, temperature=None, json_output=False, cache=False, hedge=False):
+    """
+    Run a chat completion through the shared client and return the message text.
+    Pass cache=True only from call sites whose output is a deterministic function
+    of the prompt (low-temperature classifiers); replies are never cached.
+    hedge=True marks a short classifier call: it gets the tighter attempt timeout
+    and a duplicate request when the first is slow. Provider failures that
+    outlast retries and the request budget raise LLMUnavailable.
+    """
+    params = _chat_params(messages, model, temperature, json_output)
+    recorder = metrics.CallRecorder(params["model"])
+    response_cache = get_response_cache() if cache else None
+    if response_cache is not None:
+        cache_key = response_cache_key(params["model"], params["temperature"], messages, json_output)
+        cached = response_cache.get(cache_key)
+        if cached is not MISSING:
+            recorder.finish("cached")
+            return cached
+
+    client = get_client()
+
+    def attempt(timeout):
+        return client.chat.completions.create(timeout=build_timeout(read=timeout), **params)
+
+    try:
+        completion = call_with_resilience(attempt, cap=_attempt_cap(hedge), hedge=hedge)
+    except Exception:
+        recorder.finish("error")
+        raise
+    recorder.finish(usage=completion.usage)
+    content = completion.choices[0].message.content
+
+    if response_cache is not None and content is not None:
+        response_cache.set(cache_key, content)
+    return content
+
+
+def stream_chat_completion(messages, model=None, temperature=None):
+    """
+    Stream a chat completion through the shared client, yielding content deltas.
+    Opening the stream is retried like chat_completion; once tokens flow a
+    failure is passed to the caller, since part of the reply is already out.
+    """
+    # Labels and route are resolved now, not when the caller starts iterating
+    params = _chat_params(messages, model, temperature, json_output=False)
+    recorder = metrics.CallRecorder(params["model"])
+    return _stream_deltas(recorder, params)
+
+
+def _stream_deltas(recorder, params):
+    usage = None
+    outcome = "error"
+    client = get_client()
+
+    def attempt(timeout):
+        return client.chat.completions.create(
+            stream=True, stream_options={"include_usage": True}, timeout=build_timeout(read=timeout), **params
+        )
+
+    try:
+        stream = call_with_resilience(attempt)
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            outcome = "ok"
+        finally:
+            stream.close()
+    finally:
+        recorder.finish(outcome, usage=usage)
+
+
+async def achat_completion(messages, model=None, temperature=None, json_output=False, hedge=False):
+    """Async counterpart of chat_completion; awaits the provider without holding a thread."""
+    params = _chat_params(messages, model, temperature, json_output)
+    recorder = metrics.CallRecorder(params["model"])
+    client = get_async_client()
+
+    def attempt(timeout):
+        return client.chat.completions.create(timeout=build_timeout(read=timeout), **params)
+
+    try:
+        completion = await acall_with_resilience(attempt, cap=_attempt_cap(hedge), hedge=hedge)
+    except Exception:
+        recorder.finish("error")
+        raise
+    recorder.finish(usage=completion.usage)
+    return completion.choices[0].message.content
+
+
+def transcribe(audio_path, model="whisper-1"):
+    """Transcribe an audio file through the shared client."""
+    client = get_client()
+
+    def attempt(timeout):
+        with open(audio_path, "rb") as audio_file:
+            return client.audio.transcriptions.create(
+                model=model,
+                file=audio_file,
+                timeout=build_timeout(read=timeout),
+            )
+
+    # Retries and breaker rejections are labelled with the call site too
+    with metrics.llm_call_site("whisper"):
+        recorder = metrics.CallRecorder(model)
+        try:
+            transcription = call_with_resilience(attempt, cap=TRANSCRIPTION_READ_TIMEOUT)
+        except Exception:
+            recorder.finish("error")
+            raise
+        recorder.finish()
+    return transcription.text
+
+
+@metrics.registry.register_collector
+def _response_cache_metrics():
+    if _response_cache is None:
+        return []
+    stats = _response_cache.stats()
+    lines = [
+        "# HELP llm_response_cache_lookups_total Classifier response cache lookups by result",
+        "# TYPE llm_response_cache_lookups_total counter",
+    ]
+    for result in ("memory_hits", "disk_hits", "misses"):
+        lines.append(f'llm_response_cache_lookups_total{{result="{result}"}} {stats[result]}')
+    return lines
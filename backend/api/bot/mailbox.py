@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from api.bot import metrics
+
+# Every user has a mailbox; their turns run one at a time. Messages that
+# arrive while a turn runs, or within the debounce window before it starts,
+# are merged into one turn and every waiting request gets its result. The
+# turn runs on the thread of one of the waiting requests (the leader), so
+# no extra threads or client polling are involved. If a streaming leader's
+# client goes away, the turn still finishes for the requests merged into it.
+# By default a turn starts at once; a debounce window trades that latency
+# for merging messages sent in quick succession.
+
+DEBOUNCE_SECONDS = float(os.getenv('MAILBOX_DEBOUNCE_SECONDS', '0'))
+MAX_DEBOUNCE_SECONDS = float(os.getenv('MAILBOX_MAX_DEBOUNCE_SECONDS', '2'))
+
+
+class _Entry:
+    def __init__(self, message, stream):
+        self.message = message
+        self.stream = stream
+        self.inbox = queue.Queue()  # ("token", text), ("done", result), ("error", exc) or ("lead", None)
+
+
+class _Mailbox:
+    def __init__(self):
+        self.pending = deque()
+        self.running = False
+        self.first_arrival = 0.0
+        self.last_arrival = 0.0
+
+
+class MailboxExecutor:
+    """
+    Serial per-user execution of `handler(message, user, stream)`, a
+    generator that yields ("token", text) events (when streaming) and
+    finally ("done", result). `merge(messages)` joins a batch into one message.
+    """
+
+    def __init__(self, handler, merge, debounce=None, max_debounce=None):
+        self.handler = handler
+        self.merge = merge
+        self.debounce = DEBOUNCE_SECONDS if debounce is None else debounce
+        self.max_debounce = MAX_DEBOUNCE_SECONDS if max_debounce is None else max_debounce
+        self.boxes = {}  # user_id -> _Mailbox while the user has pending or running turns
+        self.lock = threading.Lock()
+
+    def execute(self, user, message):
+        """Result of the turn that handles `message`"""
+        for event, data in self.run(user, message):
+            if event == "done":
+                return data
+
+    def run(self, user, message, stream=False):
+        """Yields ("token", text) events if `stream`, then ("done", result)"""
+        entry = _Entry(message, stream)
+        now = time.monotonic()
+        with self.lock:
+            box = self.boxes.setdefault(user.id, _Mailbox())
+            if not box.pending:
+                box.first_arrival = now
+            box.last_arrival = now
+            box.pending.append(entry)
+            lead = not box.running
+            box.running = True
+
+        while not lead:
+            event, data = entry.inbox.get()
+            if event == "lead":
+                break
+            if event == "error":
+                raise data
+            yield event, data
+            if event == "done":
+                return
+
+        yield from self._lead(user, box, entry)
+
+    def _wait_for_burst(self, box):
+        while True:
+            with self.lock:
+                deadline = min(box.last_arrival + self.debounce, box.first_arrival + self.max_debounce)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def _lead(self, user, box, me):
+        """Run one batch (which includes `me`), then hand the mailbox on"""
+        self._wait_for_burst(box)
+        with self.lock:
+            batch = list(box.pending)
+            box.pending.clear()
+        others = [entry for entry in batch if entry is not me]
+        if len(batch) > 1:
+            metrics.CHAT_MESSAGES_MERGED.inc(len(batch) - 1)
+            print(f"Merging {len(batch)} messages of user {user.id} into one turn")
+
+        outcome = ("error", RuntimeError("The turn was abandoned"))
+        events = self.handler(self.merge([entry.message for entry in batch]), user,
+                              any(entry.stream for entry in batch))
+        gone = False  # my client stopped reading; the turn goes on for the others
+        try:
+            for event, data in events:
+                if event == "done":
+                    outcome = ("done", data)
+                    continue
+                for entry in others:
+                    if entry.stream:
+                        entry.inbox.put((event, data))
+                if me.stream and not gone:
+                    try:
+                        yield event, data
+                    except GeneratorExit:
+                        if not others:
+                            raise
+                        gone = True
+        except Exception as e:
+            outcome = ("error", e)
+            raise
+        finally:
+            events.close()
+            for entry in others:
+                entry.inbox.put(outcome)
+            self._hand_on(user, box)
+        if gone:
+            return  # closed generators must not yield again
+        if outcome[0] == "error":
+            raise outcome[1]
+        yield outcome
+
+    def _hand_on(self, user, box):
+        with self.lock:
+            if box.pending:
+                box.pending[0].inbox.put(("lead", None))
+            else:
+                box.running = False
+                if self.boxes.get(user.id) is box:
+                    del self.boxes[user.id]
@@ -0,0 +1,369 @@
+import abc
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.db.models import Q
+from django.utils import timezone
+
+from api.bot.db import immediate_atomic
+from api.models import BufferedMessage, UserTurnLease
+
+try:
+    import redis
+except ImportError:  # optional: only needed for the redis backend
+    redis = None
+
+DEFAULT_LEASE_SECONDS = float(os.getenv('MESSAGE_BUFFER_LEASE_SECONDS', '30'))
+REDIS_KEY_PREFIX = os.getenv('MESSAGE_BUFFER_REDIS_PREFIX', 'sat:turn:')
+REDIS_BUFFER_TTL = int(os.getenv('MESSAGE_BUFFER_REDIS_TTL', '3600'))  # seconds an idle buffer is kept
+# Waiting for another worker's turn: the first retry comes quickly, later
+# ones back off so waiting workers do not hammer the lease store
+WAIT_INITIAL_DELAY = float(os.getenv('MESSAGE_BUFFER_WAIT_INITIAL_DELAY', '0.05'))
+WAIT_MAX_DELAY = float(os.getenv('MESSAGE_BUFFER_WAIT_MAX_DELAY', '1'))
+
+logger = logging.getLogger(__name__)
+
+
+class TurnLeaseLost(Exception):
+    """The lease of a running turn expired or was taken over, so its results must not be persisted"""
+
+    def __init__(self, user_id):
+        super().__init__(f"Lost the turn lease of user {user_id}")
+        self.user_id = user_id
+
+
+class TurnTimeout(Exception):
+    """The user's turn in another worker did not finish in time"""
+
+    def __init__(self, user_id, waited):
+        super().__init__(f"User {user_id} was still busy after {waited:g}s; the message waits for the next turn")
+        self.user_id = user_id
+        self.waited = waited
+
+
+class MessageBuffer:
+    """Handles buffering of rapid successive messages from users"""
+
+    def __init__(self):
+        self.processing_users = {}  # user_id -> processing status
+        self.message_buffers = {}   # user_id -> list of buffered messages
+        self.lock = threading.Lock()
+
+    def is_user_processing(self, user_id):
+        """Check if a user is currently being processed"""
+        with self.lock:
+            return user_id in self.processing_users and self.processing_users[user_id]
+
+    def try_start_processing(self, user_id):
+        """Mark that processing has started for a user, unless it already has; returns whether it did"""
+        with self.lock:
+            if self.processing_users.get(user_id):
+                return False
+            self.processing_users[user_id] = True
+            if user_id not in self.message_buffers:
+                self.message_buffers[user_id] = []
+            return True
+
+    def wait_to_start_processing(self, user_id, timeout):
+        """
+        try_start_processing, retried with jittered exponential backoff until
+        it succeeds; raises TurnTimeout after `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        delay = WAIT_INITIAL_DELAY
+        while not self.try_start_processing(user_id):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TurnTimeout(user_id, timeout)
+            # Jitter keeps workers waiting for the same user from retrying in step
+            time.sleep(min(remaining, delay * random.uniform(0.5, 1)))
+            delay = min(delay * 2, WAIT_MAX_DELAY)
+
+    def start_processing(self, user_id):
+        """Mark that processing has started for a user"""
+        with self.lock:
+            self.processing_users[user_id] = True
+            if user_id not in self.message_buffers:
+                self.message_buffers[user_id] = []
+
+    def end_processing(self, user_id):
+        """Mark that processing has ended for a user; messages buffered meanwhile wait for the next turn"""
+        with self.lock:
+            self.processing_users[user_id] = False
+
+    def lease_lost(self, user_id):
+        """Whether the user's running turn may no longer persist its results; never, within one process"""
+        return False
+
+    def add_message(self, user_id, message):
+        """Add a message to the buffer for a user"""
+        with self.lock:
+            if user_id not in self.message_buffers:
+                self.message_buffers[user_id] = []
+            self.message_buffers[user_id].append(message)
+
+    def get_buffered_messages(self, user_id):
+        """Get all buffered messages for a user and clear the buffer"""
+        with self.lock:
+            if user_id in self.message_buffers:
+                messages = self.message_buffers[user_id].copy()
+                self.message_buffers[user_id] = []
+                return messages
+            return []
+
+    def concatenate_messages(self, messages):
+        """Concatenate multiple messages into a single message"""
+        if not messages:
+            return ""
+        # Join messages with space, but handle cases where messages might already have punctuation
+        concatenated = " ".join(messages)
+        # Clean up any double spaces
+        concatenated = re.sub(r'\s+', ' ', concatenated).strip()
+        return concatenated
+
+    def has_buffered_messages(self, user_id):
+        """Check if there are any buffered messages for a user"""
+        with self.lock:
+            return user_id in self.message_buffers and len(self.message_buffers[user_id]) > 0
+
+    def clear_buffer(self, user_id):
+        """Drop a user's buffered messages"""
+        with self.lock:
+            self.message_buffers[user_id] = []
+
+
+class LeasedMessageBuffer(MessageBuffer, abc.ABC):
+    """
+    MessageBuffer shared by every worker. Processing a user is guarded by a
+    lease that expires unless its holder renews it, so a worker that dies
+    mid-turn cannot block the user for longer than `lease_seconds`. While a
+    turn runs, a heartbeat thread renews the leases this process holds; a
+    turn checks lease_lost() before it persists anything.
+    Subclasses store the leases and buffers.
+    """
+
+    def __init__(self, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.leases = {}  # user_id -> token of a lease this process holds
+        self.lock = threading.Lock()
+        self._heartbeat = None
+        self._stopped = threading.Event()
+
+    def _new_token(self):
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+    def try_start_processing(self, user_id):
+        token = self._new_token()
+        if not self._acquire(user_id, token):
+            return False
+        with self.lock:
+            self.leases[user_id] = token
+            if self._heartbeat is None:
+                self._stopped.clear()
+                self._heartbeat = threading.Thread(target=self._renew_leases, name="turn-lease-heartbeat", daemon=True)
+                self._heartbeat.start()
+        return True
+
+    def start_processing(self, user_id):
+        return self.try_start_processing(user_id)
+
+    def end_processing(self, user_id):
+        with self.lock:
+            token = self.leases.pop(user_id, None)
+        if token is not None:
+            self._release(user_id, token)
+
+    def lease_lost(self, user_id):
+        """
+        Whether the lease of the user's running turn expired or was taken by
+        another worker. Checked right before a turn persists its results; a
+        lease still held is renewed, so it cannot lapse in between.
+        """
+        with self.lock:
+            token = self.leases.get(user_id)
+        if token is None:
+            return True  # the heartbeat already found it lost
+        if self._renew(user_id, token):
+            return False
+        self._drop_lease(user_id, token)
+        return True
+
+    def _drop_lease(self, user_id, token):
+        logger.warning("Lost the turn lease of user %s", user_id)
+        with self.lock:
+            if self.leases.get(user_id) == token:
+                del self.leases[user_id]
+
+    def _renew_leases(self):
+        try:
+            while not self._stopped.wait(self.lease_seconds / 3):
+                with self.lock:
+                    held = list(self.leases.items())
+                    if not held:
+                        self._heartbeat = None
+                        return
+                for user_id, token in held:
+                    if not self._renew(user_id, token):
+                        self._drop_lease(user_id, token)
+        finally:
+            self._thread_done()
+
+    def _thread_done(self):
+        pass
+
+    def stop(self):
+        """Stop renewing; held leases then expire on their own"""
+        with self.lock:
+            self._stopped.set()
+            self._heartbeat = None
+
+    @abc.abstractmethod
+    def _acquire(self, user_id, token):
+        """Take the user's lease if it is free or expired; returns whether it did"""
+
+    @abc.abstractmethod
+    def _renew(self, user_id, token):
+        """Extend the lease if `token` still holds it; returns whether it does"""
+
+    @abc.abstractmethod
+    def _release(self, user_id, token):
+        """Free the lease if `token` still holds it"""
+
+
+class DatabaseMessageBuffer(LeasedMessageBuffer):
+    """Leases in UserTurnLease rows, buffered messages in BufferedMessage rows"""
+
+    def _expiry(self):
+        return timezone.now() + timedelta(seconds=self.lease_seconds)
+
+    def _acquire(self, user_id, token):
+        now = timezone.now()
+        # Take over a free or expired lease, or create the user's first one
+        taken = UserTurnLease.objects.filter(user_id=user_id).filter(Q(owner="") | Q(expires_at__lte=now)).update(
+            owner=token, expires_at=self._expiry())
+        if taken:
+            return True
+        if UserTurnLease.objects.filter(user_id=user_id).exists():
+            return False
+        try:
+            with immediate_atomic():
+                UserTurnLease.objects.create(user_id=user_id, owner=token, expires_at=self._expiry())
+        except IntegrityError:
+            return False
+        return True
+
+    def _renew(self, user_id, token):
+        return bool(UserTurnLease.objects.filter(user_id=user_id, owner=token).update(expires_at=self._expiry()))
+
+    def _release(self, user_id, token):
+        UserTurnLease.objects.filter(user_id=user_id, owner=token).update(owner="", expires_at=timezone.now())
+
+    def _thread_done(self):
+        connection.close()
+
+    def is_user_processing(self, user_id):
+        return UserTurnLease.objects.filter(user_id=user_id, expires_at__gt=timezone.now()).exclude(owner="").exists()
+
+    def add_message(self, user_id, message):
+        BufferedMessage.objects.create(user_id=user_id, text=message)
+
+    def get_buffered_messages(self, user_id):
+        with immediate_atomic():
+            rows = list(BufferedMessage.objects.select_for_update().filter(user_id=user_id)
+                        .order_by('id').values_list('id', 'text'))
+            BufferedMessage.objects.filter(id__in=[row_id for row_id, _ in rows]).delete()
+        return [text for _, text in rows]
+
+    def has_buffered_messages(self, user_id):
+        return BufferedMessage.objects.filter(user_id=user_id).exists()
+
+    def clear_buffer(self, user_id):
+        BufferedMessage.objects.filter(user_id=user_id).delete()
+
+
+class RedisMessageBuffer(LeasedMessageBuffer):
+    """Leases as expiring keys and buffers as lists on a Redis-compatible server"""
+
+    # Extend or delete the lease only if this process still holds it
+    RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, url=None, client=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+        super().__init__(lease_seconds)
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis message buffer needs the redis package")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.renew_script = client.register_script(self.RENEW_SCRIPT)
+        self.release_script = client.register_script(self.RELEASE_SCRIPT)
+
+    def _lease_key(self, user_id):
+        return f"{REDIS_KEY_PREFIX}lease:{user_id}"
+
+    def _buffer_key(self, user_id):
+        return f"{REDIS_KEY_PREFIX}buffer:{user_id}"
+
+    def _acquire(self, user_id, token):
+        return bool(self.client.set(self._lease_key(user_id), token, nx=True, px=int(self.lease_seconds * 1000)))
+
+    def _renew(self, user_id, token):
+        return bool(self.renew_script(keys=[self._lease_key(user_id)], args=[token, int(self.lease_seconds * 1000)]))
+
+    def _release(self, user_id, token):
+        self.release_script(keys=[self._lease_key(user_id)], args=[token])
+
+    def is_user_processing(self, user_id):
+        return bool(self.client.exists(self._lease_key(user_id)))
+
+    def add_message(self, user_id, message):
+        pipeline = self.client.pipeline()
+        pipeline.rpush(self._buffer_key(user_id), message)
+        pipeline.expire(self._buffer_key(user_id), REDIS_BUFFER_TTL)
+        pipeline.execute()
+
+    def get_buffered_messages(self, user_id):
+        pipeline = self.client.pipeline()
+        pipeline.lrange(self._buffer_key(user_id), 0, -1)
+        pipeline.delete(self._buffer_key(user_id))
+        messages, _ = pipeline.execute()
+        return [message.decode('utf-8') if isinstance(message, bytes) else message for message in messages]
+
+    def has_buffered_messages(self, user_id):
+        return self.client.llen(self._buffer_key(user_id)) > 0
+
+    def clear_buffer(self, user_id):
+        self.client.delete(self._buffer_key(user_id))
+
+
+def get_message_buffer():
+    """The buffer named by settings.MESSAGE_BUFFER_BACKEND ("database", "redis" or "memory")"""
+    backend = getattr(settings, 'MESSAGE_BUFFER_BACKEND', 'memory')
+    lease_seconds = getattr(settings, 'MESSAGE_BUFFER_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+    if backend == 'memory':
+        return MessageBuffer()
+    if backend == 'redis':
+        return RedisMessageBuffer(getattr(settings, 'MESSAGE_BUFFER_REDIS_URL', 'redis://localhost:6379/0'),
+                                  lease_seconds=lease_seconds)
+    if backend == 'database':
+        return DatabaseMessageBuffer(lease_seconds)
+    raise ValueError(f"Unknown message buffer backend: {backend}")
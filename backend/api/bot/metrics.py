@@ -0,0 +1,290 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Labels of the LLM call in flight. Context variables follow the call into
+# CallPlan workers (the planner copies the context) and are reset when a
+# request finishes, so a reused WSGI thread never reports a stale label.
+CALL_SITE = contextvars.ContextVar('llm_call_site', default='unknown')
+FSM_STATE = contextvars.ContextVar('llm_fsm_state', default='-')
+QUEUE_SECONDS = contextvars.ContextVar('llm_queue_seconds', default=0.0)
+SPEND = contextvars.ContextVar('llm_spend', default=None)  # SpendMeter of speculative work, if any
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+QUEUE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+PROMPT_TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+COMPLETION_TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+RATIO_BUCKETS = (0, 0.1, 0.25, 0.5, 0.75, 0.9, 1)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.labelnames = tuple(labelnames)
+        self.series = {}  # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def quantile(self, q, min_count=1, **labels):
+        """
+        Estimated q-quantile of the observations whose labels include `labels`,
+        interpolated within its bucket; None with fewer than min_count of them.
+        """
+        with self.lock:
+            matching = [
+                series for key, series in self.series.items()
+                if all(dict(zip(self.labelnames, key)).get(name) == value for name, value in labels.items())
+            ]
+            counts = [sum(series[i] for series in matching) for i in range(len(self.buckets))]
+        total = counts[-1] if matching else 0
+        if total < max(min_count, 1):
+            return None
+        rank = q * total
+        lower, below = 0.0, 0
+        for bound, count in zip(self.buckets, counts):
+            if count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+            lower, below = bound, count
+        return lower
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    labels = _format_labels(self.labelnames, key, ("le", _format_bound(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {series[-2]}")
+                lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """collector() returns extra exposition lines computed at scrape time"""
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+LLM_CALL_SECONDS = registry.register(Histogram(
+    'llm_call_duration_seconds', 'Wall time of an LLM provider call',
+    DURATION_BUCKETS, ('call_site', 'model', 'state', 'outcome'),
+))
+LLM_QUEUE_SECONDS = registry.register(Histogram(
+    'llm_call_queue_seconds', 'Time an LLM call waited for a planner worker before starting',
+    QUEUE_BUCKETS, ('call_site',),
+))
+LLM_PROMPT_TOKENS = registry.register(Histogram(
+    'llm_prompt_tokens', 'Prompt tokens per LLM call',
+    PROMPT_TOKEN_BUCKETS, ('call_site', 'model'),
+))
+LLM_COMPLETION_TOKENS = registry.register(Histogram(
+    'llm_completion_tokens', 'Completion tokens per LLM call',
+    COMPLETION_TOKEN_BUCKETS, ('call_site', 'model'),
+))
+LLM_CACHED_PROMPT_RATIO = registry.register(Histogram(
+    'llm_cached_prompt_ratio', 'Share of prompt tokens served from the provider prompt cache per LLM call',
+    RATIO_BUCKETS, ('call_site', 'model'),
+))
+LLM_CACHED_PROMPT_TOKENS = registry.register(Counter(
+    'llm_cached_prompt_tokens_total', 'Prompt tokens served from the provider prompt cache',
+    ('call_site', 'model'),
+))
+LLM_CONTEXT_TOKENS = registry.register(Histogram(
+    'llm_context_tokens', 'Tokens of an assembled system prompt (rules, memory and history)',
+    PROMPT_TOKEN_BUCKETS, ('state',),
+))
+LLM_CONTEXT_DROPPED = registry.register(Counter(
+    'llm_context_dropped_total', 'Conversation turns and memory tokens left out to stay within the context budget',
+    ('state', 'part'),
+))
+LLM_REPETITION_BLOCK_TOKENS = registry.register(Histogram(
+    'llm_repetition_block_tokens', 'Tokens of the per-user repetition-prevention prompt section',
+    COMPLETION_TOKEN_BUCKETS, ('state',),
+))
+
+LLM_RETRIES = registry.register(Counter(
+    'llm_retries_total', 'LLM call attempts retried after a transient failure',
+    ('call_site', 'reason'),
+))
+LLM_HEDGES = registry.register(Counter(
+    'llm_hedged_requests_total', 'Duplicate classifier requests sent because the first was slow',
+    ('call_site', 'winner'),
+))
+LLM_HEDGES_OVER_BUDGET = registry.register(Counter(
+    'llm_hedges_over_budget_total', 'Slow classifier requests not hedged because the hedge budget was spent',
+    ('call_site',),
+))
+LLM_CIRCUIT_OPENS = registry.register(Counter(
+    'llm_circuit_breaker_opens_total', 'Times the provider circuit breaker opened',
+))
+LLM_FAST_FAILURES = registry.register(Counter(
+    'llm_fast_failures_total', 'LLM calls refused without reaching the provider',
+    ('call_site', 'reason'),
+))
+
+SUMMARY_JOBS = registry.register(Counter(
+    'memory_summary_jobs_total', 'Background memory summarization jobs by outcome (done, coalesced, failed, stale)',
+    ('outcome',),
+))
+LLM_PREFETCHES = registry.register(Counter(
+    'llm_prefetch_total',
+    'Speculative LLM work by outcome (started, hit, miss, stale, unused, failed; '
+    'a hit whose work raised after it was taken is also counted as failed)',
+    ('name', 'outcome'),
+))
+LLM_PREFETCH_WASTED_TOKENS = registry.register(Counter(
+    'llm_prefetch_wasted_tokens_total', 'Tokens spent on speculative LLM work whose result was thrown away',
+    ('name', 'kind'),
+))
+CHAT_MESSAGES_MERGED = registry.register(Counter(
+    'chat_messages_merged_total', 'User messages answered by a turn started for an earlier message',
+))
+
+
+@contextmanager
+def llm_call_site(name):
+    """Label every LLM call made inside the block (usable as a decorator)"""
+    token = CALL_SITE.set(name)
+    try:
+        yield
+    finally:
+        CALL_SITE.reset(token)
+
+
+def set_fsm_state(state):
+    FSM_STATE.set(state or '-')
+
+
+class SpendMeter:
+    """Adds up the tokens of the LLM calls started while it is the current SPEND"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.lock = threading.Lock()
+
+    def add(self, prompt_tokens, completion_tokens):
+        with self.lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+
+def current_labels():
+    return {'call_site': CALL_SITE.get(), 'state': FSM_STATE.get()}
+
+
+class CallRecorder:
+    """
+    Times one provider call. Labels are captured when the recorder is
+    created, so streamed calls keep the labels of the code that started them.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.labels = current_labels()
+        self.queue_seconds = QUEUE_SECONDS.get()
+        self.spend = SPEND.get()
+        self.started = time.perf_counter()
+
+    def finish(self, outcome="ok", usage=None):
+        call_site = self.labels['call_site']
+        LLM_CALL_SECONDS.observe(
+            time.perf_counter() - self.started,
+            call_site=call_site, model=self.model, state=self.labels['state'], outcome=outcome,
+        )
+        if outcome == "cached":
+            return
+        LLM_QUEUE_SECONDS.observe(self.queue_seconds, call_site=call_site)
+        prompt_tokens = getattr(usage, 'prompt_tokens', None)
+        completion_tokens = getattr(usage, 'completion_tokens', None)
+        if isinstance(prompt_tokens, int):
+            LLM_PROMPT_TOKENS.observe(prompt_tokens, call_site=call_site, model=self.model)
+            cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None)
+            if isinstance(cached_tokens, int) and prompt_tokens > 0:
+                LLM_CACHED_PROMPT_RATIO.observe(cached_tokens / prompt_tokens, call_site=call_site, model=self.model)
+                LLM_CACHED_PROMPT_TOKENS.inc(cached_tokens, call_site=call_site, model=self.model)
+        if isinstance(completion_tokens, int):
+            LLM_COMPLETION_TOKENS.observe(completion_tokens, call_site=call_site, model=self.model)
+        if self.spend is not None:
+            self.spend.add(prompt_tokens if isinstance(prompt_tokens, int) else 0,
+                           completion_tokens if isinstance(completion_tokens, int) else 0)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,50 @@
+from collections import namedtuple
+
+from django.conf import settings
+
+from api.bot import metrics
+
+Route = namedtuple('Route', ['model', 'temperature', 'max_tokens'])
+
+DEFAULT_TIERS = {'large': 'gpt-4o', 'small': 'gpt-4o-mini'}
+DEFAULT_ROUTING = {'default': {'tier': 'large'}}
+
+
+def tiers():
+    return getattr(settings, 'LLM_MODEL_TIERS', DEFAULT_TIERS)
+
+
+def tier_model(tier):
+    return tiers()[tier]
+
+
+def _route_keys(call_site, state):
+    """Routing keys from most general to most specific"""
+    base = call_site.split(':', 1)[0]
+    keys = ['default', base, call_site]
+    if state and state != '-':
+        keys += [f'{base}@{state}', f'{call_site}@{state}']
+    seen = []
+    for key in keys:
+        if key not in seen:
+            seen.append(key)
+    return seen
+
+
+def resolve(call_site=None, state=None):
+    """
+    Route for an LLM call, from settings.LLM_ROUTING. Entries are merged from
+    "default" through the call site to "<call site>@<FSM state>", so a state
+    entry only needs the fields it changes. Defaults to the labels of the
+    call in flight (see api.bot.metrics).
+    """
+    call_site = call_site or metrics.CALL_SITE.get()
+    state = state or metrics.FSM_STATE.get()
+    table = getattr(settings, 'LLM_ROUTING', DEFAULT_ROUTING)
+
+    entry = {}
+    for key in _route_keys(call_site, state):
+        entry.update(table.get(key, {}))
+
+    model = entry.get('model') or tier_model(entry.get('tier', 'large'))
+    return Route(model, entry.get('temperature'), entry.get('max_tokens'))
@@ -1,9 +1,19 @@
-from api.bot.gpt import openai_req_with_history
+from api.bot.gpt import openai_req_with_history, aopenai_req_with_history, openai_req_with_history_stream
 from api.bot.gpt_recommendations import create_recommendations
+from api.bot.metrics import llm_call_site
 
 PLACEBO_SYSTEM_PROMPT = """تو دستیار روان‌درمانی به خود هستی که وظیفه‌ات کمک به بهتر شدن حال روحی کاربر است."""
 
 
+def build_placebo_messages(history, user_message):
+    messages = [{"role": "system", "content": PLACEBO_SYSTEM_PROMPT}]
+
+    if history:
+        messages.extend(history[-6:])
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
 def placebo_bot_response(history, user_message, user):
     """
     Placebo bot with minimal functionality - just a simple chatbot with basic prompt.
@@ -14,13 +24,34 @@ def placebo_bot_response(history, user_message, user):
     """
     print(f"Placebo Bot History: {history}")
 
-    messages = [{"role": "system", "content": PLACEBO_SYSTEM_PROMPT}]
+    messages = build_placebo_messages(history, user_message)
 
-    if history:
-        messages.extend(history[-6:])
-    messages.append({"role": "user", "content": user_message})
+    with llm_call_site("placebo_bot"):
+        response = openai_req_with_history(messages, temperature=0.4)
+
+    updated_history = (history or []) + [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": response}
+    ]
+
+    recommendations = create_recommendations(response, memory="")
+
+    return response, recommendations, updated_history
+
+
+def stream_placebo_bot_response(history, user_message, user):
+    """Streaming variant of placebo_bot_response; returns an iterator of reply chunks."""
+    messages = build_placebo_messages(history, user_message)
+    with llm_call_site("placebo_bot"):
+        return openai_req_with_history_stream(messages, temperature=0.4)
+
+
+async def aplacebo_bot_response(history, user_message, user):
+    """Async variant of placebo_bot_response for the ASGI message path."""
+    messages = build_placebo_messages(history, user_message)
 
-    response = openai_req_with_history(messages, temperature=0.4)
+    with llm_call_site("placebo_bot"):
+        response = await aopenai_req_with_history(messages, temperature=0.4)
 
     updated_history = (history or []) + [
         {"role": "user", "content": user_message},
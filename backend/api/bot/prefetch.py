@@ -0,0 +1,123 @@
+import json
+import threading
+from collections import OrderedDict
+
+from api.bot import metrics
+from api.bot.cache import hash_text
+
+# Speculative LLM work: started when a user is likely to need its result
+# (e.g. entering ASK_EXERCISE makes an exercise suggestion likely) and kept
+# with a fingerprint of its inputs. The result is used only if the inputs
+# are unchanged when it is needed; otherwise it is thrown away and its
+# tokens are counted as wasted. Work that raises, before or after it is
+# taken, is counted as failed and the caller recomputes it inline. Results live in the worker that started
+# them, so a turn handled by another worker is a miss.
+
+MAX_PENDING = 1000
+
+
+def fingerprint(*inputs):
+    """Stable digest of JSON-serializable inputs"""
+    return hash_text(json.dumps(inputs, ensure_ascii=False, sort_keys=True, default=sorted))
+
+
+class Speculation:
+    def __init__(self, fingerprint, futures, spend):
+        self.fingerprint = fingerprint
+        self.futures = futures  # {name: Future}
+        self.spend = spend
+        self.failed = False
+
+
+class Prefetcher:
+    """Pending speculative results of one kind, at most one per user"""
+
+    def __init__(self, name, maxsize=MAX_PENDING):
+        self.name = name
+        self.maxsize = maxsize
+        self.pending = OrderedDict()  # user_id -> Speculation
+        self.lock = threading.Lock()
+
+    def start(self, user_id, inputs_fingerprint, launch):
+        """
+        Run `launch()`, which starts the work and returns {name: Future}, with
+        its LLM spend metered. Work already running for the same inputs is kept.
+        """
+        with self.lock:
+            current = self.pending.get(user_id)
+            if current is not None and current.fingerprint == inputs_fingerprint:
+                return
+        spend = metrics.SpendMeter()
+        token = metrics.SPEND.set(spend)
+        try:
+            futures = launch()
+        finally:
+            metrics.SPEND.reset(token)
+        metrics.LLM_PREFETCHES.inc(name=self.name, outcome="started")
+
+        evicted = []
+        with self.lock:
+            replaced = self.pending.pop(user_id, None)
+            self.pending[user_id] = Speculation(inputs_fingerprint, futures, spend)
+            while len(self.pending) > self.maxsize:
+                evicted.append(self.pending.popitem(last=False)[1])
+        if replaced is not None:
+            self._waste(replaced, "stale")
+        for speculation in evicted:
+            self._waste(speculation, "unused")
+
+    def take(self, user_id, inputs_fingerprint):
+        """
+        The Speculation started for these inputs, or None if there is none to
+        use. Its futures may still be running; if one of them raises later,
+        report it with failed() and recompute.
+        """
+        with self.lock:
+            speculation = self.pending.pop(user_id, None)
+        if speculation is None:
+            metrics.LLM_PREFETCHES.inc(name=self.name, outcome="miss")
+            return None
+        if speculation.fingerprint != inputs_fingerprint:
+            self._waste(speculation, "stale")
+            return None
+        if any(future.done() and future.exception() is not None for future in speculation.futures.values()):
+            # A failed guess should not fail the turn; the caller recomputes
+            self.failed(speculation)
+            return None
+        metrics.LLM_PREFETCHES.inc(name=self.name, outcome="hit")
+        return speculation
+
+    def failed(self, speculation, error=None):
+        """Count a taken or pending guess whose work raised as wasted, once"""
+        with self.lock:
+            if speculation.failed:
+                return
+            speculation.failed = True
+        if error is not None:
+            print(f"Prefetched {self.name} failed, recomputing: {error}")
+        self._waste(speculation, "failed")
+
+    def discard(self, user_id):
+        """Drop the user's pending result, e.g. when they leave the state it was for"""
+        with self.lock:
+            speculation = self.pending.pop(user_id, None)
+        if speculation is not None:
+            self._waste(speculation, "unused")
+
+    def _waste(self, speculation, outcome):
+        metrics.LLM_PREFETCHES.inc(name=self.name, outcome=outcome)
+        remaining = [len(speculation.futures)]
+        lock = threading.Lock()
+
+        # Running work still spends tokens; count them once it is all done
+        def finished(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            spend = speculation.spend
+            metrics.LLM_PREFETCH_WASTED_TOKENS.inc(spend.prompt_tokens, name=self.name, kind="prompt")
+            metrics.LLM_PREFETCH_WASTED_TOKENS.inc(spend.completion_tokens, name=self.name, kind="completion")
+
+        for future in speculation.futures.values():
+            future.add_done_callback(finished)
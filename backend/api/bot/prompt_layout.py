@@ -0,0 +1,88 @@
+import threading
+import weakref
+
+from api.bot.prompt_registry import PromptTemplate
+
+# Providers cache the longest previously seen prompt prefix (OpenAI from
+# 1024 tokens on), so system prompts are laid out as a static prefix -- the
+# state's rules, the SAT knowledge base, fixed guidance -- followed by a
+# volatile suffix with everything that differs per user or per turn.
+# Volatile placeholders inside a template are replaced by a pointer to the
+# section at the end of the prompt that carries their value.
+
+SAT_KNOWLEDGE_TITLE = "📚 دانش پایه تکنیک دلبستگی به خود (SAT)"
+
+# Volatile value -> title of the suffix section that carries it
+SECTION_TITLES = {
+    'knowledge': "📚 بخش‌های مرتبط دانش پایه SAT",
+    'memory': "اطلاعات کاربر و تاریخچه مکالمه",
+    'exc': "تمرین انتخاب شده",
+    'daily_exercises': "تمرین‌های امروز",
+    'transition_awareness': "🔍 وضعیت انتقال فعلی",
+    'repetition': "⚠️ هشدار مهم - جلوگیری از تکرار در کل مکالمه",
+}
+
+_prefixes = weakref.WeakKeyDictionary()  # PromptTemplate -> {layout key: rendered template}
+_prefixes_lock = threading.Lock()
+
+
+def section_reference(name):
+    return f"(در بخش «{SECTION_TITLES.get(name, name)}» در انتهای همین پیام آمده است)"
+
+
+def _render_template(template, static, referenced, blank):
+    key = (frozenset(static.items()), frozenset(referenced), frozenset(blank))
+    with _prefixes_lock:
+        cached = _prefixes.setdefault(template, {}).get(key)
+    if cached is not None:
+        return cached
+
+    values = dict(static)
+    values.update({name: section_reference(name) for name in referenced})
+    values.update({name: "" for name in blank})
+    rendered = template.render(**values)
+    with _prefixes_lock:
+        _prefixes[template][key] = rendered
+    return rendered
+
+
+def static_prefix(template, volatile_fields=(), static=None, knowledge=None, guidance=None):
+    """
+    The cacheable part of a system prompt. `static` holds placeholder values
+    shared by many users (e.g. the program day), `volatile_fields` the
+    placeholders whose values go to the suffix.
+    """
+    if isinstance(template, str):
+        template = PromptTemplate(template)
+    static = static or {}
+    referenced = [name for name in volatile_fields if name in template.fields]
+    blank = [name for name in template.fields if name not in static and name not in referenced
+             and name in SECTION_TITLES]
+    prefix = _render_template(template, static, referenced, blank)
+    if knowledge:
+        prefix += f"\n\n### {SAT_KNOWLEDGE_TITLE}:\n{knowledge}\n"
+    if guidance:
+        prefix += f"\n\n{guidance}"
+    return prefix
+
+
+def volatile_suffix(volatile):
+    """Per-user/per-turn sections, in the order given"""
+    return "".join(
+        f"\n\n### {SECTION_TITLES.get(name, name)}:\n{value}"
+        for name, value in volatile.items()
+        if value is not None
+    )
+
+
+def build_system_prompt(template, volatile=None, static=None, knowledge=None, guidance=None):
+    """
+    Lay a state prompt out for provider prefix caching: the template with
+    `static` values filled in, the SAT knowledge base and `guidance` first,
+    then one section per non-None `volatile` value. Volatile placeholders
+    that have no value are left empty.
+    """
+    volatile = volatile or {}
+    present = [name for name, value in volatile.items() if value is not None]
+    return (static_prefix(template, present, static, knowledge, guidance)
+            + volatile_suffix(volatile))
@@ -0,0 +1,141 @@
+import os
+import string
+import threading
+import time
+from pathlib import Path
+
+# Everything is resolved from this file's location, so the server does not
+# depend on being started from backend/.
+BOT_DIR = Path(__file__).resolve().parent
+
+PROMPT_PATTERNS = ('Prompts/*.md', 'Information_prompts/*.md', 'RAG/*.md', 'RAG/Exercises/*.txt')
+# Seconds between mtime checks; 0 checks on every lookup, a negative value never reloads
+RELOAD_INTERVAL = float(os.getenv('PROMPT_RELOAD_INTERVAL', '2'))
+
+_formatter = string.Formatter()
+
+
+def bot_path(*parts):
+    """Absolute path of a file under api/bot/"""
+    return BOT_DIR.joinpath(*parts)
+
+
+class PromptTemplate:
+    """
+    A prompt file split once into literal and placeholder segments.
+    render() follows str.format: `{name}` is a field and `{{`/`}}` are
+    literal braces. Prompts used as plain text are never parsed.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._segments = None
+
+    @property
+    def segments(self):
+        if self._segments is None:
+            self._segments = [
+                (literal, field, spec, conversion)
+                for literal, field, spec, conversion in _formatter.parse(self.text)
+            ]
+        return self._segments
+
+    @property
+    def fields(self):
+        """Names of the placeholders in the template"""
+        return {field for _, field, _, _ in self.segments if field is not None}
+
+    def render(self, **values):
+        parts = []
+        for literal, field, spec, conversion in self.segments:
+            parts.append(literal)
+            if field is None:
+                continue
+            if field in values:
+                value = values[field]
+            else:
+                # Dotted/indexed fields and missing names behave like str.format
+                value, _ = _formatter.get_field(field, (), values)
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            parts.append(format(value, spec) if spec else str(value))
+        return "".join(parts)
+
+
+class PromptRegistry:
+    """
+    Prompt files keyed by their path under api/bot/ (e.g. "Prompts/end.md").
+    Files are read once; lookups re-check modification times at most every
+    `reload_interval` seconds so prompt edits are picked up without a restart.
+    """
+
+    def __init__(self, base_dir=BOT_DIR, patterns=PROMPT_PATTERNS, reload_interval=RELOAD_INTERVAL):
+        self.base_dir = Path(base_dir)
+        self.patterns = patterns
+        self.reload_interval = reload_interval
+        self.entries = {}  # name -> (mtime_ns, PromptTemplate)
+        self.last_check = None
+        self.lock = threading.Lock()
+
+    def _scan(self):
+        files = {}
+        for pattern in self.patterns:
+            for path in self.base_dir.glob(pattern):
+                files[path.relative_to(self.base_dir).as_posix()] = path
+        return files
+
+    def load(self):
+        """(Re)read every changed, new or deleted prompt file"""
+        with self.lock:
+            entries = {}
+            for name, path in self._scan().items():
+                try:
+                    mtime = path.stat().st_mtime_ns
+                    cached = self.entries.get(name)
+                    if cached is not None and cached[0] == mtime:
+                        entries[name] = cached
+                        continue
+                    entries[name] = (mtime, PromptTemplate(path.read_text(encoding='utf-8')))
+                except OSError:
+                    continue  # removed between the scan and the read
+            self.entries = entries
+            self.last_check = time.monotonic()
+        return self
+
+    def _maybe_reload(self):
+        if self.last_check is None:
+            self.load()
+        elif self.reload_interval >= 0 and time.monotonic() - self.last_check >= self.reload_interval:
+            self.load()
+
+    def get(self, name):
+        self._maybe_reload()
+        entry = self.entries.get(name)
+        if entry is None:
+            raise FileNotFoundError(f"No prompt named {name!r} under {self.base_dir}")
+        return entry[1]
+
+    def text(self, name):
+        return self.get(name).text
+
+    def render(self, name, /, **values):
+        return self.get(name).render(**values)
+
+    def names(self):
+        self._maybe_reload()
+        return sorted(self.entries)
+
+
+registry = PromptRegistry()
+
+
+def get(name):
+    return registry.get(name)
+
+
+def text(name):
+    return registry.text(name)
+
+
+def render(name, /, **values):
+    return registry.render(name, **values)
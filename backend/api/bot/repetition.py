@@ -0,0 +1,242 @@
+import os
+import re
+import threading
+from collections import Counter, deque
+
+from api.bot import context_assembler
+from api.bot.cache import LRUCache, MISSING
+from api.bot.db import immediate_atomic
+from api.models import UserRepetitionState
+
+# Phrases the bot already used are tracked per user, in a bounded window of
+# recent phrases per category, and compared by character shingles so that
+# a reworded sentence still counts as a repetition.
+
+RECENT_PHRASES = int(os.getenv('REPETITION_RECENT_PHRASES', '20'))  # per category
+MAX_TRACKED_USERS = int(os.getenv('REPETITION_MAX_USERS', '1000'))  # trackers kept in memory
+SIMILARITY_THRESHOLD = float(os.getenv('REPETITION_SIMILARITY', '0.6'))
+SHINGLE_SIZE = 3
+OVERUSE_THRESHOLD = 2
+# The prompt section lists this many recent phrases per category, within a token cap
+BLOCK_PHRASES = int(os.getenv('REPETITION_BLOCK_PHRASES', '5'))
+BLOCK_MAX_TOKENS = int(os.getenv('REPETITION_BLOCK_MAX_TOKENS', '400'))
+
+CATEGORIES = ('general', 'question', 'empathy', 'transition')
+
+PROBLEMATIC_WORDS = (
+    'کمک', 'متاسفم', 'می‌تونم', 'می‌خوام', 'اینجام', 'گوش', 'صحبت', 'احساس', 'ناراحت', 'خوشحال',
+    'واقعاً', 'وای', 'اوه', 'باشه', 'مشکلی', 'احترام', 'دوست', 'طبیعی', 'گرم', 'صمیمی',
+)
+
+BLOCK_HEADER = "**قبل از پاسخ دادن، این عبارات قبلاً استفاده شده‌اند و نباید تکرار شوند:**\n\n"
+# Categories listed in the prompt section, with their titles
+BLOCK_SECTIONS = (
+    ('empathy', "**عبارات همدردی استفاده شده:**\n"),
+    ('question', "**سوالات استفاده شده:**\n"),
+)
+OVERUSED_TITLE = "**⚠️ کلمات استفاده شده بیش از حد (نباید تکرار شوند):**\n"
+
+
+def clean_phrase(phrase):
+    """Normalize a phrase for comparison"""
+    if not phrase:
+        return ""
+    cleaned = re.sub(r'\s+', ' ', phrase.strip())
+    cleaned = re.sub(r'[؟،.!?]', '', cleaned)
+    return cleaned.lower()
+
+
+def shingles(phrase, size=SHINGLE_SIZE):
+    """Character n-grams of a cleaned phrase"""
+    if len(phrase) <= size:
+        return {phrase} if phrase else set()
+    return {phrase[i:i + size] for i in range(len(phrase) - size + 1)}
+
+
+def similarity(a, b):
+    """Jaccard similarity of two shingle sets"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class RepetitionPrevention:
+    """Phrases and overused words of one user's conversation"""
+
+    def __init__(self, data=None):
+        self.lock = threading.Lock()
+        self.phrases = {category: deque(maxlen=RECENT_PHRASES) for category in CATEGORIES}
+        self.problematic_words = Counter()  # only PROBLEMATIC_WORDS, so bounded
+        self.overused = {}  # word -> count once it reaches OVERUSE_THRESHOLD, in the order it got there
+        self._shingles = {}  # phrase -> shingles, for the phrases in the windows
+        self._block = None  # rendered prompt section, until the next add_phrase
+        for category, phrases in (data or {}).get('phrases', {}).items():
+            if category in self.phrases:
+                self.phrases[category].extend(phrases)
+        for word, count in (data or {}).get('words', {}).items():
+            self._count_word(word, count)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'phrases': {category: list(phrases) for category, phrases in self.phrases.items() if phrases},
+                'words': dict(self.problematic_words),
+            }
+
+    def _shingles_of(self, phrase):
+        cached = self._shingles.get(phrase)
+        if cached is None:
+            cached = self._shingles[phrase] = shingles(phrase)
+        return cached
+
+    def _match(self, cleaned, categories):
+        """The tracked phrase most similar to `cleaned` above the threshold, or None"""
+        wanted = self._shingles_of(cleaned)
+        best, best_score = None, SIMILARITY_THRESHOLD
+        for category in categories:
+            for phrase in self.phrases[category]:
+                score = 1.0 if phrase == cleaned else similarity(wanted, self._shingles_of(phrase))
+                if score >= best_score:
+                    best, best_score = phrase, score
+        return best
+
+    def add_phrase(self, phrase, category="general"):
+        """Track a phrase; a near-duplicate of a tracked one just becomes the most recent"""
+        cleaned = clean_phrase(phrase)
+        if not cleaned:
+            return
+        category = category if category in self.phrases else "general"
+        with self.lock:
+            for word in cleaned.split():
+                if word in PROBLEMATIC_WORDS:
+                    self._count_word(word)
+
+            window = self.phrases[category]
+            duplicate = self._match(cleaned, [category])
+            if duplicate is not None:
+                window.remove(duplicate)
+            window.append(cleaned)
+            self._forget_evicted()
+            self._block = None
+
+    def _count_word(self, word, amount=1):
+        self.problematic_words[word] += amount
+        if self.problematic_words[word] >= OVERUSE_THRESHOLD:
+            self.overused[word] = self.problematic_words[word]
+
+    def _forget_evicted(self):
+        if len(self._shingles) > len(CATEGORIES) * RECENT_PHRASES:
+            tracked = {phrase for phrases in self.phrases.values() for phrase in phrases}
+            self._shingles = {phrase: s for phrase, s in self._shingles.items() if phrase in tracked}
+
+    def recent(self, category, limit=None):
+        """Most recent phrases of a category, oldest first"""
+        with self.lock:
+            phrases = list(self.phrases[category])
+        return phrases[-limit:] if limit else phrases
+
+    def get_overused_words(self, threshold=OVERUSE_THRESHOLD):
+        """Problematic words used at least `threshold` times"""
+        with self.lock:
+            if threshold == OVERUSE_THRESHOLD:
+                return dict(self.overused)
+            return {word: count for word, count in self.problematic_words.items() if count >= threshold}
+
+    def prompt_block(self, max_tokens=BLOCK_MAX_TOKENS):
+        """
+        The repetition-prevention prompt section: recent phrases (oldest
+        first) and overused words, or None before anything was tracked.
+        Rendered once per change; the oldest phrases go first when the
+        section exceeds `max_tokens`.
+        """
+        with self.lock:
+            if self._block is not None and self._block[0] == max_tokens:
+                return self._block[1]
+            lists = {category: list(self.phrases[category])[-BLOCK_PHRASES:] for category, _ in BLOCK_SECTIONS}
+            block = _render_block(lists, self.overused)
+            while block and context_assembler.count_tokens(block) > max_tokens and any(lists.values()):
+                longest = max(lists, key=lambda category: len(lists[category]))
+                lists[longest].pop(0)
+                block = _render_block(lists, self.overused)
+            self._block = (max_tokens, block)
+            return block
+
+    def is_word_overused(self, word, threshold=OVERUSE_THRESHOLD):
+        return self.problematic_words.get(word, 0) >= threshold
+
+    def is_phrase_used(self, phrase, category="general"):
+        """Whether a phrase, or a near-duplicate of it, was used recently; "general" checks every category"""
+        cleaned = clean_phrase(phrase)
+        if not cleaned:
+            return False
+        categories = CATEGORIES if category not in CATEGORIES[1:] else [category]
+        with self.lock:
+            return self._match(cleaned, categories) is not None
+
+    def get_unused_phrases(self, phrase_list, category="general"):
+        """Phrases from a list that have not been used yet"""
+        return [phrase for phrase in phrase_list if not self.is_phrase_used(phrase, category)]
+
+
+def _render_block(lists, overused):
+    if not (any(lists.values()) or overused):
+        return None
+    parts = [BLOCK_HEADER]
+    for category, title in BLOCK_SECTIONS:
+        if lists[category]:
+            parts.append(title + "".join(f"- {phrase}\n" for phrase in lists[category]) + "\n")
+    if overused:
+        parts.append(OVERUSED_TITLE + "".join(
+            f"- '{word}' ({count} بار استفاده شده)\n" for word, count in overused.items()) + "\n")
+    return "".join(parts)
+
+
+class RepetitionTrackers:
+    """
+    Per-user trackers. The most recently active users stay in memory; the
+    rest are loaded from UserRepetitionState when they come back, so the
+    trackers survive worker restarts and memory stays flat. Another worker
+    may have served the user's last turn, so each turn starts by reloading
+    the tracker (begin_turn) and drops it from memory when done (end_turn).
+    """
+
+    def __init__(self, maxsize=MAX_TRACKED_USERS):
+        self.trackers = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def get(self, user):
+        tracker = self.trackers.get(user.id)
+        if tracker is not MISSING:
+            return tracker
+        with self.lock:
+            tracker = self.trackers.get(user.id)
+            if tracker is MISSING:
+                tracker = self._load(user)
+                self.trackers.set(user.id, tracker)
+        return tracker
+
+    def _load(self, user):
+        data = UserRepetitionState.objects.filter(user_id=user.id).values_list('data', flat=True).first()
+        return RepetitionPrevention(data)
+
+    def begin_turn(self, user):
+        """Reload the user's tracker; the turn's lease keeps other workers from writing it meanwhile"""
+        tracker = self._load(user)
+        self.trackers.set(user.id, tracker)
+        return tracker
+
+    def end_turn(self, user):
+        self.trackers.delete(user.id)
+
+    def save(self, user):
+        tracker = self.get(user)
+        with immediate_atomic():
+            UserRepetitionState.objects.update_or_create(user_id=user.id, defaults={'data': tracker.to_dict()})
+
+    def reset(self, user):
+        """Start a user's tracking afresh (a new conversation session)"""
+        self.trackers.set(user.id, RepetitionPrevention())
+        UserRepetitionState.objects.filter(user_id=user.id).delete()
+
+    def clear(self):
+        self.trackers.clear()
@@ -0,0 +1,337 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import openai
+from django.conf import settings
+
+from api.bot import metrics
+
+# Whole-request budget shared by every LLM call of a turn
+REQUEST_BUDGET = float(os.getenv('LLM_REQUEST_BUDGET', '120'))
+# Longest a single attempt may take, and the tighter cap for classifier calls
+ATTEMPT_TIMEOUT = float(os.getenv('LLM_ATTEMPT_TIMEOUT', '60'))
+CLASSIFIER_ATTEMPT_TIMEOUT = float(os.getenv('LLM_CLASSIFIER_ATTEMPT_TIMEOUT', '15'))
+# Do not start an attempt with less time than this left
+MIN_ATTEMPT_SECONDS = float(os.getenv('LLM_MIN_ATTEMPT_SECONDS', '1'))
+MAX_ATTEMPTS = int(os.getenv('LLM_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', '8'))
+# Send a duplicate classifier request once the first has run longer than
+# HEDGE_QUANTILE of the call site's recent calls; HEDGE_DELAY until
+# HEDGE_MIN_SAMPLES of them have been timed. See settings.LLM_HEDGE_BUDGET.
+HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', '2'))
+HEDGE_QUANTILE = float(os.getenv('LLM_HEDGE_QUANTILE', '0.95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+HEDGE_BUDGET = float(os.getenv('LLM_HEDGE_BUDGET', '0.05'))
+HEDGE_BURST = float(os.getenv('LLM_HEDGE_BURST', '3'))
+HEDGE_MAX_WORKERS = int(os.getenv('LLM_HEDGE_MAX_WORKERS', '32'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('LLM_BREAKER_FAILURES', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('LLM_BREAKER_RESET_TIMEOUT', '30'))
+
+RETRYABLE_STATUSES = {408, 409, 429}
+
+DEADLINE = contextvars.ContextVar('llm_deadline', default=None)
+
+
+class LLMUnavailable(Exception):
+    """The provider could not answer within the request's budget"""
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):  # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUSES or error.status_code >= 500
+    return False
+
+
+def failure_reason(error):
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError):
+        return str(error.status_code)
+    return type(error).__name__
+
+
+@contextmanager
+def deadline(seconds=REQUEST_BUDGET):
+    """Give every LLM call made inside the block a shared time budget"""
+    token = DEADLINE.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        DEADLINE.reset(token)
+
+
+def remaining_budget():
+    """Seconds left in the current request's budget, or None outside a request"""
+    expires_at = DEADLINE.get()
+    if expires_at is None:
+        return None
+    return expires_at - time.monotonic()
+
+
+def attempt_timeout(cap):
+    """Timeout for the next attempt: the call's cap, clipped to the budget left"""
+    remaining = remaining_budget()
+    if remaining is None:
+        return cap
+    return min(cap, remaining)
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive transient failures and refuses
+    calls for `reset_timeout` seconds, then lets a single trial call through.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                metrics.LLM_CIRCUIT_OPENS.inc()
+            self.trial_in_flight = False
+
+    def reset(self):
+        self.record_success()
+
+
+provider_breaker = CircuitBreaker()
+
+
+class HedgeBudget:
+    """
+    Lets at most `ratio` of the hedgeable calls send a duplicate request:
+    every call earns `ratio` of a hedge, every hedge spends a whole one, and
+    up to `burst` unspent hedges are saved for a slow spell.
+    """
+
+    def __init__(self, ratio=HEDGE_BUDGET, burst=HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.lock = threading.Lock()
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+hedge_budget = HedgeBudget(
+    getattr(settings, 'LLM_HEDGE_BUDGET', HEDGE_BUDGET),
+    getattr(settings, 'LLM_HEDGE_BURST', HEDGE_BURST),
+)
+
+
+def hedge_delay(call_site, timeout):
+    """How long a call runs alone before it is hedged: the call site's observed tail latency"""
+    observed = metrics.LLM_CALL_SECONDS.quantile(
+        getattr(settings, 'LLM_HEDGE_QUANTILE', HEDGE_QUANTILE),
+        min_count=HEDGE_MIN_SAMPLES, call_site=call_site, outcome="ok")
+    return min(HEDGE_DELAY if observed is None else observed, timeout)
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def get_hedge_executor():
+    # Separate from the CallPlan pool: hedged attempts never wait on each
+    # other, so a planner worker blocking on them cannot starve the pool.
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="llm-hedge")
+    return _hedge_executor
+
+
+def _next_timeout(cap, attempt, breaker):
+    """Check the breaker and budget before an attempt; returns the attempt's timeout"""
+    call_site = metrics.CALL_SITE.get()
+    if not breaker.allow():
+        metrics.LLM_FAST_FAILURES.inc(call_site=call_site, reason="circuit_open")
+        raise LLMUnavailable("LLM provider circuit is open")
+    timeout = attempt_timeout(cap)
+    if timeout < MIN_ATTEMPT_SECONDS:
+        # The breaker let us through; give the slot back without judging the provider
+        with breaker.lock:
+            breaker.trial_in_flight = False
+        metrics.LLM_FAST_FAILURES.inc(call_site=call_site, reason="deadline")
+        raise LLMUnavailable("LLM request budget exhausted")
+    return timeout
+
+
+def _should_retry(error, attempt, breaker):
+    """Record a failed attempt; returns the backoff to sleep, or None to give up"""
+    if not is_retryable(error):
+        # The provider answered; the request itself is at fault
+        breaker.record_success()
+        raise error
+    breaker.record_failure()
+    if attempt + 1 >= MAX_ATTEMPTS:
+        return None
+    delay = backoff_delay(attempt)
+    remaining = remaining_budget()
+    if remaining is not None and remaining - delay < MIN_ATTEMPT_SECONDS:
+        return None
+    metrics.LLM_RETRIES.inc(call_site=metrics.CALL_SITE.get(), reason=failure_reason(error))
+    return delay
+
+
+def _may_hedge(call_site):
+    """Spend a hedge of the budget; a slow call over budget just keeps waiting"""
+    if hedge_budget.spend():
+        return True
+    metrics.LLM_HEDGES_OVER_BUDGET.inc(call_site=call_site)
+    return False
+
+
+def _hedged(call, timeout):
+    """Run call(timeout); if it is still pending after the hedge delay, race a duplicate"""
+    executor = get_hedge_executor()
+    call_site = metrics.CALL_SITE.get()
+    delay = hedge_delay(call_site, timeout)
+    hedge_budget.earn()
+    first = executor.submit(contextvars.copy_context().run, call, timeout)
+    done, _ = wait([first], timeout=delay)
+    if done or not _may_hedge(call_site):
+        return first.result()
+
+    second = executor.submit(contextvars.copy_context().run, call, max(timeout - delay, MIN_ATTEMPT_SECONDS))
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                metrics.LLM_HEDGES.inc(call_site=call_site, winner="primary" if future is first else "hedge")
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_with_resilience(call, cap=ATTEMPT_TIMEOUT, hedge=False, breaker=None):
+    """
+    Run call(timeout) with budget-aware jittered retries and the circuit
+    breaker. Hedged calls send a duplicate request when the first is slow.
+    Transient failures that outlast the budget raise LLMUnavailable.
+    """
+    breaker = breaker or provider_breaker
+    attempt = 0
+    while True:
+        timeout = _next_timeout(cap, attempt, breaker)
+        try:
+            if hedge:
+                result = _hedged(call, timeout)
+            else:
+                result = call(timeout)
+        except Exception as e:
+            delay = _should_retry(e, attempt, breaker)
+            if delay is None:
+                raise LLMUnavailable(f"LLM provider failed: {failure_reason(e)}") from e
+            time.sleep(delay)
+            attempt += 1
+            continue
+        breaker.record_success()
+        return result
+
+
+async def _ahedged(call, timeout):
+    call_site = metrics.CALL_SITE.get()
+    delay = hedge_delay(call_site, timeout)
+    hedge_budget.earn()
+    first = asyncio.ensure_future(call(timeout))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done or not _may_hedge(call_site):
+        return await first
+
+    second = asyncio.ensure_future(call(max(timeout - delay, MIN_ATTEMPT_SECONDS)))
+    pending = {first, second}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    metrics.LLM_HEDGES.inc(call_site=call_site, winner="primary" if task is first else "hedge")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def acall_with_resilience(call, cap=ATTEMPT_TIMEOUT, hedge=False, breaker=None):
+    """Async counterpart of call_with_resilience; call(timeout) returns an awaitable"""
+    breaker = breaker or provider_breaker
+    attempt = 0
+    while True:
+        timeout = _next_timeout(cap, attempt, breaker)
+        try:
+            if hedge:
+                result = await _ahedged(call, timeout)
+            else:
+                result = await call(timeout)
+        except Exception as e:
+            delay = _should_retry(e, attempt, breaker)
+            if delay is None:
+                raise LLMUnavailable(f"LLM provider failed: {failure_reason(e)}") from e
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+
+from api.bot.db import immediate_atomic
+from api.models import UserFSMState
+
+try:
+    import redis
+except ImportError:  # optional: only needed for the redis backend
+    redis = None
+
+# Each user's FSM state (state name, counters, exercises done, session id)
+# lives in a store shared by every worker. Writes are optimistic: a save
+# names the version it was based on and fails with StaleStateError if
+# another worker saved in between.
+
+REDIS_KEY_PREFIX = os.getenv('USER_STATE_REDIS_PREFIX', 'sat:user_state:')
+
+
+class StaleStateError(Exception):
+    """The stored state changed since it was loaded"""
+
+    def __init__(self, user_id, version):
+        super().__init__(f"User state of {user_id} is no longer at version {version}")
+        self.user_id = user_id
+        self.version = version
+
+
+def dump_state(state):
+    data = dict(state)
+    if isinstance(data.get('exercises_done'), set):
+        data['exercises_done'] = sorted(data['exercises_done'])
+    return data
+
+
+def load_state(data):
+    state = dict(data)
+    if 'exercises_done' in state:
+        state['exercises_done'] = set(state['exercises_done'])
+    return state
+
+
+class InMemoryStateStore:
+    """Process-local store, for tests and single-worker development"""
+
+    def __init__(self):
+        self.rows = {}  # user_id -> (version, json)
+        self.lock = threading.Lock()
+
+    def load(self, user_id):
+        """(state, version) of a user, or (None, 0) if nothing is stored"""
+        with self.lock:
+            row = self.rows.get(user_id)
+        if row is None:
+            return None, 0
+        return load_state(json.loads(row[1])), row[0]
+
+    def save(self, user_id, state, version):
+        """Store `state` on top of `version`; returns the new version"""
+        data = json.dumps(dump_state(state), ensure_ascii=False)
+        with self.lock:
+            current = self.rows.get(user_id, (0, None))[0]
+            if current != version:
+                raise StaleStateError(user_id, version)
+            self.rows[user_id] = (version + 1, data)
+        return version + 1
+
+
+class DatabaseStateStore:
+    """State rows in the UserFSMState table"""
+
+    def load(self, user_id):
+        row = UserFSMState.objects.filter(user_id=user_id).values_list('data', 'version').first()
+        if row is None:
+            return None, 0
+        return load_state(row[0]), row[1]
+
+    def save(self, user_id, state, version):
+        data = dump_state(state)
+        if version == 0:
+            try:
+                with immediate_atomic():
+                    UserFSMState.objects.create(user_id=user_id, data=data, version=1)
+            except IntegrityError:
+                raise StaleStateError(user_id, version)
+            return 1
+        updated = UserFSMState.objects.filter(user_id=user_id, version=version).update(
+            data=data, version=version + 1, updated_at=timezone.now())
+        if not updated:
+            raise StaleStateError(user_id, version)
+        return version + 1
+
+
+class RedisStateStore:
+    """One hash per user (data, version) on a Redis-compatible server"""
+
+    # Compare-and-set: write only if the stored version is still ARGV[1]
+    SAVE_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+if current ~= tonumber(ARGV[1]) then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'version', current + 1, 'data', ARGV[2])
+return current + 1
+"""
+
+    def __init__(self, url=None, client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis user state store needs the redis package")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.save_script = client.register_script(self.SAVE_SCRIPT)
+
+    def _key(self, user_id):
+        return f"{REDIS_KEY_PREFIX}{user_id}"
+
+    def load(self, user_id):
+        data, version = self.client.hmget(self._key(user_id), 'data', 'version')
+        if data is None:
+            return None, 0
+        return load_state(json.loads(data)), int(version)
+
+    def save(self, user_id, state, version):
+        data = json.dumps(dump_state(state), ensure_ascii=False)
+        new_version = int(self.save_script(keys=[self._key(user_id)], args=[version, data]))
+        if new_version < 0:
+            raise StaleStateError(user_id, version)
+        return new_version
+
+
+def get_state_store():
+    """The store named by settings.USER_STATE_STORE ("database", "redis" or "memory")"""
+    backend = getattr(settings, 'USER_STATE_STORE', 'database')
+    if backend == 'memory':
+        return InMemoryStateStore()
+    if backend == 'redis':
+        return RedisStateStore(getattr(settings, 'USER_STATE_REDIS_URL', 'redis://localhost:6379/0'))
+    if backend == 'database':
+        return DatabaseStateStore()
+    raise ValueError(f"Unknown user state store: {backend}")
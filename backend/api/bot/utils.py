@@ -1,201 +1,93 @@
-from api.models import Message, UserMemoryState, UserDayProgress
-from api.bot.gpt import openai_req_generator
+from api.bot.gpt import openai_req_generator, openai_req_generator_stream
 from api.bot.gpt_for_statedetection import if_data_sufficient_for_state_change
 from api.bot.Memory.LLM_Memory import MemoryManager
 from api.bot.gpt_for_comprehension import OpenAILLM
 from api.bot.gpt_recommendations import create_recommendations
-from api.bot.RAG.llm_excercise_suggestor import suggest_exercises, exercises
+from api.bot.RAG.llm_excercise_suggestor import suggest_exercises
 from api.bot.simple_bot import get_daily_exercises
 from api.bot.RAG.gpt_explainability import create_exercise_explanation
+from api.bot.RAG import exercise_schedule, knowledge_base
+from api.bot.call_planner import CallPlan
+from api.bot import context_assembler, fsm_spec, metrics, prompt_layout, prompt_registry
+from api.bot.mailbox import MailboxExecutor
+from api.bot.message_buffer import TurnLeaseLost, TurnTimeout, get_message_buffer
+from api.bot.prefetch import Prefetcher, fingerprint
+from api.bot.repetition import RepetitionTrackers
+from api.bot.state_store import StaleStateError, get_state_store
 import json
 import re
-import time
 import threading
-from django.db.models import Max
-
-
-class RepetitionPrevention:
-    """Global repetition prevention system that tracks all phrases used across the entire conversation"""
-
-    def __init__(self):
-        self.used_phrases = set()
-        self.used_questions = set()
-        self.used_empathy_phrases = set()
-        self.used_transitions = set()
-        self.used_words = {}  # Track word frequency
-        self.problematic_words = {
-            'کمک': 0,
-            'متاسفم': 0,
-            'می‌تونم': 0,
-            'می‌خوام': 0,
-            'اینجام': 0,
-            'گوش': 0,
-            'صحبت': 0,
-            'احساس': 0,
-            'ناراحت': 0,
-            'خوشحال': 0,
-            'واقعاً': 0,
-            'وای': 0,
-            'اوه': 0,
-            'باشه': 0,
-            'مشکلی': 0,
-            'احترام': 0,
-            'دوست': 0,
-            'طبیعی': 0,
-            'گرم': 0,
-            'صمیمی': 0
-        }
-
-    def add_phrase(self, phrase, category="general"):
-        """Add a phrase to the used phrases set and track word frequency"""
-        if phrase:
-            # Clean and normalize the phrase
-            cleaned_phrase = self._clean_phrase(phrase)
-            if cleaned_phrase:
-                self.used_phrases.add(cleaned_phrase)
-
-                # Track word frequency
-                self._track_word_frequency(cleaned_phrase)
-
-                # Categorize phrases for better tracking
-                if category == "question":
-                    self.used_questions.add(cleaned_phrase)
-                elif category == "empathy":
-                    self.used_empathy_phrases.add(cleaned_phrase)
-                elif category == "transition":
-                    self.used_transitions.add(cleaned_phrase)
-
-    def _track_word_frequency(self, phrase):
-        """Track frequency of problematic words"""
-        words = phrase.split()
-        for word in words:
-            if word in self.problematic_words:
-                self.problematic_words[word] += 1
-            if word in self.used_words:
-                self.used_words[word] += 1
-            else:
-                self.used_words[word] = 1
-
-    def get_overused_words(self, threshold=2):
-        """Get words that have been used too frequently"""
-        overused = {}
-        for word, count in self.problematic_words.items():
-            if count >= threshold:
-                overused[word] = count
-        return overused
-
-    def is_word_overused(self, word, threshold=2):
-        """Check if a word has been used too frequently"""
-        return self.problematic_words.get(word, 0) >= threshold
-
-    def _clean_phrase(self, phrase):
-        """Clean and normalize a phrase for comparison"""
-        if not phrase:
-            return ""
-
-        # Remove extra whitespace and normalize
-        cleaned = re.sub(r'\s+', ' ', phrase.strip())
-        # Remove punctuation for comparison
-        cleaned = re.sub(r'[؟،.!?]', '', cleaned)
-        return cleaned.lower()
-
-    def is_phrase_used(self, phrase, category="general"):
-        """Check if a phrase has been used before"""
-        if not phrase:
-            return False
-
-        cleaned_phrase = self._clean_phrase(phrase)
-        if category == "question":
-            return cleaned_phrase in self.used_questions
-        elif category == "empathy":
-            return cleaned_phrase in self.used_empathy_phrases
-        elif category == "transition":
-            return cleaned_phrase in self.used_transitions
-        else:
-            return cleaned_phrase in self.used_phrases
-
-    def get_unused_phrases(self, phrase_list, category="general"):
-        """Get phrases from a list that haven't been used yet"""
-        return [phrase for phrase in phrase_list if not self.is_phrase_used(phrase, category)]
-
-    def reset_for_user(self, user_id):
-        """Reset repetition prevention for a specific user (global for now)"""
-        self.used_phrases.clear()
-        self.used_questions.clear()
-        self.used_empathy_phrases.clear()
-        self.used_transitions.clear()
-        self.used_words.clear()
-        for word in self.problematic_words:
-            self.problematic_words[word] = 0
-
-
-class MessageBuffer:
-    """Handles buffering of rapid successive messages from users"""
-
-    def __init__(self):
-        self.processing_users = {}  # user_id -> processing status
-        self.message_buffers = {}   # user_id -> list of buffered messages
-        self.lock = threading.Lock()
-
-    def is_user_processing(self, user_id):
-        """Check if a user is currently being processed"""
-        with self.lock:
-            return user_id in self.processing_users and self.processing_users[user_id]
-
-    def start_processing(self, user_id):
-        """Mark that processing has started for a user"""
-        with self.lock:
-            self.processing_users[user_id] = True
-            if user_id not in self.message_buffers:
-                self.message_buffers[user_id] = []
-
-    def end_processing(self, user_id):
-        """Mark that processing has ended for a user"""
-        with self.lock:
-            self.processing_users[user_id] = False
-            # Clear the buffer after processing
-            if user_id in self.message_buffers:
-                self.message_buffers[user_id] = []
-
-    def add_message(self, user_id, message):
-        """Add a message to the buffer for a user"""
-        with self.lock:
-            if user_id not in self.message_buffers:
-                self.message_buffers[user_id] = []
-            self.message_buffers[user_id].append(message)
-
-    def get_buffered_messages(self, user_id):
-        """Get all buffered messages for a user and clear the buffer"""
-        with self.lock:
-            if user_id in self.message_buffers:
-                messages = self.message_buffers[user_id].copy()
-                self.message_buffers[user_id] = []
-                return messages
-            return []
-
-    def concatenate_messages(self, messages):
-        """Concatenate multiple messages into a single message"""
-        if not messages:
-            return ""
-        # Join messages with space, but handle cases where messages might already have punctuation
-        concatenated = " ".join(messages)
-        # Clean up any double spaces
-        concatenated = re.sub(r'\s+', ' ', concatenated).strip()
-        return concatenated
-
-    def has_buffered_messages(self, user_id):
-        """Check if there are any buffered messages for a user"""
-        with self.lock:
-            return user_id in self.message_buffers and len(self.message_buffers[user_id]) > 0
+from concurrent.futures import Future, ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+# Async intervention turns run on a pool of their own (see aexecute_state),
+# so they neither starve the event loop's default executor nor grow past
+# settings.ASYNC_TURN_WORKERS threads; further turns queue for a thread.
+_turn_executor = None
+_turn_executor_lock = threading.Lock()
+
+
+def get_turn_executor():
+    global _turn_executor
+    if _turn_executor is None:
+        with _turn_executor_lock:
+            if _turn_executor is None:
+                _turn_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'ASYNC_TURN_WORKERS', 64), thread_name_prefix="fsm-turn")
+    return _turn_executor
+
+
+# Static half of the repetition-prevention instructions; it goes in the
+# cacheable prompt prefix while the phrases already used go in the suffix.
+REPETITION_GUIDANCE = (
+    "### نکات مهم برای صحبت دوستانه:\n"
+    "1. هرگز هیچ یک از عبارات فهرست شده در بخش «⚠️ هشدار مهم - جلوگیری از تکرار در کل مکالمه» را تکرار نکنید\n"
+    "2. همیشه از عبارات جدید و متنوع استفاده کنید\n"
+    "3. از بانک عبارات متنوع موجود استفاده کنید\n"
+    "4. اگر تمام عبارات استفاده شده‌اند، عبارات جدید بسازید\n"
+    "5. از تکرار عبارات 'متاسفم که'، 'می‌تونم بگم'، 'می‌خوام بدونم' خودداری کنید\n"
+    "6. همیشه ابتدا تاریخچه مکالمه را بررسی کنید تا از تکرار جلوگیری کنید\n"
+    "7. اگر کاربر قبلاً اطلاعاتی داده، به آن اشاره کنید و دوباره نپرسید\n"
+    "8. از سوالات زمان‌محور متنوع استفاده کنید (چه زمانی، اخیراً، مدتیه)\n"
+    "9. طبیعی و دوستانه صحبت کنید، نه مثل ربات\n"
+    "10. از ایموجی‌ها به ندرت و فقط در مواقع مناسب استفاده کنید\n"
+    "11. از تکرار ایموجی 😊 در هر پیام خودداری کنید\n"
+    "12. حداکثر یک ایموجی در هر پیام استفاده کنید\n"
+    "13. از تکرار کلمات کلیدی مثل 'کمک'، 'متاسفم'، 'می‌تونم' خودداری کنید\n"
+    "14. به جای 'کمکت کنم' از عبارات متنوع استفاده کنید\n"
+    "15. به جای 'متاسفم' از عبارات همدردی متنوع استفاده کنید\n"
+    "16. به جای 'می‌تونم' از ساختارهای جملات متنوع استفاده کنید\n"
+)
 
 
 class StateMachine:
-    def __init__(self):
+    def __init__(self, state_store=None):
+        # Working copies of the users' FSM state; the store is the source of truth
         self.user_states = {}
+        self.state_versions = {}
+        self.state_store = state_store or get_state_store()
         self.memory_manager = MemoryManager()
         self.openai_llm = OpenAILLM()
-        self.repetition_prevention = RepetitionPrevention()
-        self.message_buffer = MessageBuffer()
+        self.repetitions = RepetitionTrackers()
+        self.suggestion_prefetch = Prefetcher("exercise_suggestion")
+        self.turn_verdicts = {}  # user_id -> {judge prompt: verdict} of the running turn
+        self.leased_turns = set()  # users whose turn runs here under the message buffer's lease
+        # How each kind of spec'd reply is produced (see fsm_spec)
+        self.reply_handlers = {
+            fsm_spec.REPLY_PROMPT: self._reply_from_prompt,
+            fsm_spec.REPLY_SUGGESTION: self._reply_with_suggestion,
+        }
+        self.classifiers = {
+            "emotion": self.openai_llm.emotion_retriever,
+            "response": self.openai_llm.response_retriever,
+        }
+        self.message_buffer = get_message_buffer()
+        self.mailbox = MailboxExecutor(
+            self._turn, self.message_buffer.concatenate_messages,
+            debounce=getattr(settings, 'MAILBOX_DEBOUNCE_SECONDS', None),
+            max_debounce=getattr(settings, 'MAILBOX_MAX_DEBOUNCE_SECONDS', None),
+        )
 
         # Predefined phrase banks for variety
         self.empathy_phrases = [
@@ -313,252 +205,299 @@ class StateMachine:
         ]
 
     def get_user_day_progress(self, user):
-        """Get or create day progress for a specific user"""
-        day_progress, created = UserDayProgress.objects.get_or_create(user=user)
-        return day_progress.calculate_current_day()
-
+        """The user's program day, read once per turn"""
+        return self.memory_manager.get_current_day(user)
 
-    def get_day_allowed_exercises(day):
-        """Get allowed exercise numbers for a given day."""
-        base_exercises = [0]
-        
-        if day == 8:
-            return None  # All exercises are allowed
-        elif 1 <= day <= 7:
-            # Cumulative: day 1 = [1,2,3], day 2 = [1,2,3,4,5,6], etc.
-            end_exercise = day * 3
-            return base_exercises + list(range(1, end_exercise + 1))
-        else:
-            # Default to first day's exercises
-            return base_exercises + [1, 2, 3]
+    def get_day_exercises(self, user):
+        """The exercises open on the user's current day"""
+        return exercise_schedule.exercises_for_day(self.get_user_day_progress(user))
 
-    def parse_exercise_number(self, exercise_num):
-        """Parse exercise number to base number (e.g., '2a' -> 2, '0.1' -> 0)"""
-        if '.' in exercise_num:
-            return int(float(exercise_num))
-        else:
-            import re
-            base_num = re.match(r'(\d+)', exercise_num)
-            return int(base_num.group(1)) if base_num else 0
-
-    def filter_exercises_by_day(self, available_exercises, user):
-        """Filter exercises based on user's current day"""
-        current_day = self.get_user_day_progress(user)
-        allowed_exercises = self.get_day_allowed_exercises(current_day)
-
-        if allowed_exercises is None:
-            return available_exercises
+    def _initial_user_state(self, user):
+        # Get the next session ID
+        latest_session = self.memory_manager.get_latest_session_id(user)
+        return {
+            'state': "GREETING_FORMALITY_NAME",
+            'message_count': 0,
+            'emotion': None,
+            'response': None,
+            'stage': user.stage,
+            'exercises_done': set(),
+            'current_day': self.get_user_day_progress(user),
+            'current_session_id': (latest_session or 0) + 1,
+            'emotion_message_count': 0,
+            'event_message_count': 0
+        }
 
-        # Filter exercises based on day restrictions
-        filtered_exercises = []
-        for exercise in available_exercises:
-            exercise_base_num = self.parse_exercise_number(exercise["Exercise Number"])
-            if exercise_base_num in allowed_exercises or exercise_base_num == 0:  # 0.x exercises allowed on day 1
-                filtered_exercises.append(exercise)
+    def load_user_state(self, user):
+        """Replace the working copy with the stored state, created for new users"""
+        state, version = self.state_store.load(user.id)
+        self.user_states[user.id], self.state_versions[user.id] = state, version
+        if state is None:
+            self.user_states[user.id] = self._initial_user_state(user)
+            self.save_user_state(user)
+        return self.user_states[user.id]
 
-        return filtered_exercises
+    def save_user_state(self, user):
+        """
+        Write the working copy through to the store. If another worker saved
+        first, its state wins and becomes the working copy; during a turn that
+        means the turn was taken over, so it raises TurnLeaseLost instead.
+        """
+        self._check_lease(user)
+        try:
+            self.state_versions[user.id] = self.state_store.save(
+                user.id, self.user_states[user.id], self.state_versions.get(user.id, 0))
+        except StaleStateError as e:
+            print(f"{e}; using the stored state")
+            self.user_states[user.id], self.state_versions[user.id] = self.state_store.load(user.id)
+            if user.id in self.leased_turns:
+                raise TurnLeaseLost(user.id) from e
+
+    def _check_lease(self, user):
+        """Before a turn writes to a store: stop it if another worker took the user over"""
+        if user.id in self.leased_turns and self.message_buffer.lease_lost(user.id):
+            raise TurnLeaseLost(user.id)
+
+    def replace_user_state(self, user, state):
+        """Overwrite the stored state whatever its version (session end, reset)"""
+        while True:
+            _, version = self.state_store.load(user.id)
+            try:
+                self.state_versions[user.id] = self.state_store.save(user.id, state, version)
+                break
+            except StaleStateError:
+                continue
+        self.user_states[user.id] = state
 
     def get_user_state(self, user):
         """Get or create state for a specific user"""
         if user.id not in self.user_states:
-            # Get the next session ID for new users
-            from api.models import Message
-            latest_session = Message.objects.filter(user=user).aggregate(Max('session_id'))['session_id__max']
-            new_session_id = (latest_session or 0) + 1
-
-            self.user_states[user.id] = {
-                'state': "GREETING_FORMALITY_NAME",
-                'message_count': 0,
-                'emotion': None,
-                'response': None,
-                'stage': user.stage,
-                'exercises_done': set(),
-                'current_day': self.get_user_day_progress(user),
-                'current_session_id': new_session_id,
-                'emotion_message_count': 0,
-                'event_message_count': 0
-            }
-        else:
-            self.user_states[user.id]['current_day'] = self.get_user_day_progress(user)
-            # Ensure current_session_id exists for existing users
-            if 'current_session_id' not in self.user_states[user.id]:
-                from api.models import Message
-                latest_session = Message.objects.filter(user=user).aggregate(Max('session_id'))['session_id__max']
-                self.user_states[user.id]['current_session_id'] = (latest_session or 0) + 1
-
-            # Ensure state-specific counters exist for existing users
-            if 'emotion_message_count' not in self.user_states[user.id]:
-                self.user_states[user.id]['emotion_message_count'] = 0
-            if 'event_message_count' not in self.user_states[user.id]:
-                self.user_states[user.id]['event_message_count'] = 0
-        return self.user_states[user.id]
+            self.load_user_state(user)
+        user_state = self.user_states[user.id]
+        user_state['current_day'] = self.get_user_day_progress(user)
+        # Ensure current_session_id exists for existing users
+        if 'current_session_id' not in user_state:
+            user_state['current_session_id'] = self.memory_manager.get_latest_session_id(user) + 1
+
+        # Ensure state-specific counters exist for existing users
+        if 'emotion_message_count' not in user_state:
+            user_state['emotion_message_count'] = 0
+        if 'event_message_count' not in user_state:
+            user_state['event_message_count'] = 0
+        return user_state
 
     def transition(self, new_state, user):
         user_state = self.get_user_state(user)
         print(f"Transitioning from {user_state['state']} to {new_state}")
+        old_spec = fsm_spec.STATES.get(user_state['state'])
+        new_spec = fsm_spec.STATES.get(new_state)
         user_state['state'] = new_state
+        metrics.set_fsm_state(new_state)
 
         # Reset state-specific message counters when transitioning
-        if new_state == "EMOTION":
-            user_state['emotion_message_count'] = 0
-        elif new_state == "SUPER_STATE_EVENT":
-            user_state['event_message_count'] = 0
-
-    def _load_sat_knowledge(self):
-        """Load SAT knowledge base for injection into prompts"""
-        try:
-            with open('api/bot/RAG/sat_knowledge_base.md', "r", encoding="utf-8") as file:
-                return file.read()
-        except FileNotFoundError:
-            return "دانش پایه SAT در دسترس نیست."
-
-    def ask_llm(self, prompt_file, message, user, transition_info=None):
-        with open(f'api/bot/Prompts/{prompt_file}', "r", encoding="utf-8") as file:
-            system_prompt = file.read()
-
-        # Load SAT knowledge base
-        sat_knowledge = self._load_sat_knowledge()
-
+        if new_spec is not None and new_spec.counter:
+            user_state[new_spec.counter] = 0
+        self.save_user_state(user)
+
+        if new_spec is not None and new_spec.prefetch:
+            self._prefetch_suggestion(user)
+        elif old_spec is not None and old_spec.prefetch and (
+                new_spec is None or new_spec.reply != fsm_spec.REPLY_SUGGESTION):
+            self.suggestion_prefetch.discard(user.id)
+
+    def _load_sat_knowledge(self, state=None):
+        """The SAT knowledge sections every prompt of the state carries"""
+        return knowledge_base.state_knowledge(state or metrics.FSM_STATE.get())
+
+    def ask_llm(self, prompt_file, message, user, transition_info=None, stream=False):
+        template = prompt_registry.get(f'Prompts/{prompt_file}')
         user_state = self.get_user_state(user)
-        memory_context = self.memory_manager.format_memory_for_prompt(
-            user,
-            session_id=user_state.get('current_session_id')
-        )
-        session_history = self.memory_manager.get_formatted_session_history(
-            user,
-            session_id=user_state.get('current_session_id')
-        )
-
-        full_context = f"""### خلاصه اطلاعات کاربر:\n{memory_context}\n\n### تاریخچه کامل مکالمه این جلسه:\n{session_history}"""
-
-        # Inject SAT knowledge into the prompt
-        sat_knowledge_section = f"\n\n### 📚 دانش پایه تکنیک دلبستگی به خود (SAT):\n{sat_knowledge}\n"
-
-        if transition_info:
-            transition_context = f"\n\n### 🔍 وضعیت انتقال فعلی:\n**نتیجه انتقال:\n{transition_info}**\n"
-            system_prompt = system_prompt.format(memory=full_context, transition_awareness=transition_context)
-        else:
-            system_prompt = system_prompt.format(memory=full_context)
+        spec = fsm_spec.STATES.get(user_state['state'])
+        pieces = spec.context if spec is not None else fsm_spec.CONTEXT_PIECES
+
+        # The state's allowlisted SAT sections, plus the ones matching the message
+        use_knowledge = fsm_spec.KNOWLEDGE in pieces
+        use_repetition = fsm_spec.REPETITION in pieces
+        sat_knowledge = self._load_sat_knowledge(user_state['state']) if use_knowledge else None
+        volatile = {
+            'knowledge': (knowledge_base.relevant_knowledge(message, user_state['state']) or None
+                          if use_knowledge else None),
+            'memory': "",
+            'transition_awareness': f"**نتیجه انتقال:\n{transition_info}**" if transition_info else None,
+            'repetition': self._get_repetition_prevention_context(user) if use_repetition else None,
+        }
 
-        # Add SAT knowledge before repetition prevention
-        system_prompt += sat_knowledge_section
+        # State rules, SAT knowledge and the repetition guidance stay identical
+        # across users and form a cacheable prefix; per-user text goes last.
+        def build(volatile):
+            return prompt_layout.build_system_prompt(
+                template, volatile=volatile, knowledge=sat_knowledge,
+                guidance=REPETITION_GUIDANCE if use_repetition else None)
 
-        repetition_context = self._get_repetition_prevention_context()
-        system_prompt += f"\n\n### ⚠️ هشدار مهم - جلوگیری از تکرار در کل مکالمه:\n{repetition_context}"
+        # Memory and the session history share the budget left by everything else
+        context = self._assembled_context(user, build(volatile), session_id=user_state.get('current_session_id'),
+                                          history=fsm_spec.HISTORY in pieces, memory=fsm_spec.MEMORY in pieces)
+        system_prompt = build({**volatile, 'memory': context.text})
 
         # print(f'system_prompt={system_prompt}')
         # print(f'user_prompt={message}')
 
-        response = openai_req_generator(system_prompt=system_prompt, user_prompt=message, json_output=False, temperature=0.1)
+        with metrics.llm_call_site(f"ask_llm:{prompt_file}"):
+            if stream:
+                return self._track_stream_for_repetition(
+                    openai_req_generator_stream(system_prompt=system_prompt, user_prompt=message, temperature=0.1),
+                    user)
 
-        self._track_response_for_repetition(response)
+            response = openai_req_generator(system_prompt=system_prompt, user_prompt=message, json_output=False, temperature=0.1)
+
+        self._track_response_for_repetition(response, user)
 
         return response
 
-    def _get_repetition_prevention_context(self):
-        """Generate context about used phrases to prevent repetition"""
-        context = "**قبل از پاسخ دادن، این عبارات قبلاً استفاده شده‌اند و نباید تکرار شوند:**\n\n"
-
-        if self.repetition_prevention.used_empathy_phrases:
-            context += "**عبارات همدردی استفاده شده:**\n"
-            for phrase in list(self.repetition_prevention.used_empathy_phrases)[-5:]:  # Show last 5
-                context += f"- {phrase}\n"
-            context += "\n"
-
-        if self.repetition_prevention.used_questions:
-            context += "**سوالات استفاده شده:**\n"
-            for phrase in list(self.repetition_prevention.used_questions)[-5:]:  # Show last 5
-                context += f"- {phrase}\n"
-            context += "\n"
-
-        # Add overused words warning
-        overused_words = self.repetition_prevention.get_overused_words(threshold=2)
-        if overused_words:
-            context += "**⚠️ کلمات استفاده شده بیش از حد (نباید تکرار شوند):**\n"
-            for word, count in overused_words.items():
-                context += f"- '{word}' ({count} بار استفاده شده)\n"
-            context += "\n"
-
-        context += "**نکات مهم برای صحبت دوستانه:**\n"
-        context += "1. هرگز هیچ یک از عبارات بالا را تکرار نکنید\n"
-        context += "2. همیشه از عبارات جدید و متنوع استفاده کنید\n"
-        context += "3. از بانک عبارات متنوع موجود استفاده کنید\n"
-        context += "4. اگر تمام عبارات استفاده شده‌اند، عبارات جدید بسازید\n"
-        context += "5. از تکرار عبارات 'متاسفم که'، 'می‌تونم بگم'، 'می‌خوام بدونم' خودداری کنید\n"
-        context += "6. همیشه ابتدا تاریخچه مکالمه را بررسی کنید تا از تکرار جلوگیری کنید\n"
-        context += "7. اگر کاربر قبلاً اطلاعاتی داده، به آن اشاره کنید و دوباره نپرسید\n"
-        context += "8. از سوالات زمان‌محور متنوع استفاده کنید (چه زمانی، اخیراً، مدتیه)\n"
-        context += "9. طبیعی و دوستانه صحبت کنید، نه مثل ربات\n"
-        context += "10. از ایموجی‌ها به ندرت و فقط در مواقع مناسب استفاده کنید\n"
-        context += "11. از تکرار ایموجی 😊 در هر پیام خودداری کنید\n"
-        context += "12. حداکثر یک ایموجی در هر پیام استفاده کنید\n"
-        context += "13. از تکرار کلمات کلیدی مثل 'کمک'، 'متاسفم'، 'می‌تونم' خودداری کنید\n"
-        context += "14. به جای 'کمکت کنم' از عبارات متنوع استفاده کنید\n"
-        context += "15. به جای 'متاسفم' از عبارات همدردی متنوع استفاده کنید\n"
-        context += "16. به جای 'می‌تونم' از ساختارهای جملات متنوع استفاده کنید\n"
-
-        return context
-
-    def _track_response_for_repetition(self, response):
+    def _track_stream_for_repetition(self, chunks, user):
+        """Pass a streamed reply through, tracking it for repetition once complete"""
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        self._track_response_for_repetition("".join(parts), user)
+
+    def _get_repetition_prevention_context(self, user):
+        """The user's most recent phrases and overused words, or None before the bot has said anything"""
+        block = self.repetitions.get(user).prompt_block()
+        if block:
+            metrics.LLM_REPETITION_BLOCK_TOKENS.observe(
+                context_assembler.count_tokens(block), state=metrics.FSM_STATE.get())
+        return block
+
+    def _track_response_for_repetition(self, response, user):
         """Track the response to prevent future repetition"""
         if not response:
             return
 
-        # Extract sentences and track them
-        sentences = re.split(r'[.!?؟]', response)
+        tracker = self.repetitions.get(user)
+        # Extract sentences, keeping their closing punctuation, and track them
+        sentences = re.findall(r'[^.!?؟]+[.!?؟]?', response)
         for sentence in sentences:
             sentence = sentence.strip()
             if sentence and len(sentence) > 10:  # Only track meaningful sentences
                 # Determine category based on content
                 if any(word in sentence for word in ['احساس', 'حس', 'ناراحت', 'خوشحال', 'متاسفم', 'درکت', 'فهمم']):
-                    self.repetition_prevention.add_phrase(sentence, "empathy")
+                    tracker.add_phrase(sentence, "empathy")
                 elif '?' in sentence or '؟' in sentence:
-                    self.repetition_prevention.add_phrase(sentence, "question")
+                    tracker.add_phrase(sentence, "question")
                 else:
-                    self.repetition_prevention.add_phrase(sentence, "general")
+                    tracker.add_phrase(sentence, "general")
+        self._check_lease(user)
+        self.repetitions.save(user)
+
+    def _assembled_context(self, user, fixed_text, session_id=None, history=True, memory=True):
+        """
+        With `memory`, the memory summary plus the not yet summarized messages,
+        and with `history` the session history, fitted to the state's token budget
+        """
+        state = self.get_user_state(user).get('state')
+        spans = []
+        if memory:
+            spans.append(self.memory_manager.get_unprocessed_messages(user, session_id))
+        if history:
+            spans.append(self.memory_manager.get_chat_history(user, session_id))
+        return context_assembler.assemble(
+            self.memory_manager.get_current_memory(user) if memory else "",
+            spans,
+            context_assembler.context_budget(state),
+            fixed_text=fixed_text,
+            state=state,
+        )
+
+    def _customization_memory(self, prompt_file, user, current_day):
+        """Memory context for _customize_with_context, within the state's budget"""
+        fixed_text = prompt_layout.build_system_prompt(
+            prompt_registry.get(f'Prompts/{prompt_file}'),
+            volatile={'memory': ""},
+            static={'current_day': current_day},
+            knowledge=self._load_sat_knowledge(),
+        )
+        context = self._assembled_context(user, fixed_text, history=False)
+        return context.render(history_title="پیام‌های اخیر")
 
     def customize_excercises(self, prompt_file, user, excercises):
-        with open(f'api/bot/Prompts/{prompt_file}', "r", encoding="utf-8") as file:
-            system_prompt = file.read()
-            
-        # Load SAT knowledge base
-        sat_knowledge = self._load_sat_knowledge()
-        
-        memory_context = self.memory_manager.format_memory_for_prompt(user)
-        
         # Get current day progress
         current_day = self.get_user_day_progress(user)
-        
+        memory_context = self._customization_memory(prompt_file, user, current_day)
+
         # with open('debug.md', 'w', encoding="utf-8") as file:
         #     file.write(memory_context)
-        if memory_context != "":
-            system_prompt = system_prompt.format(
-                memory=memory_context, 
-                exc=excercises,
-                current_day=current_day)
-        else:
-            system_prompt = system_prompt.format(
-                memory="", 
-                exc=excercises,
-                current_day=current_day)
+        return self._customize_with_context(prompt_file, memory_context, current_day, excercises)
 
-        # Inject SAT knowledge into the prompt
-        sat_knowledge_section = f"\n\n### 📚 دانش پایه تکنیک دلبستگی به خود (SAT):\n{sat_knowledge}\n"
-        system_prompt += sat_knowledge_section
+    def _customize_with_context(self, prompt_file, memory_context, current_day, excercises, stream=False):
+        """LLM part of customize_excercises; takes no ORM access so it can run on a planner thread"""
+        template = prompt_registry.get(f'Prompts/{prompt_file}')
+            
+        # Load SAT knowledge base
+        sat_knowledge = self._load_sat_knowledge()
+        relevant_knowledge = knowledge_base.relevant_knowledge(excercises, metrics.FSM_STATE.get())
+        
+        # The program day has only a handful of values, so it stays in the
+        # cacheable prefix; memory and the chosen exercise go last.
+        system_prompt = prompt_layout.build_system_prompt(
+            template,
+            volatile={'knowledge': relevant_knowledge or None, 'exc': excercises, 'memory': memory_context},
+            static={'current_day': current_day},
+            knowledge=sat_knowledge,
+        )
+
+        with metrics.llm_call_site("customize_exercises"):
+            if stream:
+                return openai_req_generator_stream(system_prompt=system_prompt, user_prompt=None, temperature=0.1)
+            return openai_req_generator(system_prompt=system_prompt, user_prompt=None, json_output=False, temperature=0.1)
+
+    def _explain_suggestion(self, suggestion, user_memory):
+        exercise_content, _ = suggestion
+        if not exercise_content:
+            return None
+        return create_exercise_explanation(user_memory, exercise_content)
+
+    def _suggestion_inputs(self, user):
+        """Everything the exercise suggestion depends on, read on the request thread"""
+        user_state = self.get_user_state(user)
+        return (
+            sorted(user_state['exercises_done']),
+            self.memory_manager.get_current_memory(user),
+            user_state['stage'],
+            self.get_day_exercises(user),
+        )
 
-        return openai_req_generator(system_prompt=system_prompt, user_prompt=None, json_output=False, temperature=0.1)
+    def _start_suggestion(self, exercises_done, user_memory, stage, day_filtered_exercises):
+        """suggest (2 calls) -> explain; returns {name: Future} without waiting"""
+        plan = CallPlan()
+        plan.add("suggestion", suggest_exercises, exercises_done, user_memory, stage, day_filtered_exercises)
+        plan.add("explainability", self._explain_suggestion, user_memory, inputs=["suggestion"])
+        return plan.start()
+
+    @staticmethod
+    def _suggestion_fingerprint(inputs):
+        exercises_done, user_memory, stage, day_filtered_exercises = inputs
+        return fingerprint(exercises_done, user_memory, stage,
+                           [exercise["Exercise Number"] for exercise in day_filtered_exercises])
+
+    def _prefetch_suggestion(self, user):
+        """Start the suggestion now, so it is ready if the user agrees to an exercise"""
+        if not getattr(settings, 'EXERCISE_PREFETCH_ENABLED', True):
+            return
+        inputs = self._suggestion_inputs(user)
+        self.suggestion_prefetch.start(user.id, self._suggestion_fingerprint(inputs),
+                                       lambda: self._start_suggestion(*inputs))
 
-    def if_transition(self, user, data):
+    def if_transition(self, user, data, with_memory=None):
         # Get current session messages
-        messages_obj = self.memory_manager.get_chat_history(user)
-        chat_history = "\n".join([
-            f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
-            for msg in messages_obj
-        ])
+        chat_history = self._chat_history_text(user)
 
         # For emotion and event states, only consider current session history
         # For other states (like greeting), consider both current session and previous memory
-        if data in ["emotion.md", "event.md"]:
+        if with_memory is None:
+            with_memory = data not in ["emotion.md", "event.md"]
+        if not with_memory:
             # Only use current session history for emotion and event states
             full_context = f"تاریخچه جلسه فعلی:\n{chat_history}"
         else:
@@ -573,318 +512,304 @@ class StateMachine:
         transit = if_data_sufficient_for_state_change(data, full_context)
         return transit
 
-    def state_handler(self, message, user):
+    def _reply(self, response, user, explainability=None, exercise_number=None):
+        """
+        Package a state_handler result. Streamed replies get their
+        recommendations once the full text is known (see stream_state).
+        """
+        if isinstance(response, str):
+            recommendations = create_recommendations(response, self.memory_manager.get_current_memory(user))
+        else:
+            recommendations = None
+        return response, recommendations, explainability, exercise_number
+
+    def state_handler(self, message, user, stream=False):
+        """Reply in the user's state, as its spec in fsm_spec declares"""
         user_state = self.get_user_state(user)
-        exercise_number = None
-
-        messages_obj = self.memory_manager.get_chat_history(user)
-        chat_history = "\n".join([
-            f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
-            for msg in messages_obj
-        ])
-
-        if user_state['state'] == "EMOTION_DECIDER":
-            emotion = self.openai_llm.emotion_retriever(user_message=message, chat_history=chat_history)
-            self.set_emotion(emotion, user)
-            if 'Positive' in user_state['emotion']:
-                self.transition("ASK_EXERCISE", user)
-            else:
-                self.transition("SUPER_STATE_EVENT", user)
-
-        if user_state['state'] == "GREETING_FORMALITY_NAME":
-            # Check transition status for greeting
-            transit = self.if_transition(user, "greeting.md")
-            response = self.ask_llm(
-                "greeting_formality_name.md", message, user, transit)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "EMOTION":
-            # Check transition status for emotion
-            transit = self.if_transition(user, "emotion.md")
-            response = self.ask_llm("emotion.md", message, user, transit)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "SUPER_STATE_EVENT":
-            # Check transition status for event
-            transit = self.if_transition(user, "event.md")
-            response = self.ask_llm("ask_all_event.md", message, user, transit)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "OPEN_ENDED_CONVERSATION":
-            response = self.ask_llm("open_ended_conversation.md", message, user)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "ASK_EXERCISE":
-            response = self.ask_llm("ask_exercise.md", message, user)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "EXERCISE_SUGGESTION":
-            user_memory = self.memory_manager.get_current_memory(user)
+        spec = fsm_spec.STATES.get(user_state['state'])
+        if spec is not None and spec.decide_on_reply:
+            self.transition(self._next_state(spec, message, user), user)
+            spec = fsm_spec.STATES.get(user_state['state'])
+        if spec is None:
+            return "میتونی بیشتر توضیح بدی", [], None, None
+        return self.reply_handlers[spec.reply](spec, message, user, stream)
 
-            all_exercises = exercises
-            day_filtered_exercises = self.filter_exercises_by_day(all_exercises, user)
-
-            exercise_content, exercise_number = suggest_exercises(
-                user_state['exercises_done'],
-                user_memory,
-                user_state['stage'],
-                day_filtered_exercises
-            )
-
-            if not exercise_content:
-                # Handle case where no more exercises are available for the day
-                response = "به نظر می‌رسه تمام تمرین‌های امروز رو انجام دادی. فردا تمرین‌های جدیدی خواهیم داشت. کارِت عالی بود!"
-                self.transition("THANKS", user)
-                return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-            user_state['exercises_done'].add(exercise_number)
-            response = self.customize_excercises(
-                "suggestion.md", user, exercise_content)
-            explainability = create_exercise_explanation(
-                user_memory, exercise_content)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), explainability, exercise_number
-
-        elif user_state['state'] == "EXERCISE_EXPLANATION":
-            response = self.ask_llm("exercise_explanation.md", message, user)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "FEEDBACK":
-            response = self.ask_llm("feedback.md", message, user)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "LIKE_ANOTHER_EXERCSISE":
-            response = self.ask_llm("like_to_do_another_exc.md", message, user)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "THANKS":
-            response = self.ask_llm("thanks.md", message, user)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
-
-        elif user_state['state'] == "END":
-            response = self.ask_llm("end.md", message, user)
-            return response, create_recommendations(response, self.memory_manager.get_current_memory(user)), None, None
+    def _reply_from_prompt(self, spec, message, user, stream=False):
+        transit = self._judge(spec, user) if spec.judge_in_reply else None
+        response = self.ask_llm(spec.prompt, message, user, transit, stream=stream)
+        return self._reply(response, user)
 
-        else:
-            return "میتونی بیشتر توضیح بدی", [], None, None
+    def _reply_with_suggestion(self, spec, message, user, stream=False):
+        """suggest (2 calls) -> {customize, explain}, the suggestion possibly prefetched"""
+        user_state = self.get_user_state(user)
+        # Resolve ORM reads up front; the planner threads only talk to the LLM
+        inputs = self._suggestion_inputs(user)
+        current_day = self.get_user_day_progress(user)
+        memory_context = self._customization_memory(spec.prompt, user, current_day)
 
-    def execute_state(self, message, user):
+        # Use the suggestion prefetched on entering the previous state if
+        # its inputs still hold, else start it now. A prefetched call that
+        # raises is counted as failed and redone here instead of failing the turn
+        speculation = self.suggestion_prefetch.take(user.id, self._suggestion_fingerprint(inputs))
+        futures = speculation.futures if speculation is not None else self._start_suggestion(*inputs)
+        try:
+            suggestion = futures["suggestion"].result()
+        except Exception as e:
+            if speculation is None:
+                raise
+            self.suggestion_prefetch.failed(speculation, e)
+            speculation = None
+            futures = self._start_suggestion(*inputs)
+            suggestion = futures["suggestion"].result()
+        exercise_content, exercise_number = suggestion
+
+        if not exercise_content:
+            # Handle case where no more exercises are available for the day
+            response = "به نظر می‌رسه تمام تمرین‌های امروز رو انجام دادی. فردا تمرین‌های جدیدی خواهیم داشت. کارِت عالی بود!"
+            self.transition(spec.when_exhausted, user)
+            return self._reply(response, user)
+
+        user_state['exercises_done'].add(exercise_number)
+        # The reply is customized on this thread while the explanation
+        # keeps running; a streamed reply's explanation is joined by stream_state
+        response = self._customize_with_context(
+            spec.prompt, memory_context, current_day, exercise_content, stream=stream)
+        explainability = futures["explainability"]
+        if speculation is not None:
+            explainability = CallPlan().add("explainability", self._prefetched_explanation,
+                                            speculation, suggestion, inputs[1]).start()["explainability"]
+        if not stream:
+            explainability = explainability.result()
+        return self._reply(response, user, explainability, exercise_number)
+
+    def _prefetched_explanation(self, speculation, suggestion, user_memory):
+        """The prefetched explanation, or a new one if its call raised"""
+        try:
+            return speculation.futures["explainability"].result()
+        except Exception as e:
+            self.suggestion_prefetch.failed(speculation, e)
+            return self._explain_suggestion(suggestion, user_memory)
+
+    def _judge(self, spec, user):
+        """The verdict of the state's judge, asked at most once per turn"""
+        verdicts = self.turn_verdicts.setdefault(user.id, {})
+        if spec.judge not in verdicts:
+            verdicts[spec.judge] = self.if_transition(user, spec.judge, with_memory=spec.judge_memory)
+            print("transit", verdicts[spec.judge])
+        return verdicts[spec.judge]
+
+    def _classify(self, spec, message, user):
+        """Run the state's classifier and keep its label in the user state"""
+        label = self.classifiers[spec.classifier](user_message=message, chat_history=self._chat_history_text(user))
+        user_state = self.get_user_state(user)
+        user_state[fsm_spec.CLASSIFIERS[spec.classifier]] = label
+        print(f"user {spec.classifier}={label}")
+        return label
+
+    def _next_state(self, spec, message, user):
+        """Target of the state's first matching transition, computing only what its rules use"""
+        if not spec.transitions:
+            return None
+        verdict = self._judge(spec, user) if spec.judge else None
+        label = self._classify(spec, message, user) if spec.classifier else None
+        count = self.get_user_state(user).get(spec.counter, 0) if spec.counter else 0
+        history_length = len(self.memory_manager.get_chat_history(user)) if spec.needs_history_length else 0
+        for rule in spec.transitions:
+            if rule.matches(verdict, label, count, message, history_length):
+                return rule.target
+        return None
+
+    def _chat_history_text(self, user):
+        return self.memory_manager.get_formatted_session_history(user)
+
+    def _prepare_turn(self, message, user):
+        """
+        Everything that must happen before the reply is generated: merge buffered
+        messages, persist the user message, refresh memory and run the
+        classifier/judge calls that decide the state transition.
+        Returns the (possibly concatenated) message to answer.
+        """
         user_id = user.id
+        self.turn_verdicts.pop(user_id, None)
+        # One read of the conversation serves every prompt of this turn
+        self.memory_manager.begin_turn(user)
+        # Another worker may have handled this user's previous turn
+        self.load_user_state(user)
+        self.repetitions.begin_turn(user)
+
+        # Get any buffered messages and concatenate with current message
+        buffered_messages = self.message_buffer.get_buffered_messages(user_id)
+        if buffered_messages:
+            # Concatenate buffered messages with current message
+            all_messages = buffered_messages + [message]
+            final_message = self.message_buffer.concatenate_messages(all_messages)
+            print(f"Processing concatenated message for user {user_id}: {final_message}")
+        else:
+            final_message = message
 
-        # Check if user is currently being processed
-        if self.message_buffer.is_user_processing(user_id):
-            # Add message to buffer and return None to indicate processing is ongoing
-            self.message_buffer.add_message(user_id, message)
-            return None, None, None, None, None
+        user_state = self.get_user_state(user)
+        metrics.set_fsm_state(user_state['state'])
+        print(f"You are in the {user_state['state']} state")
+
+        # Reset this user's repetition tracking for new sessions
+        if user_state['state'] == "GREETING_FORMALITY_NAME" and user_state['message_count'] == 0:
+            self._check_lease(user)
+            self.repetitions.reset(user)
+
+        # update memory and increment message count with current session ID
+        self._check_lease(user)
+        self.memory_manager.add_message(
+            user=user,
+            text=final_message,
+            is_user=True,
+            session_id=user_state['current_session_id'],
+            state=user_state['state']
+        )
 
-        # Start processing for this user
-        self.message_buffer.start_processing(user_id)
+        # Refresh the memory summary every few messages, off the request path
+        if user_state['message_count'] >= 3:
+            self.memory_manager.schedule_summary(user)
+            user_state['message_count'] = 0
 
-        try:
-            # Get any buffered messages and concatenate with current message
-            buffered_messages = self.message_buffer.get_buffered_messages(user_id)
-            if buffered_messages:
-                # Concatenate buffered messages with current message
-                all_messages = buffered_messages + [message]
-                final_message = self.message_buffer.concatenate_messages(all_messages)
-                print(f"Processing concatenated message for user {user_id}: {final_message}")
-            else:
-                final_message = message
-
-            user_state = self.get_user_state(user)
-            print(f"You are in the {user_state['state']} state")
-
-            # Reset repetition prevention for new sessions
-            if user_state['state'] == "GREETING_FORMALITY_NAME" and user_state['message_count'] == 0:
-                self.repetition_prevention = RepetitionPrevention()
-
-            # update memory and increment message count with current session ID
-            self.memory_manager.add_message(
-                user=user,
-                text=final_message,
-                is_user=True,
-                session_id=user_state['current_session_id'],
-                state=user_state['state']
-            )
-
-            # Check if we need to update memory summary (only for current session)
-            if user_state['message_count'] >= 3:
-                self.memory_manager.update_memory(user)
-                user_state['message_count'] = 0
-
-            if user_state['state'] == "GREETING_FORMALITY_NAME":
-                transit = self.if_transition(user, "greeting.md")
-                print("transit", transit)
-                if "بله" in transit:
-                    self.transition("EMOTION", user)
-
-            elif user_state['state'] == "EMOTION":
-                # Always process emotion state in each session
-                # Track messages in current state
-                if 'emotion_message_count' not in user_state:
-                    user_state['emotion_message_count'] = 0
-                user_state['emotion_message_count'] += 1
-
-                transit = self.if_transition(user, "emotion.md")
-                print("transit", transit)
-                print(f"Emotion messages in current state: {user_state['emotion_message_count']}")
-
-                # Only transition if we have sufficient emotion data AND at least 2 messages in this state
-                if "بله" in transit and user_state['emotion_message_count'] >= 2:
-                    self.transition("EMOTION_DECIDER", user)
-
-            elif user_state['state'] == "SUPER_STATE_EVENT":
-                # Always process event state in each session
-                # Track messages in current state
-                if 'event_message_count' not in user_state:
-                    user_state['event_message_count'] = 0
-                user_state['event_message_count'] += 1
-
-                transit = self.if_transition(user, "event.md")
-                print("transit", transit)
-                print(f"Event messages in current state: {user_state['event_message_count']}")
-
-                # Only transition if we have sufficient event data AND at least 2 messages in this state
-                if "بله" in transit and user_state['event_message_count'] >= 2:
-                    # Check if user wants to explain more (نمیدونی چی شد میخوای تعریف کنم برات)
-                    if "نمیدونی" in message or "تعریف کنم" in message:
-                        self.transition("OPEN_ENDED_CONVERSATION", user)
-                    else:
-                        self.transition("ASK_EXERCISE", user)
-
-            elif user_state['state'] == "OPEN_ENDED_CONVERSATION":
-                # After open-ended conversation, transition to ASK_EXERCISE
-                # Check if conversation has reached a natural end point
-                if len(messages_obj) >= 4:  # After sufficient conversation
-                    self.transition("ASK_EXERCISE", user)
-
-            elif user_state['state'] == "ASK_EXERCISE":
-                messages_obj = self.memory_manager.get_chat_history(user)
-                chat_history = "\n".join([
-                    f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
-                    for msg in messages_obj
-                ])
-                response = self.openai_llm.response_retriever(user_message=message, chat_history=chat_history)
-                self.set_response(response, user)
-                if 'Yes' in user_state['response']:
-                    self.transition("EXERCISE_SUGGESTION", user)
-                else:
-                    self.transition("THANKS", user)
-
-            elif user_state['state'] == "EXERCISE_SUGGESTION":
-                messages_obj = self.memory_manager.get_chat_history(user)
-                chat_history = "\n".join([
-                    f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
-                    for msg in messages_obj
-                ])
-                response = self.openai_llm.response_retriever(user_message=message, chat_history=chat_history)
-                self.set_response(response, user)
-                if 'Yes' in user_state['response']:
-                    self.transition("EXERCISE_EXPLANATION", user)
-                else:
-                    self.transition("LIKE_ANOTHER_EXERCSISE", user)
-
-            elif user_state['state'] == "EXERCISE_EXPLANATION":
-                messages_obj = self.memory_manager.get_chat_history(user)
-                chat_history = "\n".join([
-                    f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
-                    for msg in messages_obj
-                ])
-                response = self.openai_llm.response_retriever(user_message=message, chat_history=chat_history)
-                self.set_response(response, user)
-                if 'Yes' in user_state['response']:
-                    self.transition("FEEDBACK", user)
-                else:
-                    self.transition("LIKE_ANOTHER_EXERCSISE", user)
-
-            elif user_state['state'] == "FEEDBACK":
-                self.transition("LIKE_ANOTHER_EXERCSISE", user)
-
-            elif user_state['state'] == "LIKE_ANOTHER_EXERCSISE":
-                # Use response_retriever to intelligently detect user's intent for another exercise
-                messages_obj = self.memory_manager.get_chat_history(user)
-                chat_history = "\n".join([
-                    f"{'User' if msg.is_user else 'Assistant'}: {msg.text}"
-                    for msg in messages_obj
-                ])
-                response = self.openai_llm.response_retriever(user_message=message, chat_history=chat_history)
-                self.set_response(response, user)
-                if 'Yes' in user_state['response']:
-                    self.transition("EXERCISE_SUGGESTION", user)
-                else:
-                    self.transition("THANKS", user)
+        spec = fsm_spec.STATES.get(user_state['state'])
+        if spec is not None and not spec.decide_on_reply:
+            if spec.counter:
+                user_state[spec.counter] = user_state.get(spec.counter, 0) + 1
+                print(f"Messages in {spec.name}: {user_state[spec.counter]}")
+            next_state = self._next_state(spec, final_message, user)
+            if next_state is not None:
+                self.transition(next_state, user)
 
-            elif user_state['state'] == "THANKS":
-                self.transition("END", user)
+        return final_message
 
-            elif user_state['state'] == "END":
-                print("State machine has reached the end.")
+    def _finish_turn(self, user, response):
+        """Persist the assistant reply and count the turn"""
+        user_state = self.get_user_state(user)
+        # The versioned state save fails if another worker took the user over,
+        # so it goes first and only the turn that still owns the user persists
+        user_state['message_count'] += 1
+        self.save_user_state(user)
+        self.memory_manager.add_message(
+            user=user,
+            text=response,
+            is_user=False,
+            session_id=user_state['current_session_id'],
+            state=user_state['state']
+        )
+        return user_state
+
+    def execute_state(self, message, user):
+        """
+        Answer a user message. Turns of a user run one at a time; messages
+        that arrive during a turn or within the debounce window are merged
+        into the next one, and every request of the batch gets its result.
+        """
+        return self.mailbox.execute(user, message)
+
+    def stream_state(self, message, user):
+        """
+        Streaming variant of execute_state. Yields ("token", text) pairs for the
+        final generation call and then one ("done", result) pair, where result
+        has the same shape as execute_state's return value. The classifier and
+        judge calls finish before the first token; the assembled reply is
+        persisted when the stream ends.
+        """
+        return self.mailbox.run(user, message, stream=True)
+
+    def _acquire_turn(self, user_id, message):
+        """
+        Wait for a turn of this user running in another worker to finish. On
+        TurnTimeout the message is kept for the user's next turn (or
+        /api/process-buffered/) before the error is raised.
+        """
+        try:
+            self.message_buffer.wait_to_start_processing(
+                user_id, getattr(settings, 'MAILBOX_TURN_WAIT_SECONDS', 60))
+        except TurnTimeout:
+            if message:
+                self.message_buffer.add_message(user_id, message)
+            raise
+
+    def _turn(self, message, user, stream=False):
+        """
+        One turn, run by the mailbox: yields ("token", text) pairs when
+        streaming, then ("done", result).
+        """
+        user_id = user.id
+        if not message and not self.message_buffer.has_buffered_messages(user_id):
+            yield "done", (None, None, None, None, None)
+            return
+
+        self._acquire_turn(user_id, message)
+        self.leased_turns.add(user_id)
+        try:
+            final_message = self._prepare_turn(message, user)
 
             response, recommendations, explainibility, excercise_number = self.state_handler(
-                final_message, user)
-            # print(response, recommendations)
+                final_message, user, stream=stream)
+
+            if stream:
+                chunks = [response] if isinstance(response, str) else response
+                parts = []
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield "token", chunk
+                response = "".join(parts)
+
+                if isinstance(explainibility, Future):
+                    explainibility = explainibility.result()
+                if recommendations is None:
+                    recommendations = create_recommendations(response, self.memory_manager.get_current_memory(user))
 
-            self.memory_manager.add_message(
-                user=user,
-                text=response,
-                is_user=False,
-                session_id=user_state['current_session_id'],
-                state=user_state['state']
-            )
-            user_state['message_count'] += 1
+            user_state = self._finish_turn(user, response)
 
-            return response, recommendations, user_state['state'], explainibility, excercise_number
+            yield "done", (response, recommendations, user_state['state'], explainibility, excercise_number)
 
         finally:
             # Always end processing when done
+            self.leased_turns.discard(user_id)
             self.message_buffer.end_processing(user_id)
-
-    def set_emotion(self, emotion, user):
-        user_state = self.get_user_state(user)
-        user_state['emotion'] = emotion
-        print(f'user emotion={user_state["emotion"]}')
-
-    def set_response(self, response, user):
-        user_state = self.get_user_state(user)
-        user_state['response'] = response
-        print(f'user response={user_state["response"]}')
+            self.memory_manager.end_turn(user)
+            self.repetitions.end_turn(user)
+            self.turn_verdicts.pop(user_id, None)
+            metrics.set_fsm_state(None)
+
+    async def aexecute_state(self, message, user):
+        """
+        Async entry point used by the ASGI views. The FSM interleaves ORM access
+        with its LLM calls, which all stay synchronous, so the whole turn runs
+        on the turn executor: each turn in flight holds one of its
+        ASYNC_TURN_WORKERS threads (and a planner thread per concurrent call)
+        and the turns beyond that wait for a free thread.
+        """
+        return await sync_to_async(
+            self.execute_state, thread_sensitive=False, executor=get_turn_executor())(message, user)
 
     def handle_session_end(self, user):
         """Handle cleanup when user ends session"""
-        self.memory_manager.update_memory(user)
-        # Reset user state
-        self.user_states[user.id] = {
-            'state': "GREETING_FORMALITY_NAME",
-            'message_count': 0,
-            'emotion': None,
-            'response': None
-        }
+        self.memory_manager.schedule_summary(user)
+        self.suggestion_prefetch.discard(user.id)
+        # Start the next session from a complete initial state; the exercises
+        # already done stay done so they are not suggested again
+        previous, _ = self.state_store.load(user.id)
+        state = self._initial_user_state(user)
+        if previous and previous.get('exercises_done'):
+            state['exercises_done'] = set(previous['exercises_done'])
+        self.replace_user_state(user, state)
 
     def reset_state_machine(self, user):
         """Reset the state machine to initial state for a specific user"""
-        # Get the next session ID
-        from api.models import Message
-        latest_session = Message.objects.filter(user=user).aggregate(Max('session_id'))['session_id__max']
-        new_session_id = (latest_session or 0) + 1
-
         # Reset user state to initial values with new session
-        self.user_states[user.id] = {
-            'state': "GREETING_FORMALITY_NAME",
-            'message_count': 0,
-            'emotion': None,
-            'response': None,
-            'stage': user.stage,
-            'exercises_done': set(),
-            'current_day': self.get_user_day_progress(user),
-            'current_session_id': new_session_id,
-            'emotion_message_count': 0,
-            'event_message_count': 0
-        }
+        self.replace_user_state(user, self._initial_user_state(user))
+        new_session_id = self.user_states[user.id]['current_session_id']
 
         # Reset repetition prevention for this user
-        # self.repetition_prevention.reset_for_user(user.id)
+        self.repetitions.reset(user)
+        self.suggestion_prefetch.discard(user.id)
 
         # Clear any buffered messages for this user
         self.message_buffer.end_processing(user.id)
+        self.message_buffer.clear_buffer(user.id)
 
         print(f"State machine reset for user {user.id} to initial state with session {new_session_id}")
         return {
@@ -898,32 +823,7 @@ class StateMachine:
         }
 
     def process_buffered_messages(self, user):
-        """Process any buffered messages for a user"""
-        user_id = user.id
-
-        # Check if user is currently being processed
-        if self.message_buffer.is_user_processing(user_id):
+        """Answer messages left in the buffer while another worker kept the user busy"""
+        if not self.message_buffer.has_buffered_messages(user.id):
             return None, None, None, None, None
-
-        # Check if there are buffered messages
-        if not self.message_buffer.has_buffered_messages(user_id):
-            return None, None, None, None, None
-
-        # Start processing for this user
-        self.message_buffer.start_processing(user_id)
-
-        try:
-            # Get all buffered messages
-            buffered_messages = self.message_buffer.get_buffered_messages(user_id)
-            if buffered_messages:
-                final_message = self.message_buffer.concatenate_messages(buffered_messages)
-                print(f"Processing buffered messages for user {user_id}: {final_message}")
-
-                # Process the concatenated message
-                return self.execute_state(final_message, user)
-
-            return None, None, None, None, None
-
-        finally:
-            # Always end processing when done
-            self.message_buffer.end_processing(user_id)
+        return self.execute_state("", user)
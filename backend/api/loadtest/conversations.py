@@ -0,0 +1,15 @@
+# Scripted Persian conversation used by the load test. It walks the
+# intervention FSM from greeting through emotion/event to an exercise and
+# back out; the control and placebo bots just receive the same turns.
+DEFAULT_CONVERSATION = [
+    "سلام، من سارا هستم",
+    "امروز اصلا حال خوبی ندارم",
+    "احساس غم و خستگی می‌کنم و انرژی ندارم",
+    "دیروز با دوستم سر یک موضوع کاری دعوا کردم",
+    "از اینکه حرفم را نفهمید خیلی ناراحت شدم",
+    "آره، دوست دارم یک تمرین انجام بدهم",
+    "باشه، انجامش می‌دهم",
+    "تمرین خوبی بود، کمی آرام‌تر شدم",
+    "نه، ممنون",
+    "خداحافظ",
+]
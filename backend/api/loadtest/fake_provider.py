@@ -0,0 +1,246 @@
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Canned answers keyed on a marker in the system prompt, so scripted
+# conversations move through the FSM the way a real model would steer them.
+CALL_SITES = [
+    ("judge", "اطلاعات استخراج شده مورد نیاز", "بله"),
+    ("emotion_retriever", "identify the user's emotion", "Negative"),
+    ("response_retriever", "identify the user's response", "Yes"),
+    ("exercise_suggestor", "suggest the best three exercises", "1, 3, 5"),
+    ("exercise_decider", "دستیار تصمیم‌گیرندۀ تمرین", "3"),
+]
+DEFAULT_REPLY = "ممنون که با من در میان گذاشتی. می‌خواهی کمی بیشتر درباره‌اش صحبت کنیم؟"
+
+# Prompt caching like OpenAI's: prefixes of at least 1024 tokens, in 128-token steps
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP = 128
+PROMPT_CACHE_MAX_ENTRIES = 100000
+
+
+class LatencyDistribution:
+    """
+    Parsed from "fixed:0.5", "uniform:0.2,1.0" or "lognormal:0.6,0.4"
+    (median seconds, sigma).
+    """
+
+    def __init__(self, spec):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",") if value]
+        if kind == "fixed" and len(self.params) == 1:
+            return
+        if kind in ("uniform", "lognormal") and len(self.params) == 2:
+            return
+        raise ValueError(f"Invalid latency distribution: {spec}")
+
+    def sample(self, rng=random):
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        median, sigma = self.params
+        return rng.lognormvariate(math.log(median), sigma)
+
+
+class FakeProviderConfig:
+    def __init__(self, latency="fixed:0.3", call_latency=None, tokens_per_second=50.0,
+                 error_rate=0.0, error_statuses=(429, 500), stall_rate=0.0, stall_seconds=30.0, seed=None,
+                 scripted_faults=()):
+        self.latency = LatencyDistribution(latency)
+        self.call_latency = {name: LatencyDistribution(spec) for name, spec in (call_latency or {}).items()}
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        # Faults for the next requests, in order: "stall", an HTTP status, or
+        # None for a normal answer. Random rates apply once it is used up.
+        self.scripted_faults = list(scripted_faults)
+
+    def next_scripted_fault(self):
+        with self.rng_lock:
+            if self.scripted_faults:
+                return True, self.scripted_faults.pop(0)
+            return False, None
+
+    def latency_for(self, call_site):
+        distribution = self.call_latency.get(call_site, self.latency)
+        with self.rng_lock:
+            return distribution.sample(self.rng)
+
+    def roll(self, rate):
+        with self.rng_lock:
+            return self.rng.random() < rate
+
+    def error_status(self):
+        with self.rng_lock:
+            return self.rng.choice(self.error_statuses)
+
+
+def classify_call(messages):
+    prompt = "\n".join(message.get("content") or "" for message in messages)
+    for name, marker, reply in CALL_SITES:
+        if marker in prompt:
+            return name, reply
+    return "reply", DEFAULT_REPLY
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        server = self.server
+        config = server.config
+        call_site, reply = classify_call(body.get("messages", []))
+        server.record(call_site)
+
+        scripted, fault = config.next_scripted_fault()
+        if fault == "stall" or (not scripted and config.roll(config.stall_rate)):
+            time.sleep(config.stall_seconds)
+        if isinstance(fault, int) or (not scripted and config.roll(config.error_rate)):
+            status = fault if isinstance(fault, int) else config.error_status()
+            server.record(f"error_{status}")
+            self._send_json(status, {"error": {"message": "Injected failure", "type": "fake_provider"}})
+            return
+
+        time.sleep(config.latency_for(call_site))
+        tokens = reply.split(" ")
+        model = body.get("model", "gpt-4o")
+        # Whitespace words stand in for tokens; good enough for the usage metrics
+        prompt_words = [word for message in body.get("messages", [])
+                        for word in (message.get("content") or "").split()]
+        prompt_tokens = len(prompt_words)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens),
+                 "prompt_tokens_details": {"cached_tokens": server.cached_prefix_tokens(prompt_words)}}
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            self._stream(model, tokens, config.tokens_per_second, usage if include_usage else None)
+        else:
+            if config.tokens_per_second:
+                time.sleep(len(tokens) / config.tokens_per_second)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, model, tokens, tokens_per_second, usage=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        for i, token in enumerate(tokens):
+            if tokens_per_second:
+                time.sleep(1 / tokens_per_second)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token if i == 0 else " " + token}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        if usage is not None:
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    Local OpenAI-compatible chat completions endpoint with injectable latency,
+    token rate, errors and stalls. Point the backend at it with
+    OPENAI_BASE_URL=<server.base_url>.
+    """
+    daemon_threads = True
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeOpenAIHandler)
+        self.config = config or FakeProviderConfig()
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+        self.prompt_prefixes = set()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def handle_error(self, request, client_address):
+        # Clients that time out on a stalled request hang up before we answer
+        pass
+
+    def record(self, name):
+        with self.calls_lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def cached_prefix_tokens(self, words):
+        """Length of the longest cacheable prefix of `words` seen in an earlier prompt"""
+        digest = hashlib.sha1()
+        boundaries = []
+        for start in range(0, len(words) - PROMPT_CACHE_STEP + 1, PROMPT_CACHE_STEP):
+            digest.update(("\x00".join(words[start:start + PROMPT_CACHE_STEP]) + "\x00").encode("utf-8"))
+            end = start + PROMPT_CACHE_STEP
+            if end >= PROMPT_CACHE_MIN_TOKENS:
+                boundaries.append((end, digest.copy().digest()))
+
+        cached = 0
+        with self.calls_lock:
+            for end, key in boundaries:
+                if key in self.prompt_prefixes:
+                    cached = end
+            if len(self.prompt_prefixes) < PROMPT_CACHE_MAX_ENTRIES:
+                self.prompt_prefixes.update(key for _, key in boundaries)
+            self.prompt_tokens += len(words)
+            self.cached_tokens += cached
+        return cached
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
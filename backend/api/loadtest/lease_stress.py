@@ -0,0 +1,104 @@
+# Several worker processes send one user's messages at the same time
+# through DatabaseMessageBuffer against a shared SQLite file. A turn does a
+# deliberately non-atomic read-modify-write of a counter, so any two turns
+# that overlap lose an increment. One extra process takes the lease and
+# dies without releasing it, to exercise stale-lease recovery.
+import multiprocessing
+import os
+import sqlite3
+import time
+
+
+def setup_django(db_path):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = db_path
+    import django
+    django.setup()
+
+
+def prepare_database(db_path, username):
+    setup_django(db_path)
+    from django.core.management import call_command
+    from api.models import User, UserMemoryState
+
+    call_command('migrate', verbosity=0)
+    user = User.objects.create_user(username=username, password='stress')
+    UserMemoryState.objects.create(user=user, current_memory="0")
+    return user.id
+
+
+def crash_holding_lease(db_path, user_id, lease_seconds):
+    setup_django(db_path)
+    from api.bot.message_buffer import DatabaseMessageBuffer
+
+    buffer = DatabaseMessageBuffer(lease_seconds)
+    buffer.try_start_processing(user_id)
+    os._exit(0)  # no release, no heartbeat: the lease must expire on its own
+
+
+def run_worker(db_path, user_id, messages, turn_seconds, lease_seconds, active, max_active, results):
+    setup_django(db_path)
+    from api.bot.message_buffer import DatabaseMessageBuffer
+    from api.models import UserMemoryState
+
+    buffer = DatabaseMessageBuffer(lease_seconds)
+    processed = buffered = 0
+    for i in range(messages):
+        if not buffer.try_start_processing(user_id):
+            buffer.add_message(user_id, f"{os.getpid()}:{i}")
+            buffered += 1
+            time.sleep(turn_seconds * 2)
+            continue
+        try:
+            with active.get_lock():
+                active.value += 1
+                max_active.value = max(max_active.value, active.value)
+            state = UserMemoryState.objects.get(user_id=user_id)
+            count = int(state.current_memory)
+            time.sleep(turn_seconds)  # an LLM call would happen here
+            state.current_memory = str(count + 1)
+            state.save(update_fields=['current_memory'])
+            processed += 1
+            with active.get_lock():
+                active.value -= 1
+        finally:
+            buffer.end_processing(user_id)
+    buffer.stop()
+    results.put((processed, buffered))
+
+
+def run(db_path, workers=4, messages=15, turn_seconds=0.05, lease_seconds=2.0):
+    """
+    Returns {"processed", "buffered", "counter", "max_concurrent"}: with a
+    working lease, counter == processed and max_concurrent == 1.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        user_id = pool.apply(prepare_database, (db_path, 'lease_stress'))
+    crasher = context.Process(target=crash_holding_lease, args=(db_path, user_id, lease_seconds))
+    crasher.start()
+    crasher.join()
+
+    active, max_active = context.Value('i', 0), context.Value('i', 0)
+    results = context.Queue()
+    processes = [
+        context.Process(target=run_worker, args=(db_path, user_id, messages, turn_seconds, lease_seconds,
+                                                 active, max_active, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    totals = [results.get(timeout=120) for _ in processes]
+    for process in processes:
+        process.join()
+
+    with sqlite3.connect(db_path) as connection:
+        counter = int(connection.execute(
+            "SELECT current_memory FROM api_usermemorystate WHERE user_id = ?", (user_id,)).fetchone()[0])
+    return {
+        "processed": sum(processed for processed, _ in totals),
+        "buffered": sum(buffered for _, buffered in totals),
+        "counter": counter,
+        "max_concurrent": max_active.value,
+    }
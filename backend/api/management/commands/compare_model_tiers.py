@@ -0,0 +1,135 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.bot import metrics, model_routing
+from api.bot.gpt_for_comprehension import OpenAILLM
+from api.bot.gpt_for_statedetection import build_judge_prompt
+from api.bot.llm_client import chat_completion
+from api.management.commands.compare_throughput import percentile
+from api.models import Message
+
+# FSM state a user message was sent in -> classifier calls that state makes
+JUDGE_PROMPTS = {
+    "GREETING_FORMALITY_NAME": "greeting.md",
+    "EMOTION": "emotion.md",
+    "SUPER_STATE_EVENT": "event.md",
+}
+RESPONSE_STATES = {"ASK_EXERCISE", "EXERCISE_SUGGESTION", "EXERCISE_EXPLANATION", "LIKE_ANOTHER_EXERCSISE"}
+EMOTION_LABELS = ("Positive", "Negative", "Antisocial")
+
+
+def judge_label(answer):
+    return "بله" if "بله" in answer else "خیر"
+
+
+def emotion_label(answer):
+    return next((label for label in EMOTION_LABELS if label in answer), answer.strip())
+
+
+def response_label(answer):
+    return "Yes" if "Yes" in answer else "No"
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay stored conversations through the classifier call sites (judge, "
+        "emotion and response retrievers) on several model tiers and report "
+        "latency and how often each tier agrees with the reference tier. "
+        "Calls the real provider and bypasses the response cache."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tiers', default='small,large',
+                            help='Comma-separated tiers from settings.LLM_MODEL_TIERS; the last is the reference')
+        parser.add_argument('--sessions', type=int, default=20, help='Most recent sessions to replay')
+        parser.add_argument('--user', help='Only replay this username')
+        parser.add_argument('--max-calls', type=int, default=200, help='Stop after this many replayed decisions')
+        parser.add_argument('--show-disagreements', action='store_true')
+
+    def handle(self, *args, **options):
+        tiers = [tier.strip() for tier in options['tiers'].split(',') if tier.strip()]
+        unknown = [tier for tier in tiers if tier not in model_routing.tiers()]
+        if len(tiers) < 2 or unknown:
+            raise CommandError(f"Need at least two known tiers, got {tiers} (unknown: {unknown})")
+        models = {tier: model_routing.tier_model(tier) for tier in tiers}
+
+        cases = self._collect_cases(options)[:options['max_calls']]
+        if not cases:
+            self.stdout.write("No classifier decisions found in the selected sessions.")
+            return
+
+        results = []  # (call_site, {tier: (label, seconds)}, description)
+        for call_site, messages, labeler, description in cases:
+            answers = {}
+            for tier in tiers:
+                with metrics.llm_call_site(f"tier_report:{call_site}"):
+                    start = time.perf_counter()
+                    answer = chat_completion(messages, model=models[tier], temperature=0.01)
+                answers[tier] = (labeler(answer or ""), time.perf_counter() - start)
+            results.append((call_site, answers, description))
+
+        self._report(tiers, models, results, options['show_disagreements'])
+
+    def _collect_cases(self, options):
+        sessions = Message.objects.values('user_id', 'session_id').distinct()
+        if options['user']:
+            sessions = sessions.filter(user__username=options['user'])
+        sessions = sessions.order_by('-session_id', 'user_id')[:options['sessions']]
+
+        llm = OpenAILLM()
+        cases = []
+        for session in sessions:
+            history = []
+            for message in Message.objects.filter(**session).order_by('timestamp'):
+                line = f"{'User' if message.is_user else 'Assistant'}: {message.text}"
+                if message.is_user and message.state in JUDGE_PROMPTS:
+                    context = "تاریخچه جلسه فعلی:\n" + "\n".join(history + [line])
+                    prompt = build_judge_prompt(JUDGE_PROMPTS[message.state], context)
+                    cases.append(("judge", [{"role": "system", "content": prompt}], judge_label,
+                                  f"{message.state}: {message.text[:60]}"))
+                if message.is_user and message.state == "EMOTION":
+                    system = llm.retriever_system_message("emotion_retriever.md", "\n".join(history))
+                    cases.append(("emotion_retriever", self._messages(system, message.text), emotion_label,
+                                  message.text[:60]))
+                if message.is_user and message.state in RESPONSE_STATES:
+                    system = llm.retriever_system_message("response_retriever.md", "\n".join(history))
+                    cases.append(("response_retriever", self._messages(system, message.text), response_label,
+                                  f"{message.state}: {message.text[:60]}"))
+                history.append(line)
+        return cases
+
+    @staticmethod
+    def _messages(system, user):
+        return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+
+    def _report(self, tiers, models, results, show_disagreements):
+        reference = tiers[-1]
+        self.stdout.write(
+            "Tiers: " + ", ".join(f"{tier}={models[tier]}" for tier in tiers) + f" (reference: {reference})\n"
+        )
+        header = f"{'call site':<20}{'n':>5}"
+        for tier in tiers:
+            header += f"{tier + ' p50':>12}{tier + ' p95':>12}"
+        for tier in tiers[:-1]:
+            header += f"{tier + ' agree':>14}"
+        self.stdout.write(header)
+
+        for call_site in sorted({call_site for call_site, _, _ in results}):
+            rows = [answers for site, answers, _ in results if site == call_site]
+            line = f"{call_site:<20}{len(rows):>5}"
+            for tier in tiers:
+                latencies = [answers[tier][1] for answers in rows]
+                line += f"{statistics.median(latencies):>12.2f}{percentile(latencies, 95):>12.2f}"
+            for tier in tiers[:-1]:
+                agreed = sum(1 for answers in rows if answers[tier][0] == answers[reference][0])
+                line += f"{100 * agreed / len(rows):>13.1f}%"
+            self.stdout.write(line)
+
+        if show_disagreements:
+            self.stdout.write("\nDisagreements:")
+            for call_site, answers, description in results:
+                labels = {tier: answers[tier][0] for tier in tiers}
+                if len(set(labels.values())) > 1:
+                    self.stdout.write(f"- [{call_site}] {description} -> {labels}")
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, AsyncClient
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.bot.Memory import summary_queue
+from api.models import User, UserGroup
+
+# Where each chat's LLM calls are made; the intervention FSM ("message")
+# also calls the provider directly from its classifiers and exercise steps
+SYNC_LLM_CALLS = ['api.bot.gpt.chat_completion', 'api.bot.gpt_for_comprehension.chat_completion',
+                  'api.bot.RAG.llm_excercise_suggestor.chat_completion',
+                  'api.bot.gpt_for_summarization.chat_completion']
+ENDPOINT_GROUPS = {
+    'placebo-chat': UserGroup.PLACEBO,
+    'simple-chat': UserGroup.CONTROL,
+    'message': UserGroup.INTERVENTION,
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of latencies"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare throughput of the sync (WSGI) and async (ASGI) chat endpoints "
+        "against a fake LLM with injected latency. Runs on a throwaway database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Total requests per path')
+        parser.add_argument('--concurrency', type=int, default=100, help='In-flight requests on the async path')
+        parser.add_argument('--threads', type=int, default=8, help='Worker threads on the sync path (gthread workers)')
+        parser.add_argument('--latency', type=float, default=0.5, help='Fake LLM latency in seconds')
+        parser.add_argument('--endpoint', choices=list(ENDPOINT_GROUPS), default='placebo-chat',
+                            help='"message" runs the intervention FSM, on ASYNC_TURN_WORKERS threads when async')
+
+    def handle(self, *args, **options):
+        # Same environment the test runner uses (testserver host, no query logging)
+        setup_test_environment(debug=False)
+        db_dir = tempfile.mkdtemp(prefix='sat-throughput-')
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(db_dir, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            tokens = self._create_users(options['concurrency'], ENDPOINT_GROUPS[options['endpoint']])
+            latency = options['latency']
+
+            def fake_llm(*args, **kwargs):
+                time.sleep(latency)
+                return "پاسخ آزمایشی"
+
+            async def afake_llm(*args, **kwargs):
+                await asyncio.sleep(latency)
+                return "پاسخ آزمایشی"
+
+            with ExitStack() as stack:
+                for target in SYNC_LLM_CALLS:
+                    stack.enter_context(patch(target, fake_llm))
+                stack.enter_context(patch('api.bot.gpt.achat_completion', afake_llm))
+                sync_result = self._run_sync(options, tokens)
+                async_result = asyncio.run(self._run_async(options, tokens))
+                # Memory summaries the turns scheduled must finish before the database goes
+                queue = summary_queue.get_queue()
+                if isinstance(queue, summary_queue.LocalSummaryQueue):
+                    queue.wait()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self._report(options, [("WSGI (sync)", sync_result), ("ASGI (async)", async_result)])
+
+    def _create_users(self, count, group):
+        users = User.objects.bulk_create([
+            User(username=f'bench_user_{i}', group=group) for i in range(count)
+        ])
+        return [str(RefreshToken.for_user(user).access_token) for user in users]
+
+    def _run_sync(self, options, tokens):
+        path = f"/api/{options['endpoint']}/"
+
+        def one_request(i):
+            client = Client()
+            start = time.perf_counter()
+            response = client.post(
+                path, {'text': 'سلام'}, content_type='application/json',
+                HTTP_AUTHORIZATION=f'Bearer {tokens[i % len(tokens)]}',
+            )
+            return time.perf_counter() - start, response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            results = list(pool.map(one_request, range(options['requests'])))
+        return time.perf_counter() - start, results
+
+    async def _run_async(self, options, tokens):
+        path = f"/api/async/{options['endpoint']}/"
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def one_request(i):
+            async with semaphore:
+                client = AsyncClient()
+                start = time.perf_counter()
+                response = await client.post(
+                    path, {'text': 'سلام'}, content_type='application/json',
+                    headers={'Authorization': f'Bearer {tokens[i % len(tokens)]}'},
+                )
+                return time.perf_counter() - start, response.status_code
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one_request(i) for i in range(options['requests'])))
+        return time.perf_counter() - start, results
+
+    def _report(self, options, rows):
+        self.stdout.write(
+            f"{options['requests']} requests to {options['endpoint']}, fake LLM latency {options['latency']}s, "
+            f"{options['threads']} WSGI threads vs {options['concurrency']} async in-flight\n"
+        )
+        self.stdout.write(f"{'path':<14}{'req/s':>9}{'p50':>9}{'p95':>9}{'max':>9}{'errors':>8}")
+        for name, (elapsed, results) in rows:
+            latencies = [latency for latency, _ in results]
+            errors = sum(1 for _, status in results if status != 200)
+            self.stdout.write(
+                f"{name:<14}{len(results) / elapsed:>9.1f}"
+                f"{statistics.median(latencies):>9.3f}{percentile(latencies, 95):>9.3f}"
+                f"{max(latencies):>9.3f}{errors:>8}"
+            )
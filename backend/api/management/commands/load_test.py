@@ -0,0 +1,238 @@
+import contextlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from api.bot import llm_client
+from api.bot.cache import ResponseCache
+from api.loadtest.conversations import DEFAULT_CONVERSATION
+from api.loadtest.fake_provider import FakeOpenAIServer, FakeProviderConfig
+from api.management.commands.compare_throughput import percentile
+from api.models import User, UserGroup
+
+ENDPOINT_GROUPS = {
+    'message': UserGroup.INTERVENTION,
+    'simple-chat': UserGroup.CONTROL,
+    'placebo-chat': UserGroup.PLACEBO,
+}
+PASSWORD = 'load-test-password'
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive scripted multi-turn conversations for N virtual users against the "
+        "backend, with every LLM call answered by a local fake OpenAI-compatible "
+        "server. Reports p50/p95/p99 latency and throughput per endpoint and FSM state."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='Concurrent virtual users')
+        parser.add_argument('--endpoints', default='message,simple-chat,placebo-chat',
+                            help='Comma-separated endpoints; users are spread across them round-robin')
+        parser.add_argument('--script', help='JSON file with a list of user turns (defaults to a built-in conversation)')
+        parser.add_argument('--think-time', type=float, default=0.0, help='Pause between turns of one user (seconds)')
+        parser.add_argument('--timeout', type=float, default=120.0, help='Per-request client timeout (seconds)')
+        parser.add_argument('--target', help='Base URL of an already running backend; it must use the fake provider '
+                                             '(start it with OPENAI_BASE_URL printed by this command)')
+        # Fake provider knobs
+        parser.add_argument('--latency', default='lognormal:0.8,0.4',
+                            help='Default LLM latency: fixed:S | uniform:A,B | lognormal:MEDIAN,SIGMA')
+        parser.add_argument('--call-latency', action='append', default=[], metavar='CALL=SPEC',
+                            help='Per call-site latency, e.g. judge=fixed:0.3 (judge, emotion_retriever, '
+                                 'response_retriever, exercise_suggestor, exercise_decider, reply)')
+        parser.add_argument('--tokens-per-second', type=float, default=50.0, help='Simulated generation speed')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of LLM calls that fail')
+        parser.add_argument('--error-statuses', default='429,500', help='HTTP statuses used for injected failures')
+        parser.add_argument('--stall-rate', type=float, default=0.0, help='Fraction of LLM calls that hang first')
+        parser.add_argument('--stall-seconds', type=float, default=30.0)
+        parser.add_argument('--provider-port', type=int, default=0, help='Port for the fake provider (0 = any)')
+        parser.add_argument('--seed', type=int, help='Seed for latency/error sampling')
+
+    def handle(self, *args, **options):
+        endpoints = [endpoint.strip() for endpoint in options['endpoints'].split(',') if endpoint.strip()]
+        unknown = set(endpoints) - set(ENDPOINT_GROUPS)
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+        conversation = self._load_conversation(options['script'])
+
+        try:
+            call_latency = dict(item.split('=', 1) for item in options['call_latency'])
+            config = FakeProviderConfig(
+                latency=options['latency'],
+                call_latency=call_latency,
+                tokens_per_second=options['tokens_per_second'],
+                error_rate=options['error_rate'],
+                error_statuses=[int(status) for status in options['error_statuses'].split(',')],
+                stall_rate=options['stall_rate'],
+                stall_seconds=options['stall_seconds'],
+                seed=options['seed'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        provider = FakeOpenAIServer(config, port=options['provider_port']).start()
+        self.stdout.write(f"Fake LLM provider listening on OPENAI_BASE_URL={provider.base_url}")
+        try:
+            if options['target']:
+                base_url = options['target'].rstrip('/')
+                elapsed, results = self._run(base_url, endpoints, conversation, options)
+            else:
+                elapsed, results = self._run_in_process(provider, endpoints, conversation, options)
+        finally:
+            provider.stop()
+
+        self._report(options, endpoints, elapsed, results, provider.calls)
+        if provider.prompt_tokens:
+            self.stdout.write(
+                f"Prompt tokens served from the simulated prefix cache: "
+                f"{100 * provider.cached_tokens / provider.prompt_tokens:.1f}% "
+                f"({provider.cached_tokens}/{provider.prompt_tokens})"
+            )
+
+    def _load_conversation(self, path):
+        if not path:
+            return DEFAULT_CONVERSATION
+        with open(path, 'r', encoding='utf-8') as f:
+            turns = json.load(f)
+        if not isinstance(turns, list) or not all(isinstance(turn, str) for turn in turns):
+            raise CommandError("--script must contain a JSON list of strings")
+        return turns
+
+    def _run_in_process(self, provider, endpoints, conversation, options):
+        """Serve the project on a throwaway database, wired to the fake provider"""
+        setup_test_environment(debug=False)
+        db_dir = tempfile.mkdtemp(prefix='sat-loadtest-')
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(db_dir, 'loadtest.sqlite3')
+        connection.settings_dict.setdefault('OPTIONS', {}).setdefault('timeout', 30)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        saved_env = {key: os.environ.get(key) for key in ('OPENAI_BASE_URL', 'OPENAI_API_KEY')}
+        os.environ['OPENAI_BASE_URL'] = provider.base_url
+        os.environ['OPENAI_API_KEY'] = 'load-test'
+        saved_client, saved_cache = llm_client._client, llm_client._response_cache
+        llm_client._client = None
+        # Keep fake answers out of the real classifier cache
+        llm_client._response_cache = ResponseCache(os.path.join(db_dir, 'llm_cache.sqlite3'))
+
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+        server.set_app(get_wsgi_application())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self._create_users(endpoints, options['users'])
+            base_url = f"http://localhost:{server.server_address[1]}"
+            # The FSM prints every transition; keep the report readable
+            quiet = contextlib.redirect_stdout(io.StringIO()) if options['verbosity'] < 2 else contextlib.nullcontext()
+            with quiet:
+                return self._run(base_url, endpoints, conversation, options, register=False)
+        finally:
+            server.shutdown()
+            server.server_close()
+            llm_client._client, llm_client._response_cache = saved_client, saved_cache
+            for key, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _create_users(self, endpoints, count):
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username=self._username(i), password=password,
+                 group=ENDPOINT_GROUPS[endpoints[i % len(endpoints)]])
+            for i in range(count)
+        ])
+
+    @staticmethod
+    def _username(i):
+        return f'load_user_{i}'
+
+    def _run(self, base_url, endpoints, conversation, options, register=True):
+        def virtual_user(i):
+            endpoint = endpoints[i % len(endpoints)]
+            records = []
+            with httpx.Client(base_url=base_url, timeout=options['timeout']) as client:
+                credentials = {'username': self._username(i), 'password': PASSWORD}
+                if register:
+                    # Re-runs against the same server reuse existing accounts
+                    client.post('/api/register/', json={**credentials, 'group': ENDPOINT_GROUPS[endpoint].value})
+                response = client.post('/api/login/', json=credentials)
+                if response.status_code != 200:
+                    return [(endpoint, 'LOGIN', 0.0, response.status_code)]
+                headers = {'Authorization': f"Bearer {response.json()['access']}"}
+
+                for turn in conversation:
+                    start = time.perf_counter()
+                    try:
+                        response = client.post(f'/api/{endpoint}/', json={'text': turn}, headers=headers)
+                        status = response.status_code
+                    except httpx.HTTPError:
+                        response, status = None, 0
+                    latency = time.perf_counter() - start
+                    records.append((endpoint, self._state_label(endpoint, response), latency, status))
+                    if options['think_time']:
+                        time.sleep(options['think_time'])
+            return records
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['users']) as pool:
+            per_user = list(pool.map(virtual_user, range(options['users'])))
+        return time.perf_counter() - start, [record for records in per_user for record in records]
+
+    @staticmethod
+    def _state_label(endpoint, response):
+        """FSM state that answered the turn (only the intervention bot reports one)"""
+        if response is None:
+            return 'TIMEOUT'
+        if endpoint != 'message':
+            return '-'
+        try:
+            return response.json().get('state') or 'ERROR'
+        except ValueError:
+            return 'ERROR'
+
+    def _report(self, options, endpoints, elapsed, results, provider_calls):
+        turns = [record for record in results if record[1] != 'LOGIN']
+        self.stdout.write(
+            f"\n{options['users']} users x {len(self._load_conversation(options['script']))} turns over "
+            f"{', '.join(endpoints)} in {elapsed:.1f}s -> {len(turns) / elapsed:.2f} turns/s\n"
+        )
+        self.stdout.write(
+            f"{'endpoint':<14}{'state':<26}{'n':>6}{'err':>6}{'turns/s':>9}{'p50':>8}{'p95':>8}{'p99':>8}"
+        )
+        groups = {}
+        for endpoint, state, latency, status in results:
+            groups.setdefault((endpoint, state), []).append((latency, status))
+        for endpoint in endpoints:
+            endpoint_groups = sorted((key, value) for key, value in groups.items() if key[0] == endpoint)
+            for (_, state), rows in endpoint_groups:
+                latencies = [latency for latency, _ in rows]
+                errors = sum(1 for _, status in rows if status not in (200, 202))
+                self.stdout.write(
+                    f"{endpoint:<14}{state:<26}{len(rows):>6}{errors:>6}{len(rows) / elapsed:>9.2f}"
+                    f"{statistics.median(latencies):>8.2f}{percentile(latencies, 95):>8.2f}"
+                    f"{percentile(latencies, 99):>8.2f}"
+                )
+        self.stdout.write("\nFake provider calls: " + ", ".join(
+            f"{name}={count}" for name, count in sorted(provider_calls.items())
+        ))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.bot.Memory.summary_queue import DatabaseSummaryQueue
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued memory summarization jobs (SUMMARY_QUEUE_BACKEND=database). "
+        "Several workers may run side by side; each job is claimed by one of them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the pending jobs and exit')
+        parser.add_argument('--batch', type=int, default=10, help='Jobs claimed per poll')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        queue = DatabaseSummaryQueue()
+        self.stdout.write(f"Summary worker {queue.worker_id} started")
+        while True:
+            ran = queue.run_pending(options['batch'])
+            if options['once'] and not ran:
+                return
+            if not ran:
+                time.sleep(options['poll'])
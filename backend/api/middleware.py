@@ -0,0 +1,22 @@
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from api.bot.resilience import deadline, REQUEST_BUDGET
+
+
+@sync_and_async_middleware
+def llm_deadline_middleware(get_response):
+    """
+    Give each request one LLM time budget, shared by all the calls its turn
+    makes (see api.bot.resilience). Streamed bodies are produced after the
+    view returns, so their calls fall back to the per-attempt timeouts.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            with deadline(REQUEST_BUDGET):
+                return await get_response(request)
+    else:
+        def middleware(request):
+            with deadline(REQUEST_BUDGET):
+                return get_response(request)
+    return middleware
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_alter_user_group'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRepetitionState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='repetition_state', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_userrepetitionstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserFSMState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.JSONField(default=dict)),
+                ('version', models.IntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='fsm_state', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -63,6 +63,60 @@ class UserMemoryState(models.Model):
         return f"Memory state for {self.user.username}"
 
 
+class UserTurnLease(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="turn_lease")
+    owner = models.CharField(max_length=200, blank=True, default="")  # Token of the worker processing the user
+    expires_at = models.DateTimeField()  # The lease is free after this unless renewed
+
+    def __str__(self):
+        return f"Turn lease for {self.user.username}: {self.owner or 'free'}"
+
+
+class BufferedMessage(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="buffered_messages")
+    text = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user.username}: {self.text[:30]} (buffered)"
+
+
+class UserFSMState(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="fsm_state")
+    data = models.JSONField(default=dict)  # FSM state, counters, exercises done and session id
+    version = models.IntegerField(default=1)  # Bumped on every save, for optimistic concurrency
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"FSM state for {self.user.username}: {self.data.get('state')} (v{self.version})"
+
+
+class UserRepetitionState(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="repetition_state")
+    data = models.JSONField(default=dict)  # Recent phrases per category and overused word counts
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Repetition state for {self.user.username}"
+
+
+class SummaryJob(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="summary_job")
+    requested_at = models.DateTimeField()  # Latest trigger; a newer one during a run means run again
+    claimed_by = models.CharField(max_length=200, blank=True, default="")  # Worker running the job
+    claimed_until = models.DateTimeField(null=True, blank=True)  # Another worker may retry it after this
+    attempts = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Summary job for {self.user.username}"
+
+
+def program_day(start_date, today):
+    """Program day on `today` of a user who started on `start_date` (day 1), capped at day 8"""
+    days_passed = (today - start_date).days + 1
+    return min(days_passed, 8)
+
+
 class UserDayProgress(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="day_progress")
     start_date = models.DateField(auto_now_add=True)  # First interaction date
@@ -75,10 +129,10 @@ class UserDayProgress(models.Model):
     def calculate_current_day(self):
         """Calculate current day based on calendar days since start"""
         from django.utils import timezone
-        today = timezone.now().date()
-        days_passed = (today - self.start_date).days + 1  # +1 because day 1 is the start date
+        current_day = program_day(self.start_date, timezone.now().date())
 
-        # Cap at day 8
-        self.current_day = min(days_passed, 8)
-        self.save()
+        # The row is written only when the day moves on
+        if current_day != self.current_day:
+            self.current_day = current_day
+            self.save(update_fields=['current_day', 'last_updated'])
         return self.current_day
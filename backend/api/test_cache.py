@@ -0,0 +1,116 @@
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+from unittest.mock import patch, MagicMock
+
+from api.bot.cache import LRUCache, MISSING, ResponseCache, response_cache_key
+from api.bot import gpt_for_statedetection, llm_client, resilience
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    """Test the bounded LRU/TTL cache"""
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        cache = LRUCache(maxsize=2, ttl=10)
+        with patch('api.bot.cache.time.monotonic', return_value=100.0):
+            cache.set("a", 1)
+        with patch('api.bot.cache.time.monotonic', return_value=105.0):
+            self.assertEqual(cache.get("a"), 1)
+        with patch('api.bot.cache.time.monotonic', return_value=111.0):
+            self.assertIs(cache.get("a"), MISSING)
+
+
+class JudgeCacheTestCase(SimpleTestCase):
+    """Test that the state-transition judge is memoized"""
+
+    def setUp(self):
+        gpt_for_statedetection.judge_cache.clear()
+
+    @patch('api.bot.gpt_for_statedetection.openai_req_generator')
+    def test_identical_judge_calls_hit_cache(self, mock_openai):
+        mock_openai.return_value = "بله"
+
+        first = gpt_for_statedetection.if_data_sufficient_for_state_change("greeting.md", "User: سلام")
+        second = gpt_for_statedetection.if_data_sufficient_for_state_change("greeting.md", "User: سلام")
+
+        self.assertEqual(first, second)
+        mock_openai.assert_called_once()
+
+    @patch('api.bot.gpt_for_statedetection.openai_req_generator')
+    def test_different_context_or_prompt_misses(self, mock_openai):
+        mock_openai.return_value = "خیر"
+
+        gpt_for_statedetection.if_data_sufficient_for_state_change("greeting.md", "User: سلام")
+        gpt_for_statedetection.if_data_sufficient_for_state_change("greeting.md", "User: سلام خوبی")
+        gpt_for_statedetection.if_data_sufficient_for_state_change("emotion.md", "User: سلام")
+
+        self.assertEqual(mock_openai.call_count, 3)
+
+
+class ResponseCacheTestCase(SimpleTestCase):
+    """Test the persistent classifier response cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.sqlite3")
+        resilience.provider_breaker.reset()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_ignores_whitespace_but_not_model_or_temperature(self):
+        messages = [{"role": "system", "content": "تشخیص  احساس\n"}]
+        same = [{"role": "system", "content": "تشخیص احساس"}]
+
+        self.assertEqual(response_cache_key("gpt-4o-mini", 0.01, messages),
+                         response_cache_key("gpt-4o-mini", 0.01, same))
+        self.assertNotEqual(response_cache_key("gpt-4o-mini", 0.01, messages),
+                            response_cache_key("gpt-4o", 0.01, messages))
+        self.assertNotEqual(response_cache_key("gpt-4o-mini", 0.01, messages),
+                            response_cache_key("gpt-4o-mini", 0.7, messages))
+
+    def test_entries_survive_a_new_instance(self):
+        ResponseCache(self.path).set("k", "غمگین")
+
+        reopened = ResponseCache(self.path)
+        self.assertEqual(reopened.get("k"), "غمگین")
+        self.assertEqual(reopened.get("k"), "غمگین")
+        self.assertEqual(reopened.stats()["disk_hits"], 1)
+        self.assertEqual(reopened.stats()["memory_hits"], 1)
+
+    def test_disk_store_evicts_least_recently_used(self):
+        cache = ResponseCache(self.path, memory_size=1, max_rows=10)
+        for i in range(11):
+            cache.set(f"k{i}", str(i))
+
+        reopened = ResponseCache(self.path)
+        self.assertIs(reopened.get("k0"), MISSING)
+        self.assertEqual(reopened.get("k10"), "10")
+        self.assertGreater(cache.stats()["disk_evictions"], 0)
+
+    def test_chat_completion_caches_only_when_opted_in(self):
+        fake_client = MagicMock()
+        fake_client.chat.completions.create.return_value.choices = [
+            MagicMock(message=MagicMock(content="خشم"))
+        ]
+        messages = [{"role": "user", "content": "عصبانی ام"}]
+        with patch.object(llm_client, 'get_client', return_value=fake_client), \
+                patch.object(llm_client, 'get_response_cache', return_value=ResponseCache(self.path)):
+            llm_client.chat_completion(messages, cache=True)
+            llm_client.chat_completion(messages, cache=True)
+            self.assertEqual(fake_client.chat.completions.create.call_count, 1)
+
+            llm_client.chat_completion(messages)
+            self.assertEqual(fake_client.chat.completions.create.call_count, 2)
@@ -0,0 +1,55 @@
+import time
+
+from django.test import SimpleTestCase
+
+from api.bot.call_planner import CallPlan
+
+
+class CallPlanTestCase(SimpleTestCase):
+    """Test the per-turn LLM call planner"""
+
+    def test_dependencies_receive_results(self):
+        """Test that dependent nodes get their inputs' results positionally"""
+        plan = CallPlan()
+        plan.add("suggestion", lambda: ("content", "2a"))
+        plan.add("response", lambda suggestion, prefix: prefix + suggestion[0], "customized-", inputs=["suggestion"])
+
+        results = plan.run()
+
+        self.assertEqual(results["response"], "customized-content")
+        self.assertEqual(plan.critical_path(), 2)
+
+    def test_independent_calls_run_concurrently(self):
+        """Test that siblings of one node overlap instead of running back to back"""
+        def slow(value, delay=0.2):
+            time.sleep(delay)
+            return value
+
+        plan = CallPlan()
+        plan.add("suggestion", slow, "s")
+        plan.add("response", slow, inputs=["suggestion"])
+        plan.add("explainability", slow, inputs=["suggestion"])
+
+        start = time.perf_counter()
+        results = plan.run()
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(results, {"suggestion": "s", "response": "s", "explainability": "s"})
+        self.assertLess(elapsed, 0.55)  # critical path is 2 calls, not 3
+
+    def test_errors_propagate(self):
+        """Test that a failing node surfaces its exception to the caller"""
+        def fail():
+            raise RuntimeError("provider down")
+
+        plan = CallPlan()
+        plan.add("judge", fail)
+        plan.add("reply", lambda judge: judge, inputs=["judge"])
+
+        with self.assertRaises(RuntimeError):
+            plan.run()
+
+    def test_unknown_dependency_rejected(self):
+        """Test that nodes must be declared after their inputs"""
+        with self.assertRaises(ValueError):
+            CallPlan().add("reply", lambda judge: judge, inputs=["judge"])
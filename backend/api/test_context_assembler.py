@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from api.bot import context_assembler
+from api.bot.context_assembler import assemble, count_tokens
+from api.bot.utils import StateMachine
+from api.models import User
+
+
+def message(id, text, is_user=True):
+    return SimpleNamespace(id=id, text=text, is_user=is_user, timestamp=float(id))
+
+
+class ContextAssemblerTestCase(SimpleTestCase):
+    """Test deduplication and budgeted truncation of the conversation context"""
+
+    def setUp(self):
+        self.turns = [message(i, f"پیام شماره {i} " * 5, is_user=i % 2 == 0) for i in range(1, 11)]
+
+    def test_overlapping_spans_are_used_once_in_order(self):
+        unprocessed, session = self.turns[6:], self.turns[::-1]
+        context = assemble("خلاصه", [unprocessed, session], budget=10000)
+
+        self.assertEqual(context.turns, [context_assembler.format_turn(m) for m in self.turns])
+        self.assertEqual(context.dropped, {})
+        self.assertEqual(context.text.count("پیام شماره 8 "), 5)
+
+    def test_older_turns_are_dropped_before_memory(self):
+        memory = "نام کاربر: سارا"
+        per_turn = count_tokens(context_assembler.format_turn(self.turns[-1])) + 1
+        budget = count_tokens("RULES") + count_tokens(memory) + 3 * per_turn
+
+        context = assemble(memory, [self.turns], budget, fixed_text="RULES")
+
+        self.assertEqual(context.memory, memory)
+        self.assertEqual(context.turns, [context_assembler.format_turn(m) for m in self.turns[-3:]])
+        self.assertEqual(context.dropped, {"turns": 7})
+        self.assertIn("7 پیام قدیمی‌تر", context.text)
+        self.assertLessEqual(context.tokens, budget)
+
+    def test_memory_is_truncated_when_rules_leave_no_room(self):
+        memory = "اطلاعات " * 200
+        budget = count_tokens("RULES") + 50
+
+        context = assemble(memory, [self.turns], budget, fixed_text="RULES")
+
+        self.assertEqual(context.turns, [])
+        self.assertTrue(memory.startswith(context.memory))
+        self.assertLessEqual(count_tokens(context.memory), 50)
+        self.assertGreater(context.dropped["memory_tokens"], 0)
+        self.assertEqual(context.dropped["turns"], 10)
+
+
+class AskLLMContextTestCase(TestCase):
+    """Test that ask_llm sends each session message once"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='context_user', password='testpass')
+        self.state_machine = StateMachine()
+        session_id = self.state_machine.get_user_state(self.user)['current_session_id']
+        for i, text in enumerate(["سلام، اسمم ساراست", "سلام سارا!", "امروز خیلی خسته‌ام"]):
+            self.state_machine.memory_manager.add_message(self.user, text, is_user=i % 2 == 0, session_id=session_id)
+
+    @patch('api.bot.utils.openai_req_generator', return_value="پاسخ")
+    def test_unprocessed_messages_are_not_repeated(self, mock_llm):
+        self.state_machine.ask_llm("open_ended_conversation.md", "امروز خیلی خسته‌ام", self.user)
+
+        system_prompt = mock_llm.call_args.kwargs['system_prompt']
+        self.assertEqual(system_prompt.count("User: سلام، اسمم ساراست"), 1)
+        self.assertEqual(system_prompt.count("Assistant: سلام سارا!"), 1)
@@ -0,0 +1,89 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.bot.Memory.LLM_Memory import MemoryManager
+from api.bot.utils import StateMachine
+from api.models import User, UserDayProgress
+
+
+def message_selects(queries):
+    return [q['sql'] for q in queries if q['sql'].startswith('SELECT') and 'FROM "api_message"' in q['sql']]
+
+
+def table_queries(queries, verb, table):
+    return [q['sql'] for q in queries if q['sql'].startswith(verb) and f'"{table}"' in q['sql']]
+
+
+class ConversationContextTestCase(TestCase):
+    """Test that a turn reads the conversation once and serves it from memory"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='context_user', password='testpass')
+        self.state_machine = StateMachine()
+        self.session_id = self.state_machine.get_user_state(self.user)['current_session_id']
+        for i, text in enumerate(["سلام", "سلام! اسمت چیه؟", "سارا هستم", "خوشبختم سارا"]):
+            self.state_machine.memory_manager.add_message(
+                self.user, text, is_user=i % 2 == 0, session_id=self.session_id)
+
+    @patch('api.bot.utils.create_recommendations', return_value=[])
+    @patch('api.bot.utils.openai_req_generator', return_value="چه خوب!")
+    @patch('api.bot.utils.if_data_sufficient_for_state_change', return_value="خیر")
+    def test_turn_reads_messages_once(self, mock_judge, mock_llm, mock_recommendations):
+        with CaptureQueriesContext(connection) as queries:
+            response, _, state, _, _ = self.state_machine.execute_state("امروز حالم خوب نیست", self.user)
+
+        self.assertEqual(response, "چه خوب!")
+        self.assertEqual(len(message_selects(queries.captured_queries)), 1, message_selects(queries.captured_queries))
+        # The judge saw the message written during the turn
+        self.assertIn("User: امروز حالم خوب نیست", mock_judge.call_args[0][1])
+
+    def test_messages_written_during_a_turn_are_appended(self):
+        manager = MemoryManager()
+        context = self.state_machine.memory_manager.begin_turn(self.user)
+        try:
+            self.assertEqual(len(context.chat_history(self.session_id)), 4)
+            before = manager.get_formatted_session_history(self.user, self.session_id)
+            with CaptureQueriesContext(connection) as queries:
+                manager.add_message(self.user, "پیام جدید", session_id=self.session_id)
+                after = manager.get_formatted_session_history(self.user, self.session_id)
+        finally:
+            self.state_machine.memory_manager.end_turn(self.user)
+
+        self.assertEqual(after, before + "\nUser: پیام جدید")
+        self.assertEqual(message_selects(queries.captured_queries), [])
+        self.assertEqual(len(manager.get_chat_history(self.user)), 5)
+
+    @patch('api.bot.utils.create_recommendations', return_value=[])
+    @patch('api.bot.utils.openai_req_generator', return_value="چه خوب!")
+    @patch('api.bot.utils.if_data_sufficient_for_state_change', return_value="خیر")
+    def test_turn_reads_day_progress_and_memory_state_once(self, mock_judge, mock_llm, mock_recommendations):
+        self.state_machine.execute_state("سلام دوباره", self.user)  # first turn creates the rows
+        with CaptureQueriesContext(connection) as queries:
+            self.state_machine.execute_state("امروز حالم خوب نیست", self.user)
+
+        captured = queries.captured_queries
+        self.assertEqual(len(table_queries(captured, 'SELECT', 'api_userdayprogress')), 1)
+        self.assertEqual(len(table_queries(captured, 'SELECT', 'api_usermemorystate')), 1)
+        self.assertEqual(table_queries(captured, 'UPDATE', 'api_userdayprogress'), [])
+
+
+class DayProgressTestCase(TestCase):
+    """Test that the program day is written only when it changes"""
+
+    def test_day_is_saved_once_per_change(self):
+        user = User.objects.create_user(username='day_user', password='testpass')
+        progress = UserDayProgress.objects.create(user=user)
+        UserDayProgress.objects.filter(pk=progress.pk).update(start_date=timezone.now().date() - timedelta(days=2))
+        progress.refresh_from_db()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(progress.calculate_current_day(), 3)
+            self.assertEqual(progress.calculate_current_day(), 3)
+
+        self.assertEqual(len(table_queries(queries.captured_queries, 'UPDATE', 'api_userdayprogress')), 1)
+        self.assertEqual(UserDayProgress.objects.get(pk=progress.pk).current_day, 3)
@@ -0,0 +1,37 @@
+from datetime import date
+
+from django.test import SimpleTestCase
+
+from api.bot.RAG import exercise_schedule
+from api.models import program_day
+
+
+def numbers(exercise_list):
+    return [exercise["Exercise Number"] for exercise in exercise_list]
+
+
+class ExerciseScheduleTestCase(SimpleTestCase):
+    """Test the per-day exercise index shared by both bots"""
+
+    def test_first_day_opens_the_introduction_and_three_exercises(self):
+        self.assertEqual(numbers(exercise_schedule.exercises_for_day(1)),
+                         ["0.1", "0.2", "0.3", "0.4", "1", "2a", "2b", "3"])
+
+    def test_each_day_opens_three_more(self):
+        day_two = numbers(exercise_schedule.exercises_for_day(2))
+
+        self.assertIn("6", day_two)
+        self.assertNotIn("7a", day_two)
+        self.assertEqual(exercise_schedule.exercises_for_day(8), exercise_schedule.exercises)
+
+    def test_unknown_days_fall_back_to_the_first(self):
+        self.assertEqual(exercise_schedule.exercises_for_day(0), exercise_schedule.exercises_for_day(1))
+        self.assertEqual(exercise_schedule.exercises_for_day(12), exercise_schedule.exercises)
+
+    def test_base_numbers(self):
+        self.assertEqual([exercise_schedule.base_number(n) for n in ("0.3", "2a", "16b", "21")], [0, 2, 16, 21])
+
+    def test_program_day_counts_from_the_start_date(self):
+        self.assertEqual(program_day(date(2024, 3, 1), date(2024, 3, 1)), 1)
+        self.assertEqual(program_day(date(2024, 3, 1), date(2024, 3, 4)), 4)
+        self.assertEqual(program_day(date(2024, 3, 1), date(2024, 4, 1)), 8)
@@ -0,0 +1,80 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from api.bot import fsm_spec, prompt_layout, prompt_registry
+from api.bot.fsm_spec import StateSpec, Transition, compile_states
+from api.bot.utils import StateMachine
+from api.models import User
+
+
+class StateTableTestCase(SimpleTestCase):
+    """Test the declarative FSM table"""
+
+    def test_every_prompt_of_the_table_exists(self):
+        for spec in fsm_spec.STATES.values():
+            for prompt in filter(None, [spec.prompt, spec.judge]):
+                self.assertTrue(prompt_registry.get(f'Prompts/{prompt}').text, f"{spec.name}: {prompt}")
+
+    def test_inconsistent_tables_are_rejected(self):
+        with self.assertRaises(ValueError):
+            compile_states([StateSpec("A", prompt="a.md", transitions=[Transition("B")])])
+        with self.assertRaises(ValueError):
+            compile_states([StateSpec("A", prompt="a.md", transitions=[Transition("A", judged=True)])])
+        with self.assertRaises(ValueError):
+            compile_states([StateSpec("A", classifier="response", decide_on_reply=True,
+                                      transitions=[Transition("A", label="Yes")])])
+
+    def test_cost_table_lists_the_calls_of_each_state(self):
+        costs = fsm_spec.cost_table()
+
+        self.assertEqual(costs["THANKS"], ["ask_llm:thanks.md", "recommendations"])
+        self.assertEqual(costs["EMOTION_DECIDER"], ["classifier:emotion"])
+        self.assertEqual(costs["GREETING_FORMALITY_NAME"][0], "judge:greeting.md")
+        self.assertIn("suggest_exercises:decide", costs["EXERCISE_SUGGESTION"])
+
+
+@patch('api.bot.utils.create_recommendations', return_value=[])
+class SpecDrivenTurnTestCase(TestCase):
+    """Test that a turn makes only the calls its state declares"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='fsm_user', password='testpass')
+        self.state_machine = StateMachine()
+        self.state_machine.get_user_state(self.user)
+
+    def enter(self, state):
+        self.state_machine.get_user_state(self.user)['state'] = state
+        self.state_machine.save_user_state(self.user)
+
+    def test_the_judge_is_asked_once_per_turn(self, mock_recommendations):
+        with patch('api.bot.utils.if_data_sufficient_for_state_change', return_value="خیر") as judge, \
+                patch('api.bot.utils.openai_req_generator', return_value="سلام!"):
+            result = self.state_machine.execute_state("سلام", self.user)
+
+        judge.assert_called_once()
+        self.assertEqual(result[0], "سلام!")
+        self.assertEqual(result[2], "GREETING_FORMALITY_NAME")
+
+    def test_counted_states_move_on_after_enough_messages(self, mock_recommendations):
+        self.enter("SUPER_STATE_EVENT")
+        with patch('api.bot.utils.if_data_sufficient_for_state_change', return_value="بله"), \
+                patch('api.bot.utils.openai_req_generator', return_value="بیشتر بگو"), \
+                patch('api.bot.utils.StateMachine._prefetch_suggestion'):
+            self.assertEqual(self.state_machine.execute_state("امروز دعوا کردم", self.user)[2], "SUPER_STATE_EVENT")
+            self.assertEqual(self.state_machine.execute_state("با دوستم", self.user)[2], "ASK_EXERCISE")
+
+    def test_closing_states_skip_the_knowledge_base(self, mock_recommendations):
+        prompts = {}
+
+        def reply(system_prompt, **kwargs):
+            prompts[self.state_machine.get_user_state(self.user)['state']] = system_prompt
+            return "ممنون"
+
+        with patch('api.bot.utils.openai_req_generator', reply):
+            for state in ("FEEDBACK", "THANKS"):
+                self.enter(state)
+                self.state_machine.state_handler("ممنون", self.user)
+
+        self.assertIn(prompt_layout.SAT_KNOWLEDGE_TITLE, prompts["FEEDBACK"])
+        self.assertNotIn(prompt_layout.SAT_KNOWLEDGE_TITLE, prompts["THANKS"])
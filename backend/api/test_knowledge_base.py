@@ -0,0 +1,87 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from api.bot import prompt_registry
+from api.bot.RAG import knowledge_base
+from api.bot.RAG.knowledge_base import KnowledgeIndex, chunk_markdown
+
+KNOWLEDGE = """# Knowledge
+
+## Emotions
+Intro to emotions.
+
+### Regulation:
+Breathing calms anxiety and fear.
+
+### Joy:
+Play and laughter increase joy.
+
+## Exercises
+### Childhood photo:
+Look at your childhood photo and talk to your child self.
+"""
+
+
+class KnowledgeChunkingTestCase(SimpleTestCase):
+    """Test heading-based chunking of the knowledge base"""
+
+    def test_one_chunk_per_heading_with_parent(self):
+        chunks = chunk_markdown(KNOWLEDGE)
+
+        self.assertEqual([chunk['section'] for chunk in chunks], ['Emotions', 'Regulation', 'Joy', 'Childhood photo'])
+        self.assertEqual(chunks[1]['parent'], 'Emotions')
+        self.assertTrue(chunks[1]['text'].startswith("### Regulation:\nBreathing"))
+
+    def test_long_sections_are_split_at_paragraphs(self):
+        text = "## Long\n" + "\n\n".join(f"paragraph {i} " + "x" * 80 for i in range(10))
+        chunks = chunk_markdown(text, max_chars=200)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(chunk['section'] == 'Long' for chunk in chunks))
+        self.assertTrue(all(chunk['text'].startswith("## Long\n") for chunk in chunks))
+
+
+class KnowledgeSearchTestCase(SimpleTestCase):
+    """Test BM25 ranking, allowlists and the on-disk index"""
+
+    def setUp(self):
+        self.index = KnowledgeIndex.build(KNOWLEDGE)
+
+    def test_search_ranks_matching_sections_first(self):
+        results = self.index.search("I feel anxiety, how can breathing help?", k=2)
+        self.assertEqual(results[0]['section'], 'Regulation')
+        self.assertEqual(self.index.search("photo of my child self", k=1)[0]['section'], 'Childhood photo')
+        self.assertEqual(self.index.search("unrelated words", k=3), [])
+
+    def test_allowlisted_sections_are_not_repeated(self):
+        with override_settings(SAT_KNOWLEDGE_SECTIONS={'EMOTION': ['Emotions']}), \
+                patch.object(knowledge_base, 'get_index', return_value=self.index):
+            static = knowledge_base.state_knowledge('EMOTION')
+            relevant = knowledge_base.relevant_knowledge("breathing and anxiety, childhood photo", 'EMOTION')
+
+        self.assertIn("Breathing calms anxiety", static)
+        self.assertIn("Play and laughter", static)  # whole parent section
+        self.assertNotIn("Breathing", relevant)
+        self.assertIn("childhood photo", relevant)
+
+    def test_index_round_trips_through_disk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.json')
+            self.index.save(path)
+
+            loaded = KnowledgeIndex.load(path, self.index.source_hash)
+            self.assertEqual(loaded.chunks, self.index.chunks)
+            self.assertEqual(loaded.search("joy", k=1)[0]['section'], 'Joy')
+            self.assertIsNone(KnowledgeIndex.load(path, "stale-hash"))
+
+    def test_shipped_knowledge_base_prompt_is_smaller(self):
+        full = prompt_registry.text(knowledge_base.KNOWLEDGE_FILE)
+        static = knowledge_base.state_knowledge('EMOTION')
+        relevant = knowledge_base.relevant_knowledge("امروز خیلی اضطراب دارم و ناراحتم", 'EMOTION')
+
+        self.assertIn("تنظیم هیجان", static)
+        self.assertTrue(relevant)
+        self.assertLess(len(static) + len(relevant), len(full) / 2)
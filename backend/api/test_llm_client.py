@@ -0,0 +1,43 @@
+from django.test import SimpleTestCase
+from unittest.mock import patch, MagicMock
+
+from api.bot import llm_client, resilience
+
+
+class SharedLLMClientTestCase(SimpleTestCase):
+    """Test the shared pooled LLM transport"""
+
+    def setUp(self):
+        # Earlier tests without network access may have tripped the breaker
+        resilience.provider_breaker.reset()
+
+    def test_client_is_shared(self):
+        """Test that every caller gets the same pooled client"""
+        self.assertIs(llm_client.get_client(), llm_client.get_client())
+
+    def test_http_client_pool_settings(self):
+        """Test that the HTTP client has explicit timeouts"""
+        http_client = llm_client.build_http_client()
+        try:
+            self.assertEqual(http_client.timeout.connect, llm_client.CONNECT_TIMEOUT)
+            self.assertEqual(http_client.timeout.read, llm_client.READ_TIMEOUT)
+        finally:
+            http_client.close()
+
+    def test_call_sites_go_through_shared_client(self):
+        """Test that the legacy helpers route through chat_completion"""
+        fake_client = MagicMock()
+        fake_client.chat.completions.create.return_value.choices = [
+            MagicMock(message=MagicMock(content="بله"))
+        ]
+        with patch.object(llm_client, 'get_client', return_value=fake_client):
+            from api.bot.gpt import openai_req_generator
+            from api.bot.gpt_for_summarization import openai_req_generator as summarize_req
+
+            self.assertEqual(openai_req_generator("system", "user", json_output=True), "بله")
+            self.assertEqual(summarize_req("system"), "بله")
+
+        first_call = fake_client.chat.completions.create.call_args_list[0].kwargs
+        self.assertEqual(first_call['response_format'], {"type": "json_object"})
+        self.assertEqual(len(first_call['messages']), 2)
+        self.assertEqual(fake_client.chat.completions.create.call_count, 2)
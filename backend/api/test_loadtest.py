@@ -0,0 +1,45 @@
+from django.test import SimpleTestCase
+from openai import OpenAI
+
+from api.loadtest.fake_provider import FakeOpenAIServer, FakeProviderConfig, LatencyDistribution, classify_call
+
+
+class FakeProviderTestCase(SimpleTestCase):
+    """Test the fake OpenAI-compatible provider used by the load test"""
+
+    def setUp(self):
+        self.server = FakeOpenAIServer(FakeProviderConfig(latency="fixed:0", tokens_per_second=0)).start()
+        self.client = OpenAI(api_key="test", base_url=self.server.base_url, max_retries=0)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_latency_specs(self):
+        self.assertEqual(LatencyDistribution("fixed:0.5").sample(), 0.5)
+        self.assertTrue(0.1 <= LatencyDistribution("uniform:0.1,0.2").sample() <= 0.2)
+        with self.assertRaises(ValueError):
+            LatencyDistribution("normal:1")
+
+    def test_classifier_calls_get_fsm_answers(self):
+        self.assertEqual(classify_call([{"role": "system", "content": "identify the user's response"}]),
+                         ("response_retriever", "Yes"))
+        self.assertEqual(classify_call([{"role": "user", "content": "سلام"}])[0], "reply")
+
+    def test_completion_and_stream(self):
+        messages = [{"role": "system", "content": "identify the user's emotion"}]
+        completion = self.client.chat.completions.create(model="gpt-4o", messages=messages)
+        self.assertEqual(completion.choices[0].message.content, "Negative")
+
+        stream = self.client.chat.completions.create(
+            model="gpt-4o", messages=[{"role": "user", "content": "سلام"}], stream=True
+        )
+        text = "".join(chunk.choices[0].delta.content or "" for chunk in stream)
+        self.assertTrue(text.startswith("ممنون"))
+        self.assertEqual(self.server.calls, {"emotion_retriever": 1, "reply": 1})
+
+    def test_error_injection(self):
+        self.server.config.error_rate = 1.0
+        self.server.config.error_statuses = (429,)
+        with self.assertRaises(Exception) as context:
+            self.client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": "سلام"}])
+        self.assertEqual(getattr(context.exception, "status_code", None), 429)
@@ -0,0 +1,179 @@
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from api.bot.mailbox import MailboxExecutor
+from api.bot.message_buffer import MessageBuffer, TurnTimeout
+from api.bot.utils import StateMachine
+from api.models import Message, User
+
+
+class MailboxExecutorTestCase(SimpleTestCase):
+    """Test serial per-user turns and merging of bursts"""
+
+    def setUp(self):
+        self.user = SimpleNamespace(id=1)
+        self.turns = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def handler(self, message, user, stream):
+        self.turns.append(message)
+        self.release.wait(5)
+        for word in message.split():
+            yield "token", word
+        yield "done", f"reply to {message}"
+
+    def executor(self, debounce=0.0):
+        return MailboxExecutor(self.handler, " ".join, debounce=debounce, max_debounce=1)
+
+    def submit_in_thread(self, executor, message, results):
+        thread = threading.Thread(target=lambda: results.__setitem__(message, executor.execute(self.user, message)))
+        thread.start()
+        return thread
+
+    def test_messages_sent_during_a_turn_are_merged_into_the_next(self):
+        executor = self.executor()
+        results = {}
+        self.release.clear()
+        first = self.submit_in_thread(executor, "one", results)
+        while not self.turns:
+            time.sleep(0.01)
+        later = [self.submit_in_thread(executor, message, results) for message in ("two", "three")]
+        time.sleep(0.1)
+        self.release.set()
+        for thread in [first] + later:
+            thread.join(5)
+
+        self.assertEqual(self.turns[0], "one")
+        self.assertEqual(sorted(self.turns[1].split()), ["three", "two"])
+        self.assertEqual(len(self.turns), 2)
+        self.assertEqual(results["two"], results["three"])
+        self.assertEqual(results["one"], "reply to one")
+        self.assertEqual(executor.boxes, {})
+
+    def test_burst_within_the_debounce_window_is_one_turn(self):
+        executor = self.executor(debounce=0.2)
+        results = {}
+        threads = []
+        for message in ("a", "b", "c"):
+            threads.append(self.submit_in_thread(executor, message, results))
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(self.turns), 1)
+        self.assertEqual(set(results.values()), {"reply to a b c"})
+
+    def test_merged_streaming_requests_receive_the_tokens(self):
+        executor = self.executor(debounce=0.2)
+        events = []
+        thread = threading.Thread(target=lambda: events.extend(executor.run(self.user, "x", stream=True)))
+        thread.start()
+        time.sleep(0.05)
+        result = executor.execute(self.user, "y")
+        thread.join(5)
+
+        self.assertEqual(events, [("token", "x"), ("token", "y"), ("done", "reply to x y")])
+        self.assertEqual(result, "reply to x y")
+
+    def test_merged_requests_get_the_result_when_the_streaming_leader_leaves(self):
+        executor = self.executor(debounce=0.2)
+        results = {}
+        follower = threading.Thread(target=lambda: results.__setitem__("z", executor.execute(self.user, "z")))
+        threading.Timer(0.05, follower.start).start()
+
+        events = executor.run(self.user, "x y", stream=True)
+        self.assertEqual(next(events), ("token", "x"))
+        events.close()  # the leader's client disconnected
+        follower.join(5)
+
+        self.assertEqual(results["z"], "reply to x y z")
+        self.assertEqual(executor.boxes, {})
+
+    def test_errors_reach_every_waiting_request(self):
+        def failing(message, user, stream):
+            raise ValueError("boom")
+            yield
+
+        executor = MailboxExecutor(failing, " ".join, debounce=0.2, max_debounce=1)
+        errors = []
+
+        def submit(message):
+            try:
+                executor.execute(self.user, message)
+            except ValueError as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=submit, args=(message,)) for message in ("a", "b")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(errors, ["boom", "boom"])
+        self.assertEqual(executor.boxes, {})
+
+
+class BufferedMessagesTestCase(TestCase):
+    """Test that messages left in the buffer are answered"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='mailbox_user', password='testpass')
+        self.state_machine = StateMachine()
+
+    @patch('api.bot.utils.StateMachine.state_handler', return_value=("پاسخ", [], None, None))
+    @patch('api.bot.utils.if_data_sufficient_for_state_change', return_value="خیر")
+    def test_process_buffered_messages_runs_a_turn(self, mock_judge, mock_handler):
+        self.state_machine.message_buffer.add_message(self.user.id, "پیام اول")
+        self.state_machine.message_buffer.add_message(self.user.id, "پیام دوم")
+
+        response, _, _, _, _ = self.state_machine.process_buffered_messages(self.user)
+
+        self.assertEqual(response, "پاسخ")
+        self.assertEqual(mock_handler.call_args[0][0], "پیام اول پیام دوم")
+        self.assertTrue(Message.objects.filter(user=self.user, text="پیام اول پیام دوم", is_user=True).exists())
+        self.assertFalse(self.state_machine.message_buffer.has_buffered_messages(self.user.id))
+        self.assertEqual(self.state_machine.process_buffered_messages(self.user), (None, None, None, None, None))
+
+    @override_settings(MAILBOX_TURN_WAIT_SECONDS=0.3)
+    def test_a_turn_that_cannot_start_in_time_raises_and_keeps_the_message(self):
+        self.assertTrue(self.state_machine.message_buffer.try_start_processing(self.user.id))  # another worker's turn
+
+        with self.assertRaises(TurnTimeout):
+            self.state_machine.execute_state("سلام", self.user)
+
+        self.assertEqual(self.state_machine.message_buffer.get_buffered_messages(self.user.id), ["سلام"])
+
+
+class TurnWaitTestCase(SimpleTestCase):
+    """Test waiting for a user's turn in another worker"""
+
+    @patch('api.bot.message_buffer.time.sleep')
+    def test_retries_back_off_until_the_timeout(self, mock_sleep):
+        buffer = MessageBuffer()
+        buffer.try_start_processing(1)
+        clock = [0.0]
+        mock_sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+
+        with patch('api.bot.message_buffer.time.monotonic', side_effect=lambda: clock[0]):
+            with self.assertRaises(TurnTimeout):
+                buffer.wait_to_start_processing(1, timeout=5)
+
+        delays = [call.args[0] for call in mock_sleep.call_args_list]
+        self.assertLess(len(delays), 15)
+        self.assertLessEqual(delays[0], 0.05)
+        self.assertGreater(max(delays), 0.4)
+        self.assertAlmostEqual(sum(delays), 5)
+
+    def test_starts_as_soon_as_the_user_is_free(self):
+        buffer = MessageBuffer()
+        buffer.try_start_processing(1)
+        threading.Timer(0.1, buffer.end_processing, args=(1,)).start()
+
+        buffer.wait_to_start_processing(1, timeout=5)
+
+        self.assertTrue(buffer.is_user_processing(1))
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from api.bot.db import immediate_atomic
+from api.bot.message_buffer import DatabaseMessageBuffer, LeasedMessageBuffer, TurnLeaseLost
+from api.bot.utils import StateMachine
+from api.loadtest import lease_stress
+from api.models import Message, User
+
+
+class DatabaseMessageBufferTestCase(TransactionTestCase):
+    """Test the turn lease and buffer shared by workers through the database"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='lease_user', password='testpass')
+        self.worker_a = DatabaseMessageBuffer(lease_seconds=0.3)
+        self.worker_b = DatabaseMessageBuffer(lease_seconds=0.3)
+
+    def tearDown(self):
+        self.worker_a.stop()
+        self.worker_b.stop()
+
+    def test_only_one_worker_processes_a_user(self):
+        self.assertTrue(self.worker_a.try_start_processing(self.user.id))
+        self.assertFalse(self.worker_b.try_start_processing(self.user.id))
+        self.assertTrue(self.worker_b.is_user_processing(self.user.id))
+
+        self.worker_b.add_message(self.user.id, "پیام اول")
+        self.worker_b.add_message(self.user.id, "پیام دوم")
+        self.assertEqual(self.worker_a.get_buffered_messages(self.user.id), ["پیام اول", "پیام دوم"])
+        self.assertFalse(self.worker_a.has_buffered_messages(self.user.id))
+
+        self.worker_a.end_processing(self.user.id)
+        self.assertFalse(self.worker_b.is_user_processing(self.user.id))
+        self.assertTrue(self.worker_b.try_start_processing(self.user.id))
+        self.worker_b.end_processing(self.user.id)
+
+    def test_held_leases_are_renewed(self):
+        self.assertTrue(self.worker_a.try_start_processing(self.user.id))
+        time.sleep(0.8)
+
+        self.assertFalse(self.worker_b.try_start_processing(self.user.id))
+        self.worker_a.end_processing(self.user.id)
+
+    def test_leases_of_dead_workers_expire(self):
+        self.assertTrue(self.worker_a.try_start_processing(self.user.id))
+        self.worker_a.stop()  # as if the worker died mid-turn
+        time.sleep(0.5)
+
+        self.assertFalse(self.worker_b.is_user_processing(self.user.id))
+        self.assertTrue(self.worker_b.try_start_processing(self.user.id))
+        self.worker_b.end_processing(self.user.id)
+
+    def test_a_worker_knows_when_its_lease_was_taken_over(self):
+        self.assertTrue(self.worker_a.try_start_processing(self.user.id))
+        self.assertFalse(self.worker_a.lease_lost(self.user.id))
+        self.worker_a.stop()  # stalled past the lease
+        time.sleep(0.5)
+        self.assertTrue(self.worker_b.try_start_processing(self.user.id))
+
+        self.assertTrue(self.worker_a.lease_lost(self.user.id))
+        self.assertFalse(self.worker_b.lease_lost(self.user.id))
+        self.worker_b.end_processing(self.user.id)
+
+    def test_lease_and_buffer_writes_take_the_write_lock_up_front(self):
+        with CaptureQueriesContext(connection) as queries:
+            with immediate_atomic():
+                User.objects.count()
+            with immediate_atomic():
+                with immediate_atomic():
+                    pass
+
+        begins = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('BEGIN')]
+        self.assertEqual(begins, ['BEGIN IMMEDIATE', 'BEGIN IMMEDIATE'])
+        self.assertIsNone(connection.transaction_mode)
+
+    def test_backends_must_implement_the_lease(self):
+        with self.assertRaises(TypeError):
+            LeasedMessageBuffer()
+
+
+class LostLeaseTurnTestCase(TestCase):
+    """Test that a turn whose lease was lost does not persist its reply"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='fenced_user', password='testpass')
+        self.state_machine = StateMachine()
+
+    @patch('api.bot.utils.StateMachine.state_handler', return_value=("پاسخ", [], None, None))
+    @patch('api.bot.utils.if_data_sufficient_for_state_change', return_value="خیر")
+    def test_a_fenced_turn_writes_nothing(self, mock_judge, mock_handler):
+        with patch.object(self.state_machine.message_buffer, 'lease_lost', return_value=True):
+            with self.assertRaises(TurnLeaseLost):
+                self.state_machine.execute_state("سلام", self.user)
+
+        self.assertFalse(Message.objects.filter(user=self.user).exists())
+        self.assertFalse(self.state_machine.message_buffer.is_user_processing(self.user.id))
+
+    @patch('api.bot.utils.if_data_sufficient_for_state_change', return_value="خیر")
+    def test_a_turn_whose_state_was_overwritten_is_not_saved(self, mock_judge):
+        other_worker = StateMachine()
+
+        def reply(message, user, stream=False):
+            # Another worker saves the user's state while this turn runs
+            other_worker.get_user_state(user)['state'] = "EMOTION"
+            other_worker.save_user_state(user)
+            return "پاسخ", [], None, None
+
+        with patch('api.bot.utils.StateMachine.state_handler', side_effect=reply):
+            with self.assertRaises(TurnLeaseLost):
+                self.state_machine.execute_state("سلام", self.user)
+
+        self.assertFalse(Message.objects.filter(user=self.user, is_user=False).exists())
+        self.assertEqual(self.state_machine.get_user_state(self.user)['state'], "EMOTION")
+
+
+class LeaseStressTestCase(TransactionTestCase):
+    """Run several worker processes against one user and check turns never overlap"""
+
+    def test_concurrent_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = lease_stress.run(os.path.join(tmp, 'stress.sqlite3'))
+
+        self.assertEqual(result["max_concurrent"], 1)
+        self.assertEqual(result["counter"], result["processed"])
+        self.assertGreater(result["processed"], 0)
+        self.assertEqual(result["processed"] + result["buffered"], 4 * 15)
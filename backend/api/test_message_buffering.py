@@ -18,7 +18,8 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-from api.bot.utils import StateMachine, MessageBuffer
+from api.bot.message_buffer import MessageBuffer
+from api.bot.utils import StateMachine
 
 class MessageBufferingTest(TestCase):
     """Test cases for message buffering functionality"""
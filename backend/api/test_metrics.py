@@ -0,0 +1,103 @@
+from django.test import SimpleTestCase, override_settings
+from openai import OpenAI
+from unittest.mock import patch
+
+from api.bot import llm_client, metrics, resilience
+from api.bot.call_planner import CallPlan
+from api.loadtest.fake_provider import FakeOpenAIServer, FakeProviderConfig
+
+
+def series_count(histogram, **labels):
+    key = tuple(labels[name] for name in histogram.labelnames)
+    series = histogram.series.get(key)
+    return series[-1] if series else 0
+
+
+class LLMMetricsTestCase(SimpleTestCase):
+    """Test per-call-site LLM instrumentation"""
+
+    def setUp(self):
+        self.server = FakeOpenAIServer(FakeProviderConfig(latency="fixed:0", tokens_per_second=0)).start()
+        self.client = OpenAI(api_key="test", base_url=self.server.base_url, max_retries=0)
+        patcher = patch.object(llm_client, 'get_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        resilience.provider_breaker.reset()
+
+    def tearDown(self):
+        self.server.stop()
+        metrics.set_fsm_state(None)
+
+    def test_call_site_state_and_tokens_are_recorded(self):
+        labels = dict(call_site="test:labels", model="gpt-4o", state="EMOTION", outcome="ok")
+        before = series_count(metrics.LLM_CALL_SECONDS, **labels)
+        metrics.set_fsm_state("EMOTION")
+        with metrics.llm_call_site("test:labels"):
+            llm_client.chat_completion([{"role": "user", "content": "امروز ناراحتم"}])
+
+        self.assertEqual(series_count(metrics.LLM_CALL_SECONDS, **labels), before + 1)
+        prompt_series = metrics.LLM_PROMPT_TOKENS.series[("test:labels", "gpt-4o")]
+        self.assertGreater(prompt_series[-2], 0)
+
+    def test_stream_records_usage_with_labels_from_creation(self):
+        with metrics.llm_call_site("test:stream"):
+            chunks = llm_client.stream_chat_completion([{"role": "user", "content": "سلام"}])
+        "".join(chunks)
+
+        self.assertEqual(series_count(metrics.LLM_CALL_SECONDS, call_site="test:stream", model="gpt-4o",
+                                      state="-", outcome="ok"), 1)
+        self.assertIn(("test:stream", "gpt-4o"), metrics.LLM_COMPLETION_TOKENS.series)
+
+    def test_labels_follow_calls_into_planner_workers(self):
+        def call():
+            return llm_client.chat_completion([{"role": "user", "content": "سلام"}])
+
+        with metrics.llm_call_site("test:planner"):
+            CallPlan().add("a", call).add("b", call).run()
+
+        self.assertEqual(series_count(metrics.LLM_QUEUE_SECONDS, call_site="test:planner"), 2)
+
+    def test_metrics_endpoint(self):
+        with metrics.llm_call_site("test:endpoint"):
+            llm_client.chat_completion([{"role": "user", "content": "سلام"}])
+
+        response = self.client_class().get('/metrics')
+        body = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE llm_call_duration_seconds histogram', body)
+        self.assertIn('llm_call_duration_seconds_bucket{call_site="test:endpoint",model="gpt-4o",state="-",outcome="ok",le="+Inf"} 1', body)
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.5'], METRICS_TOKEN='scrape-secret')
+    def test_metrics_endpoint_is_restricted(self):
+        client = self.client_class()
+
+        self.assertEqual(client.get('/metrics').status_code, 403)
+        self.assertEqual(client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret').status_code, 200)
+        self.assertEqual(client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+
+    def test_transcription_retries_are_labelled_with_its_call_site(self):
+        attempts = []
+
+        def fail_once(attempt, **kwargs):
+            attempts.append(metrics.CALL_SITE.get())
+            raise RuntimeError("upload failed")
+
+        with patch.object(llm_client, 'call_with_resilience', fail_once):
+            with self.assertRaises(RuntimeError):
+                llm_client.transcribe(__file__)
+
+        self.assertEqual(attempts, ["whisper"])
+        self.assertEqual(series_count(metrics.LLM_CALL_SECONDS, call_site="whisper", model="whisper-1",
+                                      state="-", outcome="error"), 1)
+
+    def test_cached_prompt_tokens_are_recorded(self):
+        shared_prefix = "قانون " * 1500
+        with metrics.llm_call_site("test:prompt_cache"):
+            llm_client.chat_completion([{"role": "system", "content": shared_prefix + "کاربر اول"}])
+            llm_client.chat_completion([{"role": "system", "content": shared_prefix + "کاربر دوم"}])
+
+        ratios = metrics.LLM_CACHED_PROMPT_RATIO.series[("test:prompt_cache", "gpt-4o")]
+        self.assertEqual(ratios[-1], 2)
+        self.assertGreater(ratios[-2], 0.9)  # the second call reused 1408 of 1502 tokens
+        self.assertEqual(metrics.LLM_CACHED_PROMPT_TOKENS.values[("test:prompt_cache", "gpt-4o")], 1408)
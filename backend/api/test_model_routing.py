@@ -0,0 +1,85 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from unittest.mock import patch, MagicMock
+
+from api.bot import llm_client, metrics, model_routing, resilience
+from api.models import User, Message
+
+TIERS = {'large': 'big-model', 'small': 'small-model'}
+ROUTING = {
+    'default': {'tier': 'large'},
+    'judge': {'tier': 'small', 'max_tokens': 50},
+    'ask_llm': {'temperature': 0.3},
+    'ask_llm@EMOTION': {'tier': 'small'},
+    'ask_llm:thanks.md': {'model': 'pinned-model'},
+}
+
+
+@override_settings(LLM_MODEL_TIERS=TIERS, LLM_ROUTING=ROUTING)
+class ModelRoutingTestCase(SimpleTestCase):
+    """Test the per-call-site model routing table"""
+
+    def test_specific_entries_override_general_ones(self):
+        self.assertEqual(model_routing.resolve('judge'), ('small-model', None, 50))
+        self.assertEqual(model_routing.resolve('ask_llm:greeting.md'), ('big-model', 0.3, None))
+        self.assertEqual(model_routing.resolve('ask_llm:greeting.md', 'EMOTION'), ('small-model', 0.3, None))
+        self.assertEqual(model_routing.resolve('ask_llm:thanks.md', 'EMOTION').model, 'pinned-model')
+        self.assertEqual(model_routing.resolve('unknown').model, 'big-model')
+
+    def test_chat_completion_uses_the_route_of_the_call_site(self):
+        resilience.provider_breaker.reset()
+        fake_client = MagicMock()
+        fake_client.chat.completions.create.return_value.choices = [MagicMock(message=MagicMock(content="بله"))]
+        with patch.object(llm_client, 'get_client', return_value=fake_client):
+            with metrics.llm_call_site("judge"):
+                llm_client.chat_completion([{"role": "system", "content": "x"}])
+            llm_client.chat_completion([{"role": "system", "content": "x"}], model="explicit-model")
+
+        judge_call, explicit_call = [call.kwargs for call in fake_client.chat.completions.create.call_args_list]
+        self.assertEqual(judge_call['model'], 'small-model')
+        self.assertEqual(judge_call['max_tokens'], 50)
+        self.assertEqual(explicit_call['model'], 'explicit-model')
+        self.assertNotIn('max_tokens', explicit_call)
+
+    def test_an_explicit_temperature_wins_over_the_route(self):
+        with metrics.llm_call_site("ask_llm:greeting.md"):
+            self.assertEqual(llm_client._chat_params([], None, None, False)['temperature'], 0.3)
+            self.assertEqual(llm_client._chat_params([], None, 0.1, False)['temperature'], 0.1)
+        self.assertEqual(llm_client._chat_params([], None, None, False)['temperature'],
+                         llm_client.DEFAULT_TEMPERATURE)
+
+
+@override_settings(LLM_MODEL_TIERS=TIERS)
+class CompareModelTiersCommandTestCase(TestCase):
+    """Test the tier comparison report on stored conversations"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='tier_user', password='pass')
+        for text, is_user, state in [
+            ("سلام، سارا هستم", True, "GREETING_FORMALITY_NAME"),
+            ("سلام سارا! امروز چطوری؟", False, "GREETING_FORMALITY_NAME"),
+            ("ناراحتم", True, "EMOTION"),
+            ("آره تمرین می‌کنم", True, "ASK_EXERCISE"),
+        ]:
+            Message.objects.create(user=user, text=text, is_user=is_user, session_id=1, state=state)
+
+    @patch('api.management.commands.compare_model_tiers.chat_completion')
+    def test_reports_agreement_per_call_site(self, mock_chat):
+        def fake_chat(messages, model, temperature):
+            prompt = messages[0]["content"]
+            if "identify the user's emotion" in prompt:
+                return "Negative"
+            if "identify the user's response" in prompt:
+                return "Yes" if model == "big-model" else "No"
+            return "بله"
+        mock_chat.side_effect = fake_chat
+
+        out = StringIO()
+        call_command('compare_model_tiers', stdout=out)
+        report = out.getvalue()
+
+        self.assertEqual(mock_chat.call_count, 8)  # 2 judge + 1 emotion + 1 response, on two tiers
+        self.assertRegex(report, r"judge\s+2 .* 100\.0%")
+        self.assertRegex(report, r"response_retriever\s+1 .* 0\.0%")
@@ -0,0 +1,140 @@
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from api.bot import metrics
+from api.bot.call_planner import CallPlan
+from api.bot.prefetch import Prefetcher, fingerprint
+from api.bot.utils import StateMachine
+from api.models import User, UserMemoryState
+
+
+def metered_call(value):
+    metrics.CallRecorder("gpt-4o").finish(usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20))
+    return value
+
+
+class PrefetcherTestCase(SimpleTestCase):
+    """Test that speculative results are used only for the inputs they were made for"""
+
+    def launch(self, value):
+        return lambda: CallPlan().add("result", metered_call, value).start()
+
+    def test_matching_inputs_are_used_once(self):
+        prefetcher = Prefetcher("test_hit")
+        prefetcher.start(1, fingerprint("memory", ["1"]), self.launch("a"))
+
+        speculation = prefetcher.take(1, fingerprint("memory", ["1"]))
+
+        self.assertEqual(speculation.futures["result"].result(), "a")
+        self.assertIsNone(prefetcher.take(1, fingerprint("memory", ["1"])))
+        self.assertEqual(metrics.LLM_PREFETCHES.values[("test_hit", "hit")], 1)
+        self.assertEqual(metrics.LLM_PREFETCHES.values[("test_hit", "miss")], 1)
+
+    def test_changed_inputs_count_the_spend_as_wasted(self):
+        prefetcher = Prefetcher("test_stale")
+        prefetcher.start(1, fingerprint("memory", ["1"]), self.launch("a"))
+        prefetcher.start(1, fingerprint("memory", ["1"]), self.launch("b"))  # same inputs: kept
+
+        prefetcher.pending[1].futures["result"].result()
+        self.assertIsNone(prefetcher.take(1, fingerprint("newer memory", ["1"])))
+        self.assertEqual(metrics.LLM_PREFETCHES.values[("test_stale", "started")], 1)
+        self.assertEqual(metrics.LLM_PREFETCHES.values[("test_stale", "stale")], 1)
+        self.assertEqual(metrics.LLM_PREFETCH_WASTED_TOKENS.values[("test_stale", "prompt")], 100)
+        self.assertEqual(metrics.LLM_PREFETCH_WASTED_TOKENS.values[("test_stale", "completion")], 20)
+
+    def test_a_failure_after_take_is_counted_once(self):
+        prefetcher = Prefetcher("test_failed")
+        prefetcher.start(1, fingerprint("memory"), self.launch("a"))
+        speculation = prefetcher.take(1, fingerprint("memory"))
+        speculation.futures["result"].result()
+
+        prefetcher.failed(speculation, RuntimeError("timeout"))
+        prefetcher.failed(speculation)
+
+        self.assertEqual(metrics.LLM_PREFETCHES.values[("test_failed", "failed")], 1)
+        self.assertEqual(metrics.LLM_PREFETCH_WASTED_TOKENS.values[("test_failed", "prompt")], 100)
+
+
+@patch('api.bot.utils.create_recommendations', return_value=[])
+@patch('api.bot.utils.create_exercise_explanation', return_value="چرا این تمرین")
+@patch('api.bot.utils.StateMachine._customize_with_context', return_value="تمرین امروز")
+class SuggestionPrefetchTestCase(TestCase):
+    """Test that the exercise suggestion starts when the user is asked about an exercise"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='prefetch_user', password='testpass')
+        self.state_machine = StateMachine()
+        self.state_machine.get_user_state(self.user)
+
+    def suggest(self):
+        self.state_machine.transition("EXERCISE_SUGGESTION", self.user)
+        return self.state_machine.state_handler("بله", self.user)
+
+    def test_suggestion_prefetched_on_ask_exercise_is_used(self, *mocks):
+        with patch('api.bot.utils.suggest_exercises', return_value=(["متن تمرین"], "3")) as suggest:
+            self.state_machine.transition("ASK_EXERCISE", self.user)
+            response, _, explainability, exercise_number = self.suggest()
+
+        suggest.assert_called_once()
+        self.assertEqual((response, explainability, exercise_number), ("تمرین امروز", "چرا این تمرین", "3"))
+        self.assertIn("3", self.state_machine.get_user_state(self.user)['exercises_done'])
+
+    def test_suggestion_is_redone_when_the_memory_changed(self, *mocks):
+        with patch('api.bot.utils.suggest_exercises', return_value=(["متن تمرین"], "3")) as suggest:
+            self.state_machine.transition("ASK_EXERCISE", self.user)
+            UserMemoryState.objects.update_or_create(user=self.user, defaults={'current_memory': "خلاصه جدید"})
+            self.suggest()
+
+        self.assertEqual(suggest.call_count, 2)
+        self.assertEqual(suggest.call_args[0][1], "خلاصه جدید")
+
+    def fail_after_take(self, value):
+        """A side effect whose first call raises once the prefetched work was taken"""
+        taken = threading.Event()
+        take = self.state_machine.suggestion_prefetch.take
+
+        def take_and_release(*args):
+            speculation = take(*args)
+            taken.set()
+            return speculation
+
+        self.state_machine.suggestion_prefetch.take = take_and_release
+        calls = []
+
+        def side_effect(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                taken.wait(5)
+                raise RuntimeError("timeout")
+            return value
+        return side_effect
+
+    def test_a_prefetched_suggestion_that_fails_after_take_is_redone(self, *mocks):
+        failed = metrics.LLM_PREFETCHES.values.get(("exercise_suggestion", "failed"), 0)
+        with patch('api.bot.utils.suggest_exercises', side_effect=self.fail_after_take((["متن تمرین"], "3"))) as suggest:
+            self.state_machine.transition("ASK_EXERCISE", self.user)
+            response, _, explainability, exercise_number = self.suggest()
+
+        self.assertEqual(suggest.call_count, 2)
+        self.assertEqual((response, explainability, exercise_number), ("تمرین امروز", "چرا این تمرین", "3"))
+        self.assertEqual(metrics.LLM_PREFETCHES.values[("exercise_suggestion", "failed")], failed + 1)
+
+    def test_a_prefetched_explanation_that_fails_after_take_is_redone(self, customize, explain, *mocks):
+        explain.side_effect = self.fail_after_take("چرا این تمرین")
+        with patch('api.bot.utils.suggest_exercises', return_value=(["متن تمرین"], "3")) as suggest:
+            self.state_machine.transition("ASK_EXERCISE", self.user)
+            response, _, explainability, exercise_number = self.suggest()
+
+        suggest.assert_called_once()
+        self.assertEqual(explain.call_count, 2)
+        self.assertEqual(explainability, "چرا این تمرین")
+
+    def test_leaving_for_another_state_discards_the_suggestion(self, *mocks):
+        with patch('api.bot.utils.suggest_exercises', return_value=(["متن تمرین"], "3")):
+            self.state_machine.transition("ASK_EXERCISE", self.user)
+            self.state_machine.transition("THANKS", self.user)
+
+        self.assertEqual(self.state_machine.suggestion_prefetch.pending, {})
@@ -0,0 +1,56 @@
+from django.test import SimpleTestCase
+
+from api.bot import prompt_layout, prompt_registry
+from api.bot.prompt_registry import PromptTemplate
+
+
+class PromptLayoutTestCase(SimpleTestCase):
+    """Test that system prompts start with a prefix shared across users"""
+
+    def setUp(self):
+        self.template = PromptTemplate(
+            "Rules for day {current_day}\n### Memory:\n{memory}\n### Transition:\n{transition_awareness}\nMore rules"
+        )
+
+    def build(self, memory, transition=None, day=1):
+        return prompt_layout.build_system_prompt(
+            self.template,
+            volatile={'memory': memory, 'transition_awareness': transition, 'repetition': "used: hi"},
+            static={'current_day': day},
+            knowledge="SAT knowledge",
+            guidance="Static guidance",
+        )
+
+    def test_prefix_is_shared_and_volatile_text_comes_last(self):
+        first, second = self.build("user A likes tea"), self.build("user B is sad")
+        prefix = prompt_layout.static_prefix(self.template, ['memory', 'repetition'], {'current_day': 1},
+                                             "SAT knowledge", "Static guidance")
+
+        self.assertTrue(first.startswith(prefix) and second.startswith(prefix))
+        self.assertNotIn("user A", prefix)
+        self.assertLess(first.index("SAT knowledge"), first.index("user A likes tea"))
+        self.assertLess(first.index("Static guidance"), first.index("used: hi"))
+        self.assertIn(prompt_layout.section_reference('memory'), prefix)
+        self.assertIn(f"### {prompt_layout.SECTION_TITLES['memory']}:\nuser A likes tea", first)
+
+    def test_missing_volatile_value_is_left_empty(self):
+        prompt = self.build("memory")
+        self.assertIn("### Transition:\n\nMore rules", prompt)
+        self.assertNotIn(prompt_layout.SECTION_TITLES['transition_awareness'], prompt)
+
+        with_transition = self.build("memory", transition="moved on")
+        self.assertIn(prompt_layout.section_reference('transition_awareness'), with_transition)
+        self.assertTrue(with_transition.endswith("used: hi"))
+
+    def test_static_values_render_in_place(self):
+        self.assertIn("Rules for day 3", self.build("memory", day=3))
+
+    def test_state_prompts_keep_their_rules(self):
+        template = prompt_registry.get('Prompts/emotion.md')
+        prompt = prompt_layout.build_system_prompt(
+            template, volatile={'memory': "MEMORY", 'transition_awareness': "TRANSITION"}, knowledge="KNOWLEDGE",
+        )
+        rules = template.text.split("{memory}")[-1].strip()[:200]
+        self.assertLess(prompt.index(rules), prompt.index("KNOWLEDGE"))
+        self.assertLess(prompt.index("KNOWLEDGE"), prompt.index("MEMORY"))
+        self.assertNotIn("{memory}", prompt)
@@ -0,0 +1,74 @@
+import os
+import tempfile
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+from api.bot import prompt_registry
+from api.bot.prompt_registry import PromptRegistry, PromptTemplate
+from api.bot.gpt_for_statedetection import build_judge_prompt
+
+
+class PromptTemplateTestCase(SimpleTestCase):
+    """Test that pre-split templates render exactly like str.format"""
+
+    def test_matches_str_format(self):
+        text = 'Memory: {memory}\n{{"json": {{"stage": "{stage}"}}}}\nDay {current_day:>3} {exc!r}'
+        values = {'memory': 'likes tea', 'stage': 'EMOTION', 'current_day': 2, 'exc': ['1', '2a'], 'unused': 1}
+        self.assertEqual(PromptTemplate(text).render(**values), text.format(**values))
+
+    def test_missing_field_raises_key_error(self):
+        with self.assertRaises(KeyError):
+            PromptTemplate('{memory} {transition_awareness}').render(memory='')
+
+    def test_shipped_prompts_render_like_str_format(self):
+        values = {'memory': 'M', 'exc': 'E', 'current_day': 1, 'stage': 'S', 'done_before': 'None',
+                  'exercise_descriptions': 'D', 'daily_exercises': 'X', 'transition_awareness': 'T'}
+        for name in ('RAG/prompt.md', 'RAG/exercise_decider.md', 'RAG/exercise_explanation_prompt.md',
+                     'Prompts/simple_fsm_full.md'):
+            self.assertEqual(prompt_registry.render(name, **values), prompt_registry.text(name).format(**values))
+
+
+class PromptRegistryTestCase(SimpleTestCase):
+    """Test loading, reloading and working-directory independence"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmp.name)
+        (self.base / 'Prompts').mkdir()
+        self.prompt = self.base / 'Prompts' / 'hello.md'
+        self.prompt.write_text('Hello {name}', encoding='utf-8')
+        self.registry = PromptRegistry(self.base, patterns=('Prompts/*.md',), reload_interval=0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_picks_up_edits(self):
+        self.assertEqual(self.registry.render('Prompts/hello.md', name='Sara'), 'Hello Sara')
+        self.prompt.write_text('Salam {name}', encoding='utf-8')
+        stat = self.prompt.stat()
+        os.utime(self.prompt, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.assertEqual(self.registry.render('Prompts/hello.md', name='Sara'), 'Salam Sara')
+
+    def test_unchanged_files_are_not_reread(self):
+        first = self.registry.get('Prompts/hello.md')
+        self.assertIs(self.registry.get('Prompts/hello.md'), first)
+
+    def test_new_and_deleted_files(self):
+        self.registry.load()
+        (self.base / 'Prompts' / 'bye.md').write_text('Bye', encoding='utf-8')
+        self.assertEqual(self.registry.text('Prompts/bye.md'), 'Bye')
+        self.prompt.unlink()
+        with self.assertRaises(FileNotFoundError):
+            self.registry.get('Prompts/hello.md')
+
+    def test_does_not_depend_on_working_directory(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        try:
+            registry = PromptRegistry()
+            self.assertIn('Information_prompts/Judge_prompt.md', registry.names())
+            prompt = build_judge_prompt('emotion.md', 'User: hi')
+        finally:
+            os.chdir(cwd)
+        self.assertIn(prompt_registry.text('Information_prompts/emotion.md'), prompt)
@@ -0,0 +1,116 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from api.bot import context_assembler, repetition
+from api.bot.repetition import RepetitionPrevention, RepetitionTrackers
+from api.bot.utils import StateMachine
+from api.models import User, UserRepetitionState
+
+
+class RepetitionPreventionTestCase(SimpleTestCase):
+    """Test bounded phrase windows and near-duplicate matching"""
+
+    def test_near_duplicates_count_as_used(self):
+        tracker = RepetitionPrevention()
+        tracker.add_phrase("می‌تونم بفهمم چه احساسی داری.", "empathy")
+
+        self.assertTrue(tracker.is_phrase_used("می‌تونم بفهمم چه احساسی داری", "empathy"))
+        self.assertTrue(tracker.is_phrase_used("می‌تونم بفهمم چه احساسی داری الان", "empathy"))
+        self.assertTrue(tracker.is_phrase_used("می‌تونم بفهمم چه احساسی داری"))  # general checks every category
+        self.assertFalse(tracker.is_phrase_used("امروز هوا آفتابی و خوب است", "empathy"))
+
+    def test_windows_are_bounded_and_keep_the_most_recent(self):
+        with patch.object(repetition, 'RECENT_PHRASES', 3):
+            tracker = RepetitionPrevention()
+        for phrase in ["اولین جمله کاملا متفاوت", "دومین عبارت درباره خانواده", "سومی در مورد کار و شغل",
+                       "چهارمی درباره ورزش صبحگاهی", "دومین عبارت درباره خانواده"]:
+            tracker.add_phrase(phrase, "question")
+
+        self.assertEqual(tracker.recent("question"),
+                         ["سومی در مورد کار و شغل", "چهارمی درباره ورزش صبحگاهی", "دومین عبارت درباره خانواده"])
+
+    def test_only_problematic_words_are_counted(self):
+        tracker = RepetitionPrevention()
+        for _ in range(2):
+            tracker.add_phrase("اگر کمک خواستی من اینجام", "general")
+
+        self.assertEqual(tracker.get_overused_words(), {'کمک': 2, 'اینجام': 2})
+        self.assertEqual(set(tracker.problematic_words), {'کمک', 'اینجام'})
+
+    def test_prompt_block_lists_recent_phrases_in_order(self):
+        tracker = RepetitionPrevention()
+        self.assertIsNone(tracker.prompt_block())
+        questions = ["از کی این حس رو داری", "خانواده‌ات چه واکنشی نشون دادن", "امروز صبح چطور گذشت",
+                     "چه چیزی آرومت می‌کنه", "آخرین بار کی ورزش کردی", "با دوستات در ارتباطی",
+                     "برنامه‌ات برای آخر هفته چیه"]
+        for question in questions:
+            tracker.add_phrase(question + "؟", "question")
+        tracker.add_phrase("کمک کمک", "general")
+
+        block = tracker.prompt_block()
+        self.assertIs(tracker.prompt_block(), block)  # rendered once until the next change
+        self.assertEqual([line[2:] for line in block.splitlines() if line[2:] in questions], questions[2:])
+        self.assertIn("- 'کمک' (2 بار استفاده شده)", block)
+
+        tracker.add_phrase("یک سوال تازه و کاملا متفاوت؟", "question")
+        self.assertIn("یک سوال تازه و کاملا متفاوت", tracker.prompt_block())
+
+    def test_prompt_block_is_capped_by_tokens(self):
+        tracker = RepetitionPrevention()
+        for i in range(5):
+            tracker.add_phrase(f"عبارت همدردی شماره {i} " + "خیلی " * 10 + "ناراحت", "empathy")
+
+        capped = tracker.prompt_block(max_tokens=120)
+        self.assertLessEqual(context_assembler.count_tokens(capped), 120)
+        self.assertIn("شماره 4", capped)
+        self.assertNotIn("شماره 0", capped)
+
+
+class RepetitionTrackersTestCase(TestCase):
+    """Test per-user trackers and their persistence"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='rep_alice', password='testpass')
+        self.bob = User.objects.create_user(username='rep_bob', password='testpass')
+        self.state_machine = StateMachine()
+
+    def test_users_do_not_share_phrases(self):
+        self.state_machine._track_response_for_repetition("این تجربه واقعاً ناراحت‌کننده بوده. چه زمانی شروع شد؟", self.alice)
+
+        alice_context = self.state_machine._get_repetition_prevention_context(self.alice)
+        self.assertIn("این تجربه واقعاً ناراحت‌کننده بوده", alice_context)
+        self.assertIn("چه زمانی شروع شد", alice_context)
+        self.assertIsNone(self.state_machine._get_repetition_prevention_context(self.bob))
+
+    def test_trackers_survive_a_restart(self):
+        self.state_machine._track_response_for_repetition("می‌فهمم که چقدر برات سخت بوده", self.alice)
+
+        restarted = RepetitionTrackers()
+        self.assertTrue(restarted.get(self.alice).is_phrase_used("می‌فهمم که چقدر برات سخت بوده"))
+
+        restarted.reset(self.alice)
+        self.assertFalse(UserRepetitionState.objects.filter(user=self.alice).exists())
+        self.assertEqual(RepetitionTrackers().get(self.alice).recent("empathy"), [])
+
+    def test_each_turn_sees_the_phrases_other_workers_saved(self):
+        worker_a, worker_b = RepetitionTrackers(), RepetitionTrackers()
+        worker_a.get(self.alice)  # worker A served an earlier turn
+
+        worker_b.begin_turn(self.alice).add_phrase("حالا بیشتر برام بگو", "questions")
+        worker_b.save(self.alice)
+        worker_b.end_turn(self.alice)
+        worker_a.begin_turn(self.alice).add_phrase("می‌فهمم که چقدر برات سخت بوده", "empathy")
+        worker_a.save(self.alice)
+        worker_a.end_turn(self.alice)
+
+        tracker = RepetitionTrackers().get(self.alice)
+        self.assertTrue(tracker.is_phrase_used("حالا بیشتر برام بگو"))
+        self.assertTrue(tracker.is_phrase_used("می‌فهمم که چقدر برات سخت بوده"))
+        self.assertEqual(len(worker_a.trackers), 0)
+
+    def test_inactive_users_are_evicted_from_memory(self):
+        trackers = RepetitionTrackers(maxsize=1)
+        trackers.get(self.alice)
+        trackers.get(self.bob)
+        self.assertEqual(len(trackers.trackers), 1)
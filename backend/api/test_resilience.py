@@ -0,0 +1,131 @@
+import time
+
+from django.test import SimpleTestCase, TestCase
+from openai import OpenAI
+from unittest.mock import patch
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.bot import llm_client, metrics, resilience
+from api.bot.resilience import CircuitBreaker, HedgeBudget, LLMUnavailable, deadline
+from api.loadtest.fake_provider import FakeOpenAIServer, FakeProviderConfig, LatencyDistribution
+from api.models import User, UserGroup
+
+MESSAGES = [{"role": "user", "content": "سلام"}]
+
+
+class ResilienceTestCase(SimpleTestCase):
+    """Test retries, deadlines, hedging and the circuit breaker against the fake provider"""
+
+    def setUp(self):
+        self.server = FakeOpenAIServer(FakeProviderConfig(latency="fixed:0", tokens_per_second=0, stall_seconds=5)).start()
+        client = OpenAI(api_key="test", base_url=self.server.base_url, max_retries=0)
+        for target, value in [
+            (patch.object(llm_client, 'get_client', return_value=client), None),
+            (patch.object(resilience, 'RETRY_BASE_DELAY', 0.01), None),
+            (patch.object(resilience, 'MIN_ATTEMPT_SECONDS', 0.1), None),
+            (patch.object(resilience, 'provider_breaker', CircuitBreaker(failure_threshold=3, reset_timeout=0.3)), None),
+        ]:
+            target.start()
+            self.addCleanup(target.stop)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def script(self, *faults):
+        self.server.config.scripted_faults = list(faults)
+
+    def test_transient_errors_are_retried(self):
+        self.script(429, 503)
+        self.assertTrue(llm_client.chat_completion(MESSAGES))
+        self.assertEqual(self.server.calls["reply"], 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.script(400)
+        with self.assertRaises(Exception) as context:
+            llm_client.chat_completion(MESSAGES)
+        self.assertNotIsInstance(context.exception, LLMUnavailable)
+        self.assertEqual(self.server.calls["reply"], 1)
+
+    def test_stalled_provider_respects_the_deadline(self):
+        self.script("stall", "stall", "stall")
+        start = time.monotonic()
+        with deadline(1.0), self.assertRaises(LLMUnavailable):
+            llm_client.chat_completion(MESSAGES)
+        self.assertLess(time.monotonic() - start, 2.0)
+
+    def test_slow_classifier_call_is_hedged(self):
+        self.script("stall")
+        with patch.object(resilience, 'HEDGE_DELAY', 0.2):
+            start = time.monotonic()
+            result = llm_client.chat_completion(
+                [{"role": "system", "content": "identify the user's response"}], hedge=True)
+        self.assertEqual(result, "Yes")
+        self.assertLess(time.monotonic() - start, 2.0)
+        self.assertEqual(self.server.calls["response_retriever"], 2)
+
+    def test_slow_call_over_the_hedge_budget_is_not_hedged(self):
+        self.server.config.latency = LatencyDistribution("fixed:0.4")
+        over_budget = metrics.LLM_HEDGES_OVER_BUDGET.values.get(("unknown",), 0)
+        with patch.object(resilience, 'HEDGE_DELAY', 0.1), \
+                patch.object(resilience, 'hedge_budget', HedgeBudget(ratio=0, burst=0)):
+            result = llm_client.chat_completion(
+                [{"role": "system", "content": "identify the user's response"}], hedge=True)
+        self.assertEqual(result, "Yes")
+        self.assertEqual(self.server.calls["response_retriever"], 1)
+        self.assertEqual(metrics.LLM_HEDGES_OVER_BUDGET.values[("unknown",)], over_budget + 1)
+
+    def test_hedge_delay_follows_the_call_sites_tail_latency(self):
+        self.assertEqual(resilience.hedge_delay("hedge_delay_test", 60), resilience.HEDGE_DELAY)
+        for _ in range(95):
+            metrics.LLM_CALL_SECONDS.observe(0.2, call_site="hedge_delay_test", model="m", state="-", outcome="ok")
+        for _ in range(5):
+            metrics.LLM_CALL_SECONDS.observe(10, call_site="hedge_delay_test", model="m", state="-", outcome="ok")
+        for _ in range(50):
+            metrics.LLM_CALL_SECONDS.observe(30, call_site="hedge_delay_test", model="m", state="-", outcome="error")
+        self.assertLessEqual(resilience.hedge_delay("hedge_delay_test", 60), 0.25)
+        self.assertEqual(resilience.hedge_delay("hedge_delay_test", 0.1), 0.1)
+
+    def test_hedge_budget_caps_the_share_of_hedged_calls(self):
+        budget = HedgeBudget(ratio=0.1, burst=1)
+        hedged = 0
+        for _ in range(100):
+            budget.earn()
+            hedged += budget.spend()
+        self.assertEqual(hedged, 10)
+
+    def test_circuit_breaker_fails_fast_then_recovers(self):
+        self.script(500, 500, 500)
+        with self.assertRaises(LLMUnavailable):
+            llm_client.chat_completion(MESSAGES)
+        self.assertEqual(resilience.provider_breaker.state, "open")
+
+        with self.assertRaises(LLMUnavailable):
+            llm_client.chat_completion(MESSAGES)
+        self.assertEqual(self.server.calls["reply"], 3)
+
+        time.sleep(0.35)
+        self.assertTrue(llm_client.chat_completion(MESSAGES))
+        self.assertEqual(resilience.provider_breaker.state, "closed")
+
+
+class ProviderOutageResponseTestCase(TestCase):
+    """Test that provider outages surface as a friendly 503, not a traceback"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='outage_user', password='pass', group=UserGroup.INTERVENTION)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    @patch('api.views.state_machine.execute_state', side_effect=LLMUnavailable("down"))
+    def test_message_view_returns_503(self, mock_execute):
+        response = self.client.post('/api/message/', {'text': 'سلام'}, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data['error'], 'llm_unavailable')
+        self.assertNotIn('traceback', response.data)
+        self.assertIn('Retry-After', response)
+
+    @patch('api.views.placebo_bot_response', side_effect=LLMUnavailable("down"))
+    def test_placebo_view_returns_503(self, mock_bot):
+        response = self.client.post('/api/placebo-chat/', {'text': 'سلام'}, format='json')
+        self.assertEqual(response.status_code, 503)
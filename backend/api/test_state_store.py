@@ -0,0 +1,112 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from api.bot.state_store import DatabaseStateStore, InMemoryStateStore, StaleStateError
+from api.bot.utils import StateMachine
+from api.models import User
+
+
+class StateStoreContract:
+    """Behaviour every user state store must have"""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.user_id = self.make_user_id()
+
+    def make_user_id(self):
+        return 1
+
+    def test_round_trip_keeps_exercises_as_a_set(self):
+        self.assertEqual(self.store.load(self.user_id), (None, 0))
+
+        version = self.store.save(self.user_id, {'state': "EMOTION", 'exercises_done': {"2", "1"}}, 0)
+        state, loaded_version = self.store.load(self.user_id)
+
+        self.assertEqual(version, loaded_version)
+        self.assertEqual(state, {'state': "EMOTION", 'exercises_done': {"1", "2"}})
+
+    def test_stale_versions_are_rejected(self):
+        version = self.store.save(self.user_id, {'state': "EMOTION"}, 0)
+        self.store.save(self.user_id, {'state': "SUPER_STATE_EVENT"}, version)
+
+        with self.assertRaises(StaleStateError):
+            self.store.save(self.user_id, {'state': "THANKS"}, version)
+        with self.assertRaises(StaleStateError):
+            self.store.save(self.user_id, {'state': "THANKS"}, 0)
+        self.assertEqual(self.store.load(self.user_id)[0]['state'], "SUPER_STATE_EVENT")
+
+
+class InMemoryStateStoreTestCase(StateStoreContract, SimpleTestCase):
+    """Test the in-memory user state store"""
+
+    def make_store(self):
+        return InMemoryStateStore()
+
+
+class DatabaseStateStoreTestCase(StateStoreContract, TestCase):
+    """Test the database user state store"""
+
+    def make_store(self):
+        return DatabaseStateStore()
+
+    def make_user_id(self):
+        return User.objects.create_user(username='store_user', password='testpass').id
+
+
+class SharedUserStateTestCase(TestCase):
+    """Test that state machines in different workers see the same user state"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='shared_user', password='testpass')
+        self.worker_a = StateMachine(DatabaseStateStore())
+        self.worker_b = StateMachine(DatabaseStateStore())
+
+    def test_transitions_are_written_through(self):
+        self.worker_a.get_user_state(self.user)['exercises_done'].add("3")
+        self.worker_a.transition("EMOTION", self.user)
+
+        state = self.worker_b.load_user_state(self.user)
+        self.assertEqual(state['state'], "EMOTION")
+        self.assertEqual(state['exercises_done'], {"3"})
+        self.assertEqual(state['current_session_id'], self.worker_a.get_user_state(self.user)['current_session_id'])
+
+    def test_the_first_writer_wins_a_conflict(self):
+        self.worker_a.get_user_state(self.user)
+        self.worker_b.get_user_state(self.user)
+
+        self.worker_a.transition("EMOTION", self.user)
+        self.worker_b.transition("THANKS", self.user)
+
+        self.assertEqual(self.worker_b.get_user_state(self.user)['state'], "EMOTION")
+        self.assertEqual(StateMachine(DatabaseStateStore()).get_user_state(self.user)['state'], "EMOTION")
+
+    def test_reset_overwrites_any_version(self):
+        self.worker_a.transition("THANKS", self.user)
+
+        self.worker_b.reset_state_machine(self.user)
+
+        self.assertEqual(self.worker_a.load_user_state(self.user)['state'], "GREETING_FORMALITY_NAME")
+
+    @patch('api.bot.utils.create_recommendations', return_value=[])
+    @patch('api.bot.utils.create_exercise_explanation', return_value="چرا این تمرین")
+    @patch('api.bot.utils.StateMachine._customize_with_context', return_value="تمرین امروز")
+    @patch('api.bot.utils.suggest_exercises', return_value=(["متن تمرین"], "4"))
+    def test_a_new_session_can_reach_an_exercise_suggestion(self, mock_suggest, *mocks):
+        self.worker_a.get_user_state(self.user)['exercises_done'].add("3")
+        self.worker_a.transition("THANKS", self.user)
+        self.worker_a.handle_session_end(self.user)
+
+        self.worker_b.load_user_state(self.user)
+        self.worker_b.transition("ASK_EXERCISE", self.user)
+        self.worker_b.transition("EXERCISE_SUGGESTION", self.user)
+        _, _, _, exercise_number = self.worker_b.state_handler("بله", self.user)
+        self.worker_b.save_user_state(self.user)  # as the end of the turn does
+
+        self.assertEqual(exercise_number, "4")
+        state = self.worker_a.load_user_state(self.user)
+        self.assertEqual(state['state'], "EXERCISE_SUGGESTION")
+        self.assertEqual(state['exercises_done'], {"3", "4"})
@@ -0,0 +1,100 @@
+import threading
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from api.bot.Memory.LLM_Memory import ConversationContext, MemoryManager
+from api.bot.Memory.summary_queue import DatabaseSummaryQueue, LocalSummaryQueue
+from api.models import Message, SummaryJob, User, UserMemoryState
+
+
+class LocalSummaryQueueTestCase(SimpleTestCase):
+    """Test that the in-process queue coalesces a user's triggers"""
+
+    def test_triggers_during_a_run_cause_one_more_run(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def slow_summary(user_id):
+            calls.append(user_id)
+            started.set()
+            release.wait(5)
+
+        queue = LocalSummaryQueue(max_workers=2)
+        with patch('api.bot.Memory.summary_queue.summarize_user', slow_summary):
+            queue.enqueue(7)
+            self.assertTrue(started.wait(5))
+            for _ in range(3):
+                queue.enqueue(7)
+            release.set()
+            queue.wait()
+
+        self.assertEqual(calls, [7, 7])
+
+
+class DatabaseSummaryQueueTestCase(TestCase):
+    """Test the SummaryJob queue shared by web workers and summary workers"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='summary_user', password='testpass')
+
+    def test_a_job_is_claimed_by_one_worker(self):
+        first, second = DatabaseSummaryQueue(), DatabaseSummaryQueue()
+        first.enqueue(self.user.id)
+        first.enqueue(self.user.id)
+
+        self.assertEqual(SummaryJob.objects.count(), 1)
+        self.assertEqual(len(first.claim()), 1)
+        self.assertEqual(second.claim(), [])
+
+    def test_a_job_requested_while_running_runs_again(self):
+        queue = DatabaseSummaryQueue()
+        queue.enqueue(self.user.id)
+        job = queue.claim()[0]
+
+        with patch('api.bot.Memory.summary_queue.summarize_user', lambda user_id: queue.enqueue(user_id)):
+            queue.run(job)
+        self.assertEqual(SummaryJob.objects.get(user=self.user).claimed_by, "")
+
+        with patch('api.bot.Memory.summary_queue.summarize_user') as summarize:
+            self.assertEqual(queue.run_pending(), 1)
+        summarize.assert_called_once_with(self.user.id)
+        self.assertFalse(SummaryJob.objects.exists())
+
+    def test_failed_jobs_are_retried_then_dropped(self):
+        queue = DatabaseSummaryQueue()
+        queue.enqueue(self.user.id)
+
+        with patch('api.bot.Memory.summary_queue.summarize_user', side_effect=RuntimeError("LLM down")), \
+                patch('api.bot.Memory.summary_queue.MAX_ATTEMPTS', 2):
+            queue.run_pending()
+            self.assertEqual(SummaryJob.objects.get(user=self.user).attempts, 1)
+            queue.run_pending()
+        self.assertFalse(SummaryJob.objects.exists())
+
+
+class ScheduledSummaryTestCase(TestCase):
+    """Test that summaries leave the request path and never overwrite a newer one"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='summary_user', password='testpass')
+        self.messages = [Message.objects.create(user=self.user, text=f"پیام {i}", session_id=1) for i in range(3)]
+
+    def test_scheduling_defers_summarization_until_commit(self):
+        with patch('api.bot.Memory.LLM_Memory.summarize_conversation') as summarize, \
+                self.captureOnCommitCallbacks() as callbacks:
+            MemoryManager().schedule_summary(self.user)
+
+        summarize.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+
+    def test_a_concurrent_summary_wins(self):
+        stale = ConversationContext(self.user)
+        self.assertEqual(len(stale.unprocessed()), 3)
+        UserMemoryState.objects.filter(user=self.user).update(
+            current_memory="newer", last_processed_message=self.messages[-1])
+
+        with patch('api.bot.Memory.LLM_Memory.summarize_conversation', return_value="older"):
+            MemoryManager().update_memory(self.user, context=stale)
+
+        self.assertEqual(UserMemoryState.objects.get(user=self.user).current_memory, "newer")
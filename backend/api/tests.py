@@ -1,3 +1,6 @@
+import json
+import threading
+
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase
@@ -211,3 +214,124 @@ class ComparisonTestCase(TestCase):
         # Simple should be more complex
         self.assertIn('تمرین تست', simple_system_prompt)
         self.assertIn('دانش SAT', simple_system_prompt)
+
+
+class AsyncChatEndpointsTestCase(TestCase):
+    """Test the async (ASGI) chatbot endpoints"""
+
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.placebo_user = User.objects.create_user(
+            username='async_placebo_user',
+            password='testpass',
+            group=UserGroup.PLACEBO
+        )
+        self.token = str(RefreshToken.for_user(self.placebo_user).access_token)
+
+    async def test_async_placebo_chat_requires_auth(self):
+        """Test that the async endpoint rejects anonymous requests"""
+        response = await self.async_client.post(
+            '/api/async/placebo-chat/', {'text': 'سلام'}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_async_placebo_chat_requires_text(self):
+        """Test that the async endpoint rejects a message without text"""
+        response = await self.async_client.post(
+            '/api/async/placebo-chat/', {}, content_type='application/json',
+            headers={'Authorization': f'Bearer {self.token}'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(await Message.objects.filter(user=self.placebo_user).acount(), 0)
+
+    async def test_async_message_runs_the_turn_on_the_turn_pool(self):
+        """Test that async intervention turns run on their own sized thread pool"""
+        from .views import state_machine
+        threads = []
+
+        def execute_state(message, user):
+            threads.append(threading.current_thread().name)
+            return "پاسخ تست", [], "EMOTION", None, None
+
+        with patch.object(state_machine, 'execute_state', side_effect=execute_state):
+            response = await self.async_client.post(
+                '/api/async/message/', {'text': 'سلام'}, content_type='application/json',
+                headers={'Authorization': f'Bearer {self.token}'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(threads[0].startswith("fsm-turn"))
+
+    @patch('api.bot.placebo_bot.aopenai_req_with_history')
+    async def test_async_placebo_chat_endpoint(self, mock_openai):
+        """Test the async placebo endpoint answers and persists both messages"""
+        mock_openai.return_value = "پاسخ تست"
+
+        response = await self.async_client.post(
+            '/api/async/placebo-chat/', {'text': 'سلام'}, content_type='application/json',
+            headers={'Authorization': f'Bearer {self.token}'})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['response'], "پاسخ تست")
+        self.assertEqual(data['history'][-1], {"role": "assistant", "content": "پاسخ تست"})
+        self.assertEqual(await Message.objects.filter(user=self.placebo_user).acount(), 2)
+
+
+class StreamingEndpointsTestCase(APITestCase):
+    """Test the server-sent-events streaming endpoints"""
+
+    def setUp(self):
+        self.intervention_user = User.objects.create_user(
+            username='stream_intervention_user',
+            password='testpass',
+            group=UserGroup.INTERVENTION
+        )
+        self.placebo_user = User.objects.create_user(
+            username='stream_placebo_user',
+            password='testpass',
+            group=UserGroup.PLACEBO
+        )
+        from .bot.gpt_for_statedetection import judge_cache
+        judge_cache.clear()
+
+    def read_events(self, response):
+        body = b"".join(response.streaming_content).decode('utf-8')
+        events = []
+        for block in body.strip().split("\n\n"):
+            event_line, data_line = block.split("\n")
+            events.append((event_line[len("event: "):], json.loads(data_line[len("data: "):])))
+        return events
+
+    @patch('api.bot.placebo_bot.openai_req_with_history_stream')
+    def test_placebo_chat_stream(self, mock_stream):
+        """Test that placebo replies are streamed and persisted once complete"""
+        mock_stream.return_value = iter(["سلام", "، خوبی؟"])
+
+        self.client.force_authenticate(user=self.placebo_user)
+        response = self.client.post('/api/placebo-chat/stream/', {'text': 'سلام'})
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self.read_events(response)
+        self.assertEqual([event for event, _ in events], ["token", "token", "done"])
+        self.assertEqual(events[-1][1]['response'], "سلام، خوبی؟")
+
+        saved = list(Message.objects.filter(user=self.placebo_user).order_by('id').values_list('text', 'is_user'))
+        self.assertEqual(saved, [('سلام', True), ('سلام، خوبی؟', False)])
+
+    @patch('api.bot.utils.openai_req_generator_stream')
+    @patch('api.bot.gpt_for_statedetection.openai_req_generator')
+    def test_message_stream_runs_judge_before_streaming(self, mock_judge, mock_stream):
+        """Test that the intervention stream ends with the FSM state and saves the reply"""
+        mock_judge.return_value = "خیر"
+        mock_stream.return_value = iter(["سلام! ", "اسمت چیه؟"])
+
+        self.client.force_authenticate(user=self.intervention_user)
+        response = self.client.post('/api/message/stream/', {'text': 'سلام'})
+
+        events = self.read_events(response)
+        self.assertEqual(events[-1][0], "done")
+        self.assertEqual(events[-1][1]['response'], "سلام! اسمت چیه؟")
+        self.assertEqual(events[-1][1]['state'], "GREETING_FORMALITY_NAME")
+        mock_judge.assert_called()
+
+        reply = Message.objects.filter(user=self.intervention_user, is_user=False).get()
+        self.assertEqual(reply.text, "سلام! اسمت چیه؟")
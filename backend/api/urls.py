@@ -1,17 +1,26 @@
 from django.urls import path
 from .views import RegisterView, LoginView, MessageView, end_session, get_audio_message
 from .views import SimpleBotView, PlaceboBotView, reset_state_machine, get_chat_history, get_user_sessions, process_buffered_messages
+from .views import async_message, async_simple_chat, async_placebo_chat
+from .views import MessageStreamView, SimpleBotStreamView, PlaceboBotStreamView
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', LoginView.as_view(), name='login'),
     path('message/', MessageView.as_view(), name='message'),
+    path('message/stream/', MessageStreamView.as_view(), name='message-stream'),
     path('end-session/', end_session, name='end-session'),
     path('send-audio/', get_audio_message, name='send-audio'),
     path('simple-chat/', SimpleBotView.as_view(), name='simple-chat'),
+    path('simple-chat/stream/', SimpleBotStreamView.as_view(), name='simple-chat-stream'),
     path('placebo-chat/', PlaceboBotView.as_view(), name='placebo-chat'),
+    path('placebo-chat/stream/', PlaceboBotStreamView.as_view(), name='placebo-chat-stream'),
     path('reset-state/', reset_state_machine, name='reset-state'),
     path('process-buffered/', process_buffered_messages, name='process-buffered'),
     path('chat-history/', get_chat_history, name='chat-history'),
     path('user-sessions/', get_user_sessions, name='user-sessions'),
+    # Async variants, meant to be served through backend.asgi
+    path('async/message/', async_message, name='async-message'),
+    path('async/simple-chat/', async_simple_chat, name='async-simple-chat'),
+    path('async/placebo-chat/', async_placebo_chat, name='async-placebo-chat'),
 ]
@@ -1,24 +1,37 @@
+import hmac
+import json
 import logging
 import traceback
 
 from datetime import timezone
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import authenticate
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework.exceptions import AuthenticationFailed
 from .models import Message, User
 from .serializers import UserSerializer, MessageSerializer
 from .bot.utils import StateMachine
 from rest_framework.decorators import api_view, permission_classes
 from .bot.Memory.LLM_Memory import MemoryManager
-from .bot.simple_bot import simple_bot_response
-from .bot.placebo_bot import placebo_bot_response
+from .bot.simple_bot import simple_bot_response, asimple_bot_response, stream_simple_bot_response
+from .bot.placebo_bot import placebo_bot_response, aplacebo_bot_response, stream_placebo_bot_response
+from .bot.gpt_recommendations import create_recommendations
 
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from .bot.ASR.ASRPipeline import feed_audio_to_ASR_modal
+from .bot import metrics
+from .bot.resilience import LLMUnavailable, BREAKER_RESET_TIMEOUT
+from .bot.message_buffer import TurnLeaseLost, TurnTimeout
 
 # Create shared instances at module level
 state_machine = StateMachine()
@@ -26,6 +39,63 @@ memory_manager = MemoryManager()
 
 logger = logging.getLogger(__name__)
 
+
+def transcribe_uploaded_audio(audio_file):
+    """Save an uploaded audio file temporarily, transcribe it and clean up"""
+    logger.info(f"Received audio file: {audio_file.name}")
+
+    file_name = default_storage.save(f'audio/{audio_file.name}', ContentFile(audio_file.read()))
+    file_path = default_storage.path(file_name)
+
+    logger.info(f"Saved audio file to: {file_path}")
+
+    try:
+        text = feed_audio_to_ASR_modal(file_path)
+        logger.info(f"Transcribed text: {text}")
+    finally:
+        default_storage.delete(file_name)
+    return text
+
+
+def keep_only_numbers(s):
+    if s is None:
+        return None
+    return ''.join(char for char in s if char.isdigit())
+
+
+def llm_unavailable_body():
+    """Friendly reply for when the LLM provider is down or too slow"""
+    return {
+        "error": "llm_unavailable",
+        "response": "متاسفانه الان نمی‌توانم جواب بدهم. لطفا چند لحظه دیگر دوباره پیام بده.",
+        "retry_after": int(BREAKER_RESET_TIMEOUT),
+    }
+
+
+def llm_unavailable_response(error, response_class=Response):
+    logger.warning(f"LLM provider unavailable: {error}")
+    return response_class(llm_unavailable_body(), status=503, headers={'Retry-After': str(int(BREAKER_RESET_TIMEOUT))})
+
+
+def turn_conflict_response(error, response_class=Response):
+    """Another worker kept the user busy past the wait, or took over the turn; no reply was saved"""
+    logger.warning(f"Turn not completed: {error}")
+    return response_class({"error": str(error)}, status=409)
+
+
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 class RegisterView(APIView):
     def get_balanced_group(self):
         """Get balanced group assignment based on current user counts across all three groups"""
@@ -90,9 +160,7 @@ class MessageView(APIView):
     permission_classes = [IsAuthenticated]
 
     def keep_only_numbers(self, s):
-        if s is None:
-            return None
-        return ''.join(char for char in s if char.isdigit())
+        return keep_only_numbers(s)
 
     def post(self, request):
         try:
@@ -101,18 +169,9 @@ class MessageView(APIView):
 
             if 'audio' in request.FILES:
                 try:
-                    audio_file = request.FILES['audio']
-                    logger.info(f"Received audio file: {audio_file.name}")
-                    
-                    file_name = default_storage.save(f'audio/{audio_file.name}', ContentFile(audio_file.read()))
-                    file_path = default_storage.path(file_name)
-                    
-                    logger.info(f"Saved audio file to: {file_path}")
-                    
-                    text = feed_audio_to_ASR_modal(file_path)
-                    logger.info(f"Transcribed text: {text}")
-                    
-                    default_storage.delete(file_name)
+                    text = transcribe_uploaded_audio(request.FILES['audio'])
+                except LLMUnavailable as e:
+                    return llm_unavailable_response(e)
                 except Exception as e:
                     logger.error(f"Audio processing error: {str(e)}")
                     logger.error(traceback.format_exc())
@@ -131,15 +190,6 @@ class MessageView(APIView):
             logger.info(f"Processing message from user: {user}")
             
             response_text, recommendations, state, explainibility, exercise_number = state_machine.execute_state(text, user)
-            
-            if response_text is None:
-                return Response({
-                    "response": "دارم فکر میکنم ...",
-                    "recommendations": [],
-                    "state": "PROCESSING",
-                    "explainibility": None,
-                    "excercise_number": None
-                }, status=202)
                 
             excercise_number = self.keep_only_numbers(exercise_number)
             
@@ -151,6 +201,10 @@ class MessageView(APIView):
                 "excercise_number": excercise_number
             }, status=200)
 
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
+        except (TurnLeaseLost, TurnTimeout) as e:
+            return turn_conflict_response(e)
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
             logger.error(traceback.format_exc())
@@ -201,7 +255,10 @@ class SimpleBotView(APIView):
         history = self.get_last_n_history(user, n=6)
 
         # Call the bot
-        response_text, recommendations, updated_history = simple_bot_response(history, text, user)
+        try:
+            response_text, recommendations, updated_history = simple_bot_response(history, text, user)
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
 
         # Save assistant message
         Message.objects.create(user=user, text=response_text, is_user=False, session_id=session_id)
@@ -261,7 +318,10 @@ class PlaceboBotView(APIView):
         history = self.get_last_n_history(user, n=6)
 
         # Call the placebo bot
-        response_text, recommendations, updated_history = placebo_bot_response(history, text, user)
+        try:
+            response_text, recommendations, updated_history = placebo_bot_response(history, text, user)
+        except LLMUnavailable as e:
+            return llm_unavailable_response(e)
 
         # Save assistant message
         Message.objects.create(user=user, text=response_text, is_user=False, session_id=session_id)
@@ -278,6 +338,114 @@ class PlaceboBotView(APIView):
         }, status=200)
 
 
+class MessageStreamView(MessageView):
+    """
+    SSE variant of MessageView. The judge/classifier calls run first, then the
+    final reply is streamed as `token` events and a closing `done` event
+    carries the same fields as MessageView's JSON body.
+    """
+
+    def post(self, request):
+        user = request.user
+
+        if 'audio' in request.FILES:
+            try:
+                text = transcribe_uploaded_audio(request.FILES['audio'])
+            except LLMUnavailable as e:
+                return llm_unavailable_response(e)
+            except Exception as e:
+                logger.error(f"Audio processing error: {str(e)}")
+                logger.error(traceback.format_exc())
+                return Response({"error": f"Error processing audio: {str(e)}"}, status=500)
+        else:
+            text = request.data.get('text')
+
+        if not text:
+            return Response({
+                "error": "No text or audio input provided"
+            }, status=400)
+
+        logger.info(f"Streaming message from user: {user}")
+        return sse_response(self.events(text, user))
+
+    def events(self, text, user):
+        try:
+            for event, data in state_machine.stream_state(text, user):
+                if event == "token":
+                    yield sse_event("token", {"text": data})
+                else:
+                    response_text, recommendations, state, explainibility, exercise_number = data
+                    yield sse_event("done", {
+                        "response": response_text,
+                        "recommendations": recommendations,
+                        "state": state,
+                        "explainibility": explainibility,
+                        "excercise_number": self.keep_only_numbers(exercise_number)
+                    })
+        except LLMUnavailable as e:
+            logger.warning(f"LLM provider unavailable while streaming: {e}")
+            yield sse_event("error", llm_unavailable_body())
+        except (TurnLeaseLost, TurnTimeout) as e:
+            logger.warning(f"Turn not completed while streaming: {e}")
+            yield sse_event("error", {"error": str(e)})
+        except Exception as e:
+            logger.error(f"Unexpected error while streaming: {str(e)}")
+            logger.error(traceback.format_exc())
+            yield sse_event("error", {"error": str(e)})
+
+
+class HistoryBotStreamMixin:
+    """SSE post() for the history-based bots (simple and placebo)"""
+
+    stream_bot_response = None
+
+    def post(self, request):
+        text = request.data.get('text')
+        user = request.user
+
+        session_id = self.get_current_session_id(user)
+
+        memory_manager.add_message(user=user, text=text, is_user=True, session_id=session_id)
+
+        history = self.get_last_n_history(user, n=6)
+
+        return sse_response(self.events(history, text, user, session_id))
+
+    def events(self, history, text, user, session_id):
+        try:
+            parts = []
+            for chunk in self.stream_bot_response(history, text, user):
+                parts.append(chunk)
+                yield sse_event("token", {"text": chunk})
+            response_text = "".join(parts)
+
+            memory_manager.add_message(user=user, text=response_text, is_user=False, session_id=session_id)
+
+            yield sse_event("done", {
+                "response": response_text,
+                "recommendations": create_recommendations(response_text, memory=""),
+                "history": history + [
+                    {"role": "user", "content": text},
+                    {"role": "assistant", "content": response_text}
+                ]
+            })
+        except LLMUnavailable as e:
+            logger.warning(f"LLM provider unavailable while streaming: {e}")
+            yield sse_event("error", llm_unavailable_body())
+        except Exception as e:
+            logger.error(f"Unexpected error while streaming: {str(e)}")
+            logger.error(traceback.format_exc())
+            yield sse_event("error", {"error": str(e)})
+
+
+class SimpleBotStreamView(HistoryBotStreamMixin, SimpleBotView):
+    stream_bot_response = staticmethod(stream_simple_bot_response)
+
+
+class PlaceboBotStreamView(HistoryBotStreamMixin, PlaceboBotView):
+    stream_bot_response = staticmethod(stream_placebo_bot_response)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_chat_history(request):
@@ -425,7 +593,133 @@ def process_buffered_messages(request):
             "explainibility": explainibility,
             "excercise_number": excercise_number
         }, status=200)
+    except (TurnLeaseLost, TurnTimeout) as e:
+        return turn_conflict_response(e)
     except Exception as e:
         return Response({
             'error': f'Failed to process buffered messages: {str(e)}'
         }, status=500)
+
+
+# ---------------------------------------------------------------------------
+# Async message path (served by backend.asgi). These are plain Django async
+# views because DRF's APIView is sync-only; JWT auth is resolved manually.
+# ---------------------------------------------------------------------------
+
+async def aauthenticate(request):
+    """Return the JWT-authenticated user for an async view, or None"""
+    try:
+        result = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    return result[0] if result else None
+
+
+def get_request_text(request):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}').get('text')
+        except ValueError:
+            return None
+    return request.POST.get('text')
+
+
+@csrf_exempt
+@require_POST
+async def async_message(request):
+    """Async variant of MessageView for the intervention group"""
+    user = await aauthenticate(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+    try:
+        if 'audio' in request.FILES:
+            text = await sync_to_async(transcribe_uploaded_audio, thread_sensitive=False)(request.FILES['audio'])
+        else:
+            text = get_request_text(request)
+
+        if not text:
+            return JsonResponse({"error": "No text or audio input provided"}, status=400)
+
+        response_text, recommendations, state, explainibility, exercise_number = await state_machine.aexecute_state(text, user)
+
+        return JsonResponse({
+            "response": response_text,
+            "recommendations": recommendations,
+            "state": state,
+            "explainibility": explainibility,
+            "excercise_number": keep_only_numbers(exercise_number)
+        }, status=200)
+
+    except LLMUnavailable as e:
+        return llm_unavailable_response(e, JsonResponse)
+    except (TurnLeaseLost, TurnTimeout) as e:
+        return turn_conflict_response(e, JsonResponse)
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        logger.error(traceback.format_exc())
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+async def _async_history_bot(request, bot_response):
+    user = await aauthenticate(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+    text = get_request_text(request)
+    if not text:
+        return JsonResponse({"error": "No text input provided"}, status=400)
+
+    session_id = await memory_manager.aget_current_session_id(user)
+
+    await memory_manager.aadd_message(user, text, is_user=True, session_id=session_id)
+
+    history = await memory_manager.aget_last_n_history(user, n=6)
+
+    try:
+        response_text, recommendations, updated_history = await bot_response(history, text, user)
+    except LLMUnavailable as e:
+        return llm_unavailable_response(e, JsonResponse)
+
+    await memory_manager.aadd_message(user, response_text, is_user=False, session_id=session_id)
+
+    updated_history = history + [
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": response_text}
+    ]
+    return JsonResponse({
+        "response": response_text,
+        "recommendations": recommendations,
+        "history": updated_history
+    }, status=200)
+
+
+@csrf_exempt
+@require_POST
+async def async_simple_chat(request):
+    """Async variant of SimpleBotView for the control group"""
+    return await _async_history_bot(request, asimple_bot_response)
+
+
+@csrf_exempt
+@require_POST
+async def async_placebo_chat(request):
+    """Async variant of PlaceboBotView for the placebo group"""
+    return await _async_history_bot(request, aplacebo_bot_response)
+
+
+def may_read_metrics(request):
+    """Whether the request comes from an allowed address or carries the metrics token"""
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1']):
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorization = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(authorization, f"Bearer {token}")
+
+
+@require_GET
+def metrics_view(request):
+    """Prometheus scrape endpoint for per-call-site LLM latency and token metrics"""
+    if not may_read_metrics(request):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
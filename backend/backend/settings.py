@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from datetime import timedelta
 from pathlib import Path
 
@@ -51,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.middleware.llm_deadline_middleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -86,6 +88,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Several workers share the file: wait for its write lock. The shared
+        # lease and state writes take that lock up front (api.bot.db)
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -176,3 +181,99 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=15),
 }
+
+
+# LLM model routing (api/bot/model_routing.py). Keys are call-site names as
+# labelled by api.bot.metrics.llm_call_site ("ask_llm" also covers every
+# "ask_llm:<prompt file>"), optionally suffixed with "@<FSM state>". Each entry
+# may set tier or model, temperature and max_tokens; unset fields fall back to
+# the less specific entry. A model or temperature the caller passes explicitly
+# wins over the route.
+LLM_MODEL_TIERS = {
+    'large': os.getenv('LLM_LARGE_MODEL', 'gpt-4o'),
+    'small': os.getenv('LLM_SMALL_MODEL', 'gpt-4o-mini'),
+}
+
+LLM_ROUTING = {
+    'default': {'tier': 'large'},
+    # Binary decisions do not need the large model. The judge is not capped:
+    # after "خیر" it lists what is missing, which the state's reply is told
+    'judge': {'tier': 'small'},
+    'emotion_retriever': {'tier': 'small', 'max_tokens': 5},
+    'response_retriever': {'tier': 'small', 'max_tokens': 5},
+}
+
+# SAT knowledge base sections every prompt of a state carries; the sections
+# that best match the user's message are added on top (api.bot.RAG.knowledge_base).
+SAT_KNOWLEDGE_SECTIONS = {
+    'default': ['تعریف و اساس نظری تکنیک دلبستگی به خود (SAT)'],
+    'EMOTION': ['تعریف و اساس نظری تکنیک دلبستگی به خود (SAT)', '2. تنظیم هیجان'],
+    'SUPER_STATE_EVENT': ['تعریف و اساس نظری تکنیک دلبستگی به خود (SAT)', '2. تنظیم هیجان',
+                          '4. حل آسیب‌های گذشته'],
+    'OPEN_ENDED_CONVERSATION': ['تعریف و اساس نظری تکنیک دلبستگی به خود (SAT)', '2. تنظیم هیجان',
+                                '4. حل آسیب‌های گذشته'],
+    'ASK_EXERCISE': ['تعریف و اساس نظری تکنیک دلبستگی به خود (SAT)', 'اصول کلیدی SAT'],
+    'EXERCISE_SUGGESTION': ['اصول کلیدی SAT', 'نکات مهم برای اجرا'],
+    'EXERCISE_EXPLANATION': ['اصول کلیدی SAT', 'نکات مهم برای اجرا'],
+    'FEEDBACK': ['اصول کلیدی SAT', 'نکات مهم برای اجرا'],
+    'LIKE_ANOTHER_EXERCSISE': ['اصول کلیدی SAT', 'نکات مهم برای اجرا'],
+    'simple_bot': ['تعریف و اساس نظری تکنیک دلبستگی به خود (SAT)', 'اصول کلیدی SAT', 'نکات مهم برای اجرا'],
+}
+
+# Token budget of a state's whole system prompt (rules, SAT knowledge, memory
+# and history); older turns are dropped first when a conversation outgrows it.
+LLM_CONTEXT_BUDGETS = {
+    'default': int(os.getenv('LLM_CONTEXT_BUDGET', '12000')),
+}
+
+# Where each user's FSM state is kept (api/bot/state_store.py): "database",
+# "redis" (needs the redis package) or "memory" (single process only).
+USER_STATE_STORE = os.getenv('USER_STATE_STORE', 'database')
+USER_STATE_REDIS_URL = os.getenv('USER_STATE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Coordination of a user's concurrent messages (api/bot/message_buffer.py):
+# "memory" works only with a single process; "database" and "redis" share
+# the per-user turn lease and the buffered messages between workers.
+MESSAGE_BUFFER_BACKEND = os.getenv('MESSAGE_BUFFER_BACKEND', 'memory' if USER_STATE_STORE == 'memory' else USER_STATE_STORE)
+MESSAGE_BUFFER_LEASE_SECONDS = float(os.getenv('MESSAGE_BUFFER_LEASE_SECONDS', '30'))
+MESSAGE_BUFFER_REDIS_URL = os.getenv('MESSAGE_BUFFER_REDIS_URL', USER_STATE_REDIS_URL)
+
+# A user's turns run one at a time (api/bot/mailbox.py). Messages sent while
+# a turn runs, or less than MAILBOX_DEBOUNCE_SECONDS apart (at most
+# MAILBOX_MAX_DEBOUNCE_SECONDS in all), are answered together by one turn.
+# Every turn waits out the debounce window first, so it is off by default.
+MAILBOX_DEBOUNCE_SECONDS = float(os.getenv('MAILBOX_DEBOUNCE_SECONDS', '0'))
+MAILBOX_MAX_DEBOUNCE_SECONDS = float(os.getenv('MAILBOX_MAX_DEBOUNCE_SECONDS', '2'))
+# How long a turn waits for the same user's turn in another worker
+MAILBOX_TURN_WAIT_SECONDS = float(os.getenv('MAILBOX_TURN_WAIT_SECONDS', '60'))
+# Intervention turns served by the ASGI views run synchronously on a pool of
+# this many threads; a process holds at most this many such turns at once.
+ASYNC_TURN_WORKERS = int(os.getenv('ASYNC_TURN_WORKERS', '64'))
+
+# Classifier and judge calls are hedged (api/bot/resilience.py): when one has
+# run longer than LLM_HEDGE_QUANTILE of its call site's recent calls, a
+# duplicate request races it. Each hedge is a second paid request, so the
+# tail latency saved is bought with tokens: at most LLM_HEDGE_BUDGET of the
+# hedgeable calls (plus a burst of LLM_HEDGE_BURST) send a duplicate, which
+# caps their extra spend at that share. Both at 0 turn hedging off; a lower
+# quantile hedges sooner but exhausts the budget faster.
+LLM_HEDGE_QUANTILE = float(os.getenv('LLM_HEDGE_QUANTILE', '0.95'))
+LLM_HEDGE_BUDGET = float(os.getenv('LLM_HEDGE_BUDGET', '0.05'))
+LLM_HEDGE_BURST = float(os.getenv('LLM_HEDGE_BURST', '3'))
+
+# Memory summaries are refreshed in the background (api/bot/Memory/summary_queue.py):
+# "local" runs them on a thread pool in each web process, "database" queues
+# them in SummaryJob rows for `manage.py run_summary_worker`, "inline" runs
+# them on the request thread.
+SUMMARY_QUEUE_BACKEND = os.getenv('SUMMARY_QUEUE_BACKEND', 'local')
+SUMMARY_QUEUE_WORKERS = int(os.getenv('SUMMARY_QUEUE_WORKERS', '2'))
+
+# Start the exercise suggestion as soon as the user is asked whether they
+# want an exercise (api/bot/prefetch.py); it is used if its inputs still hold.
+EXERCISE_PREFETCH_ENABLED = os.getenv('EXERCISE_PREFETCH_ENABLED', '1') == '1'
+
+# Who may read /metrics: clients whose address is in METRICS_ALLOWED_IPS, or
+# that send "Authorization: Bearer <METRICS_TOKEN>" when a token is set. The
+# address is the connection's, so behind a proxy rely on the token.
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()]
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')